@@ -5,13 +5,15 @@
 
 Main script that start the processes including the live plot
 
-- 6 independent processes:
+- 8 independent processes:
     - connect and get emg from TCU to get raw data
     - connect and use the stimulator
     - filter raw data
     - rms filtered data
     - plot live
     - console monitor
+    - connect and get imu from TCU
+    - record all the data streams to disk
 
 """
 
@@ -29,12 +31,13 @@ import numpy as np
 import json
 from datetime import datetime
 from time import sleep
-import scipy.io as sio
 from collections import OrderedDict
 import multiprocessing
 from multiprocessing import Process, Pipe, freeze_support, Manager
 
 from orlau_utils import showTitle, printColor, show
+from orlau_ring import SharedRing
+from orlau_control import SharedControl
 
 if __name__ == '__main__':
     
@@ -45,6 +48,8 @@ if __name__ == '__main__':
     from orlau_imu             import funcStreamImu
     from orlau_monitor         import funcMonitor
     from orlau_stim            import funcStim2
+    from orlau_recorder        import funcRecorder
+    from orlau_export          import export_session
 
     ###
     # Config
@@ -61,7 +66,8 @@ if __name__ == '__main__':
         'recordButton'          : [],                   # list of lists containing the current iteration of raw/filt/rms emg every time we press it, so we can work out when it was pressed during the whole recording (as we save all data from start/stop of the GUI)
 
         # EMG and filtering
-        'emg_muscles_names'     : ['deltoid','biceps'], # list of the muscles that have an EMG/IMU: one device per muscle
+        'emg_muscles_names'     : ['deltoid','biceps'], # list of the muscles that have an EMG/IMU: one device per muscle. All the per-muscle settings below (lists) and data streams (rows) follow this order
+        'emg_sensors'           : [1,2],                # number of the delsys sensor (as shown in the TCU) placed on each muscle of emg_muscles_names: only these channels are decoded
         'emg_thresh_noStim'     : [0.00032,0.00032],    # threshold at which a muscle is considered active (when there is no stimulation running, in which case it is higher)
         'emg_thresh_withStim'   : [0.00032,0.00032],    # threshold at which a muscle is considered active (when stimulation is ongoing)
         'emg_connected'         : False,                # flag indicating if we have successfully connected to the delsys base station and are streaming live
@@ -69,6 +75,8 @@ if __name__ == '__main__':
         'emg_dummyMode'         : False,                # for offline testing live-stream
         'streamTimeStart'       : None,                 # keep track of when we received the first batch of data to display streaming time (as can't calculate from length of arrays that get dumped to disk) 
         'samples_per_read'      : 300,                  # size of batch of data received from the basestation
+        'emg_lowLatency'        : False,                # if True, the emg is read, filtered, rms'd and given to the controller frame by frame as the basestation sends it (emg_frameSamples instead of samples_per_read, which is then set to it), the recorder still writes in large blocks
+        'emg_frameSamples'      : 27,                   # size of the frames sent by the basestation (27 samples = 13.5ms at 2000Hz), used as batch in emg_lowLatency mode
         'maxArraySize'          : 6000,                 # max length of data arrays to keep in memory before dumping to disk (used by all arrays)
         'emg_iter'              : 0,                    # keep track of the number of batches to synchronise the processes with blocking mechanisms
 
@@ -76,8 +84,17 @@ if __name__ == '__main__':
         'emg_filter_do'         : True,                 # for debug: only change for testing! True by default. if False, the "filt" process will pass the raw data to rms. if True, uses 'stim_thresh' and 'filter_delWindow' to filter the data
         'stim_thresh'           : 0.0009,               # the threshold at which we will decide to start filtering EMG when the stim is making our signal noisy
         'filter_delWindow'      : 10,                   # number of data to filter out before and after each value that was above the stimulation trigger value 'stim_thresh'. Try a value between 10 and 20.
+        'filter_fillMode'       : ['hold','zero'],      # for each muscle, how the filter replaces the stimulation artifacts: 'hold' the last good value, or 'zero'
+        'filter_spill'          : False,                # if True, the blanking after an artifact at the end of a batch continues at the start of the next batch (otherwise it is cut at the end of the batch)
         'filter_iter'           : 0,                    # keep track of the number of batches to synchronise the processes with blocking mechanisms
 
+        # Stages falling behind (filter, rms)
+        'stage_catchUp'         : 'all',                # when the filter/rms fall behind by several batches: 'all' to process all of them in one go, 'latest' to skip to the latest batch (the skipped ones are left empty, NaN, in their streams)
+        'stage_gaps'            : [],                   # set by the filter/rms: the last stage_gapsKept runs of batches they skipped, [stage, first batch, number of batches]
+        'stage_gapsKept'        : 100,                  # number of runs of skipped batches kept in stage_gaps
+        'filter_skipped'        : 0,                    # set by the filter: number of batches it skipped since the start
+        'rms_skipped'           : 0,                    # set by the rms: number of batches it skipped since the start (a batch skipped by both stages is counted by both)
+
         # EMG rms
         'rms_analogFreq'        : 2000,                 # RMS parameters for emg filtering (delsys is 2000Hz)
         'rms_power'             : 2,
@@ -85,6 +102,7 @@ if __name__ == '__main__':
         'rms_low'               : 400,
         'rms_window'            : 150,
         'rms_iter'              : 0,                    # keep track of the number of batches to synchronise the processes with blocking mechanisms
+        'rms_latency'           : None,                 # set by the rms process every second: time from the reception of each batch to the decision of the controller (ms: mean, p95, max)
 
         # IMU
         'imu_connected'         : False,                # flag indicating if we have successfully connected to the delsys base station and are streaming live
@@ -93,59 +111,102 @@ if __name__ == '__main__':
         'imu_maxArraySize'      : 6000,                 # max length of data arrays to keep in memory before dumping to disk (used by all arrays)
         'imu_iter'              : 0,                    # keep track of the number of batches to synchronise the processes with blocking mechanisms
         'imu_iter_sync_emg'     : None,                 # to sync emg/imu : when EMG was iternumber 1, what was the iternumber of IMU? (it's actually a tuple if EMG started faster than IMU - which is unlikely)
+        'imu_sensors'           : [4,8],                # number of the delsys sensors whose IMU we record (only their aux channels are decoded and saved). None to record all 144 channels
+        'imu_auxChannels'       : [0,1,2,3],            # channels of each of those sensors that we record, in its block of 9 aux channels (the first 4: columns 27:31 and 63:67 for sensors 4 and 8, [0,1,2] for the accelerometer x/y/z only). None to record all of them
+        'imu_channels'          : None,                 # set by the imu process once connected: channel indices (in the 144 aux channels) saved as the channels of data_imu.bin
+        'imu_rate'              : None,                 # set by the imu process once connected: sample rate of the imu (Hz)
+
+        # Recording (done by the recorder process, from the shared rings)
+        'record_container'      : True,                 # if True, all the streams are recorded in a single indexed file (session.orl, see orlau_session), otherwise in one file per stream (data_*.bin, see orlau_record)
+        'record_streams'        : {'emg_raw':'data_raw', 'emg_filt':'data_filter', 'emg_rms':'data_rms', 'activ_hist':'data_activ_history',
+                                   'controller_val_hist':'data_controller_value', 'pulse_val_hist':'data_controller_intensity', 'imu_all':'data_imu'}, # data stream recorded: name of its file when not using the container
+        'record_compress'       : ['imu_all'],          # streams compressed in the container (lossless delta + zlib per chunk), from a background thread of the recorder
+        'record_events'         : {'activ_hist':'emg_rms', 'controller_val_hist':'emg_rms', 'pulse_val_hist':'emg_rms'}, # piecewise-constant streams saved as their changes of value in the container, and the stream giving their times
+        'record_flushInterval'  : 0.5,                  # time between two writes of the recorder (s): each write gathers all the batches received meanwhile
+        'record_export'         : [],                   # formats the recording is exported to at the end of the session ('mat', 'npz', see orlau_export), can also be done afterwards
+        'record_manifestInterval': 1,                   # time between two updates of the manifest of the session (manifest.json: configuration, samples written, last consistent batch), used by orlau_recover after a crash
+        'record_fsyncInterval'  : 5,                    # time between two fsync of the recorded files (s): 0 after every write, None only when closing the files
+        'record_maxBacklog'     : 10,                   # the rings of the 2000Hz streams keep at least this much data (s), i.e. how long the disk can stall before we lose data
+        'record_backlog'        : 0,                    # set by the recorder: data waiting to be written (s, the largest over the streams)
+        'record_dropped'        : 0,                    # set by the recorder: number of samples overwritten in the rings before they could be written
 
         # Controller
         'controller_on'         : False,                # if True, the intensity is set by the feedback of the controller. If False, we are in "manual" mode and the pulse intensity is set in the GUI. The controller is called by the EMG process thus this parameter here
         'controller_value'      : 0,                    # starts at 0, will be changed by the emg process that calls the controller
+        'controller_muscles'    : ['deltoid','biceps'], # muscles given to the controller (from emg_muscles_names): stimulate when the first one is active and the second one is not
 
         # Stim
-        'stim_musclesName'      : 'triceps',            # list of the muscles stimulated
-        'stim_channelNumbers'   : 1,                    # lisf of the color of the cables of the stimulator (red = 0, blue = 1, grey = 2)
-        'stim_max_intensity'    : 15,                   # the hardcoded max intensity chosen at calibration for each muscle (milliAmp)
+        'stim_musclesName'      : ['triceps'],          # list of the muscles stimulated. All the per-channel settings below (lists) and the rows of pulse_val_hist follow this order
+        'stim_channelNumbers'   : [1],                  # list of the channels (color of the cables) of the stimulator for each muscle (red = 0, blue = 1, grey = 2): all updated in one packet
+        'stim_max_intensity'    : [15],                 # the hardcoded max intensity chosen at calibration for each muscle (milliAmp)
+        'stim_pulseShape'       : [[1, 1]],             # points of each pulse: [fraction of pulse_width, fraction of the intensity], e.g. [[1, 1], [1, -1]] for a biphasic pulse. One shape for all the muscles, or one per muscle (list of shapes). At most 16 points
         'pulse_width'           : 300,                  # the pulse length, or 'time' in microseconds (us)
         'pulse_period'          : 40,                   # the period in milliSeconds, so if period is 25ms it is 1/25 = 40Hz ; 1/10 = 100Hz
-        'pulse_intensity_man'   : 0,                    # current or intensity in milliAmps: start at 0 - the one we set manually in the GUI
-        'pulse_intensity_auto'  : 0,                    # current or intensity in milliAmps: start at 0 - the one that is calculated from the controller's value
+        'pulse_intensity_man'   : [0],                  # current or intensity in milliAmps for each muscle: start at 0 - the one we set manually in the GUI
+        'pulse_intensity_auto'  : [0],                  # current or intensity in milliAmps for each muscle: start at 0 - the one that is calculated from the controller's value
         'stim_connected'        : False,                # flag indicating if we have successfully connected to the stimulator
         'stim_shutdown'         : False,                # flag indicating if we should do a graceful exit of the stimulator process
-        'stim_dummyMode'        : False,                # for offline testing live-stream
+        'stim_portCache'        : None,                 # file keeping the serial port the stimulator was last found on (tried first at the next start), set below in Data
+        'stim_portTimeout'      : 2,                    # time given to the serial ports to answer when looking for the stimulator (s), for the cached port and then for all the others at once
+        'stim_dummyMode'        : False,                # for offline testing live-stream: the pure-python stimulator of orlau_stim_sim is used instead of sciencemode3 (its calls are logged to stim_log.sim in the session folder)
         'stim_do'               : False,                # flag indicating if the stimulator should send a pulse (whether it skips it or sends a 0 pulse)
+        'stim_schedule'         : 'change',             # when the stimulator process sends an update: 'change' as soon as the intensity/settings change (and every stim_keepAlive), 'pulse' once per pulse (every pulse_period)
+        'stim_keepAlive'        : 0.5,                  # maximum time between two updates when nothing changes (s), well within the 2s after which the stimulator stops
+        'stim_checkPeriod'      : 20,                   # how often the settings changed from the GUI are looked at (ms), the controller's are sent as soon as it publishes them
+        'stim_timing'           : None,                 # set by the stimulator process every second: updates sent (and why), deadlines missed, how late they were sent and how long sending took (ms)
 
         # GUI only
         'gui_preview_type'      : 'raw',                # raw / rms (takes from a different array)
         'gui_zoom'              : 0.0014,               # zoom value for the plot
         'gui_refresh_delay'     : 200,                  # refresh rate of the GUI (ms)
         'gui_downsample'        : 0,                    # if want to downsample the preview (does not impact the actual data, just the live plot!)
-        'active_delt'           : False,                # the emg rms process/controller will decide which muscle is active, and update this flag
-        'active_bic'            : False,
+        'emg_active'            : [False,False],        # the emg rms process/controller will decide which muscle is active, and update these flags (one per muscle)
         'recordBtn_timeFrames'  : 0,                    # saved the frame current frame number when pressing the record button: it is generic so can also serve to indicate various events (if following a protocol) that we can flag when saving the data
         'buttonRecord_status'   : False,                # feedback on whether we are set to save the current stream as recorded or not
         })
 
+    # low-latency mode: all the stages work on the frames of the basestation (one controller decision every 13.5ms)
+    if config['emg_lowLatency']:
+        config['samples_per_read'] = config['emg_frameSamples']
+
+    # data streams exchanged between the processes: (number of channels, number of samples kept in memory, dtype)
+    # the emg streams have one row per muscle of emg_muscles_names
+    # (they keep at least record_maxBacklog seconds, so that the recorder can catch up after a slow write)
+    nMuscles = len(config['emg_muscles_names'])
+    nStim    = len(config['stim_musclesName'])
+    ringSize = max(config['maxArraySize'], int(config['record_maxBacklog'] * config['rms_analogFreq']))
     data = OrderedDict({
         
-        'emg_delt_raw'        : np.array([]), # we constantly save the raw data from the basestation so that is our raw data
-        'emg_bic_raw'         : np.array([]),
-        
-        'emg_delt_filt'       : np.array([]), # the raw data is then going through the filter and is saved here
-        'emg_bic_filt'        : np.array([]),
+        'emg_raw'             : (nMuscles, ringSize,                   'float64'), # we constantly save the raw data from the basestation so that is our raw data
+        'emg_filt'            : (nMuscles, ringSize,                   'float64'), # the raw data is then going through the filter and is saved here
+        'emg_rms'             : (nMuscles, ringSize,                   'float64'), # after the filtering, rms is performed
         
-        'emg_delt_rms'        : np.array([]), # after the filtering, rms is performed
-        'emg_bic_rms'         : np.array([]),
+        'imu_all'             : (144,      config['imu_maxArraySize'], 'float32'), # we constantly save the imu data from the basestation (only the rows of imu_channels are filled)
         
-        'imu_all'             : np.array([]), # we constantly save the imu data from the basestation
-        'imu_delt'            : np.array([]),
-        'imu_bic'             : np.array([]),
-        
-        'controller_val_hist' : np.array([]), # history of the values of the controller
-        'pulse_val_hist'      : np.array([]), # history of the values of the pulse intensity, might be useful when we look at the calibrations?
-        'activ_delt_hist'     : np.array([]), # history of the activity of the muscles ? useful for analysing results easily
-        'activ_bic_hist'      : np.array([]),
+        'controller_val_hist' : (1,        ringSize,                   'float64'), # history of the values of the controller
+        'pulse_val_hist'      : (nStim,    ringSize,                   'float64'), # history of the values of the pulse intensity (one row per stimulated muscle), might be useful when we look at the calibrations?
+        'activ_hist'          : (nMuscles, ringSize,                   'float64'), # history of the activity of the muscles ? useful for analysing results easily
 
         })
 
+    # hot settings, read or written at every iteration by the stim/rms processes and the GUI: (numpy dtype)
+    # they are taken out of the Manager dict and kept in a control block in shared memory (initial values from config)
+    control = OrderedDict({
+        'stim_do'               : '?',
+        'controller_on'         : '?',
+        'controller_value'      : 'f8',
+        'stim_max_intensity'    : ('i8', (nStim,)),
+        'pulse_width'           : 'i8',
+        'pulse_period'          : 'f8',
+        'pulse_intensity_man'   : ('i8', (nStim,)),
+        'pulse_intensity_auto'  : ('f8', (nStim,)),
+        'emg_active'            : ('?', (nMuscles,)),
+        'stim_shutdown'         : '?',                  # polled by the stimulator loop
+        })
+
     # Prepare folders for data recording
     config['dataSaveFolder'] = CURR_DIR + "/Data/" + config['participant_name'] + '_' + config['session_name'] + "_" + config['session_date']
+    config['stim_portCache'] = CURR_DIR + "/Data/stim_port.json"
     # Make sure output folder exists
     if not os.path.exists(config['dataSaveFolder']):
         print(f"creating output folder")
@@ -154,12 +215,15 @@ if __name__ == '__main__':
     # Make our config a shared object (create unique keys instead of nesting a dict: otherwise proxy won't be triggered and change not propagated to manager)
     sharedConfig = multiprocessing.Manager().dict()  # dict wit results
     for key in config:
-        sharedConfig[key] = config[key]
+        if key not in control:
+            sharedConfig[key] = config[key]
+    sharedControl = SharedControl(control, config)
 
-    # Then we create a different sharedData for the data (so that we can export config / data easily and separately!)
-    sharedData   = multiprocessing.Manager().dict()  # dict wit results
+    # Then we create a ring buffer in shared memory for each data stream (so that we can export config / data easily and separately!)
+    # the processes append/read batches directly in shared memory, instead of sending whole arrays through the manager
+    sharedData   = OrderedDict()
     for key in data:
-        sharedData[key] = data[key]
+        sharedData[key] = SharedRing(*data[key])
 
     ###
     # Create the processes
@@ -179,17 +243,19 @@ if __name__ == '__main__':
     # 1) get raw emg from delsys place in shared obj
     t1 = multiprocessing.Process(target=funcStreamEmg,    args=(sharedConfig, sharedData, sharedQueue1, sharedQueue2), kwargs={"verbose":False,"debug":False})
     # 2) filter from raw (whether we perform any filtering or not, it's going through it!)
-    t2 = multiprocessing.Process(target=funcFilter,       args=(sharedConfig, sharedData, sharedQueue1, sharedQueue2), kwargs={"verbose":False,"debug":False})  
+    t2 = multiprocessing.Process(target=funcFilter,       args=(sharedConfig, sharedData, sharedControl, sharedQueue1, sharedQueue2), kwargs={"verbose":False,"debug":False})  
     # 3) rms on filtered data from t2 to t3
-    t3 = multiprocessing.Process(target=funcRms,          args=(sharedConfig, sharedData, sharedQueue1, sharedQueue2), kwargs={"verbose":False,"debug":False})
+    t3 = multiprocessing.Process(target=funcRms,          args=(sharedConfig, sharedData, sharedControl, sharedQueue1, sharedQueue2), kwargs={"verbose":False,"debug":False})
     # 4) live plot from raw/filtered/rms
-    t4 = multiprocessing.Process(target=functionLivePlot, args=(sharedConfig, sharedData, sharedQueue1, sharedQueue2), kwargs={"verbose":False,"debug":False})
+    t4 = multiprocessing.Process(target=functionLivePlot, args=(sharedConfig, sharedData, sharedControl, sharedQueue1, sharedQueue2), kwargs={"verbose":False,"debug":False})
     # 5) stimulator
-    t5 = multiprocessing.Process(target=funcStim2,        args=(sharedConfig, sharedData),                             kwargs={"verbose":False,"debug":False})
+    t5 = multiprocessing.Process(target=funcStim2,        args=(sharedConfig, sharedData, sharedControl),              kwargs={"verbose":False,"debug":False})
     # 6) console monitor for summary of processes
     t6 = multiprocessing.Process(target=funcMonitor,      args=(sharedConfig, sharedData))
-    # 7) get imu from delsys, dump to file only
+    # 7) get imu from delsys, to the shared ring only
     t7 = multiprocessing.Process(target=funcStreamImu,    args=(sharedConfig, sharedData, sharedQueue1, sharedQueue2), kwargs={"verbose":False,"debug":False})
+    # 8) recorder: writes all the data streams to disk
+    t8 = multiprocessing.Process(target=funcRecorder,     args=(sharedConfig, sharedData, sharedControl),             kwargs={"verbose":False,"debug":False})
 
     # Start the processes
     t1.start() # emg delsys
@@ -199,6 +265,7 @@ if __name__ == '__main__':
     t5.start() # stim
     t6.start() # monitor
     t7.start() # imu
+    t8.start() # recorder
 
     # Join the GUI. Blocking mechanism: will move on and terminate the other processes once it is closed only
     t4.join() # wait for GUI to close
@@ -206,22 +273,25 @@ if __name__ == '__main__':
     print("\nClosed GUI, processing graceful exit")
 
     # Graceful exit by setting flags so that each process has time to finish and wrap up current iteration
-    sharedConfig['emg_shutdown']  = True
-    sharedConfig['stim_shutdown'] = True
-    sharedConfig['imu_shutdown']  = True
+    sharedConfig['emg_shutdown']   = True
+    sharedControl['stim_shutdown'] = True
+    sharedConfig['imu_shutdown']   = True
 
     ###
     # Dump config file also
     ###
         
-    # pickles
+    # pickles (conf_sharedData only has the latest values of each ring: the whole session is in the recording, see record_export)
     finalConfig = {}
     finalData   = {}
     # deproxify
     for key in sharedConfig:
         finalConfig[key] = sharedConfig[key]
+    finalConfig.update(sharedControl.snapshot())
     for key in sharedData:
-        finalData[key] = sharedData[key]
+        finalData[key] = np.array(sharedData[key].latest(sharedData[key].capacity)) # copy out of the shared memory
+        if sharedData[key].channels == 1:
+            finalData[key] = finalData[key][0]
     filehandler = open(config['dataSaveFolder']+'/conf_sharedConfig.pickle', 'wb')
     pickle.dump(finalConfig, filehandler)
     filehandler.close()
@@ -233,12 +303,23 @@ if __name__ == '__main__':
 
     """
     # csv (plain text) : replaced by live dump to disk in dedicated functions
-    for fileName in ['controller_val_hist','pulse_val_hist','activ_delt_hist','activ_bic_hist']:
+    for fileName in ['controller_val_hist','pulse_val_hist','activ_hist']:
         print(f"saving {fileName} : len {len(sharedData[fileName])}")
         np.savetxt(config['dataSaveFolder']+'/conf_'+fileName+'.csv', sharedData[fileName], delimiter=",")
     """
 
     sleep(3) # give some time to the processes to finish before the main process exits (or it will kill spawned ones), esp. the stimulator to send the disconnection signal to the DLL
+    t8.join()  # and to the recorder to write the last batches and close the files
+
+    # export the whole recording (from the disk, block by block) for the analysis
+    if config['record_export']:
+        print(f"exporting the session to {config['record_export']}")
+        export_session(config['dataSaveFolder'], formats=config['record_export'])
+
+    # free the shared memory
+    for key in sharedData:
+        sharedData[key].close()
+    sharedControl.close()
 
     print("(main live) Goodbye")
 
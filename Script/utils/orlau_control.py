@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Control block in shared memory, for the few settings that are read or written at every iteration
+
+The Manager dict (sharedConfig) costs an IPC round-trip for every single read or write, which
+is fine for the settings that are set once (folders, rms window...) but not for the values that
+the stimulator loop polls continuously (stim_do, intensities...) or that the rms process updates
+at each batch (controller value, active muscles).
+
+Those hot fields live here instead, as one typed record (numpy structured array) in a
+multiprocessing.shared_memory block, protected by a sequence lock:
+    - writers (GUI, rms) take a lock, make the sequence number odd, write, and make it even again
+    - readers never lock: they copy the record and retry if the sequence number was odd or
+      changed during the copy, so they always get a consistent snapshot of all the fields
+"""
+
+import sys, os, copy, time
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))     # get current directory variable
+sys.path.append(CURR_DIR)                                  # load from the utils directory
+
+import numpy as np
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+class SharedControl(object):
+    """
+    Typed record of scalar settings in shared memory, with lock-free consistent reads.
+
+    Create it in the main process before starting the other processes and
+    pass it to them as an argument (re-attached by name when pickled).
+    Reads and writes look like a dict: control['stim_do'], control['stim_do'] = True.
+
+    Parameters
+    ----------
+    fields : OrderedDict
+        Name and numpy dtype of each field, e.g. {'stim_do':'?', 'pulse_period':'f8'},
+        or (dtype, shape) for a small fixed-size array, e.g. ('?', (2,)) for one flag per muscle.
+    values : dict, optional
+        Initial values (only the keys of 'fields' are used, the others are ignored).
+    name : str, optional
+        Name of an existing shared memory block to attach to (used when
+        unpickling). A new block is created if None.
+    lock : multiprocessing.Lock, optional
+        Lock serialising the writers (used when unpickling).
+    """
+
+    HEADER_SIZE = 64 # bytes reserved before the record: sequence number (int64)
+
+    def __init__(self, fields, values=None, name=None, lock=None):
+        self.fields = OrderedDict(fields)
+        self.dtype  = np.dtype([(key,) + (self.fields[key] if isinstance(self.fields[key], tuple) else (self.fields[key],)) for key in self.fields])
+        self._owner = name is None
+        self._lock  = lock if lock is not None else multiprocessing.Lock()
+
+        size = self.HEADER_SIZE + self.dtype.itemsize
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+
+        self._seq    = np.ndarray((1,), dtype=np.int64, buffer=self._shm.buf, offset=0)
+        self._record = np.ndarray((),   dtype=self.dtype, buffer=self._shm.buf, offset=self.HEADER_SIZE)
+        if self._owner:
+            self._seq[0]      = 0
+            self._record[...] = np.zeros((), dtype=self.dtype)
+            if values is not None:
+                self.update(**{key: values[key] for key in self.fields if key in values})
+
+    def __reduce__(self):
+        return (self.__class__, (self.fields, None, self.name, self._lock))
+
+    def keys(self):
+        return self.fields.keys()
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        while True:
+            seq = int(self._seq[0])
+            if seq & 1: # a writer is busy
+                continue
+            value = self._record[key].tolist()
+            if int(self._seq[0]) == seq:
+                return value
+
+    def __setitem__(self, key, value):
+        self.update(**{key: value})
+
+    def snapshot(self):
+        """
+        Consistent copy of all the fields.
+
+        Returns
+        -------
+        values : OrderedDict
+            Python values (bool, int, float, or list of them) of each field, as they were at the same instant.
+        """
+        while True:
+            seq = int(self._seq[0])
+            if seq & 1: # a writer is busy
+                continue
+            record = self._record.copy()
+            if int(self._seq[0]) == seq:
+                return OrderedDict((key, record[key].tolist()) for key in self.fields)
+
+    def update(self, **values):
+        """
+        Write one or several fields at once (readers see all of them or none).
+
+        The values are converted to the type and shape of their field before
+        anything is written, so that a bad value (KeyError, ValueError,
+        TypeError) leaves the record untouched and readable.
+        """
+        converted = {}
+        for key in values:
+            if key not in self.fields:
+                raise KeyError(key)
+            field          = self.dtype[key]
+            converted[key] = np.broadcast_to(np.asarray(values[key], dtype=field.base), field.shape) # a scalar is written to all the elements of an array field
+        with self._lock:
+            self._seq[0] += 1
+            try:
+                for key in converted:
+                    self._record[key] = converted[key]
+            finally:
+                self._seq[0] += 1 # even again whatever happens, or the readers would spin forever
+
+    def close(self):
+        """
+        Detach from the shared memory, and free it if we created it.
+        """
+        self._seq    = None
+        self._record = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass # views still referenced somewhere: the memory is released when they are garbage collected
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
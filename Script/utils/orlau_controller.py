@@ -44,3 +44,11 @@ def controller(delt_EMG, thres_delt_EMG, bic_EMG, thres_bic_EMG, tric_stim, stim
 
 
     return new_tric_stim
+
+def frame_lambda(stim_lambda, samples, reference=300):
+    """
+    Rate of change giving, when the controller is called every 'samples' samples, the same ramp
+    over time as 'stim_lambda' when it is called every 'reference' samples (the batch it was
+    tuned for): e.g. 0.061 per frame of 27 samples for 0.5 per batch of 300 samples.
+    """
+    return 1 - (1 - stim_lambda) ** (samples / float(reference))
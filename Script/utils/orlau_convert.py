@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Converter of the sessions recorded as text files to the session container (session.orl)
+
+The older versions of live.py saved each stream as a text file (np.savetxt), e.g. data_raw_delt.txt,
+data_rms_bic.txt, data_controller_value.txt or data_imu_all.txt, which are slow to load and about
+6 times larger than the binary streams. This tool converts those session folders to a session.orl
+(see orlau_session), the streams being named after the rings as when recorded by orlau_recorder:
+
+    python orlau_convert.py ../Data                     # every session folder found in Data
+    python orlau_convert.py ../Data/A_test1_... -j 2    # some folders, 2 worker processes
+
+    - the text files are parsed 'chunk' lines at a time, so the memory used does not depend on the
+      length of the session, and the files of one stream (one per muscle in the oldest sessions) are
+      read side by side and saved as the channels of a single stream
+    - each folder is converted by one worker process of a pool, the folders in parallel
+    - the number of samples of each stream is checked against the number of lines of its text files
+      once the container is written and read back
+    - the container is written as session.orl.part and only renamed to session.orl once checked: a
+      conversion interrupted (or failed) leaves no session.orl, and running the tool again only
+      converts the folders that have none (the text files are never modified)
+"""
+
+# Reset the vars at run if using ipython-based IDE if in main
+if __name__ == "__main__":
+    try:
+        from IPython import get_ipython
+        get_ipython().run_line_magic('reset', '-sf')
+    except: pass
+
+import sys, os, copy, time, json
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))     # get current directory variable
+sys.path.append(CURR_DIR)                                  # load from the utils directory
+
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+from datetime import datetime
+from collections import OrderedDict
+
+from orlau_session import SessionWriter, SessionFile, EXTENSION
+from orlau_utils import showTitle, printColor, show
+
+# text files of each stream (named after its ring): one column per muscle, or one file per muscle in the oldest sessions
+LEGACY_STREAMS = OrderedDict([
+    ('emg_raw',             ('data_raw.txt',                  'data_raw_{}.txt')),
+    ('emg_filt',            ('data_filter.txt',               'data_filter_{}.txt')),
+    ('emg_rms',             ('data_rms.txt',                  'data_rms_{}.txt')),
+    ('activ_hist',          ('data_activ_history.txt',        'data_activ_{}_history.txt')),
+    ('controller_val_hist', ('data_controller_value.txt',     None)),
+    ('pulse_val_hist',      ('data_controller_intensity.txt', None)),
+    ])
+EVENT_STREAMS  = ['activ_hist', 'controller_val_hist', 'pulse_val_hist'] # piecewise constant: saved as events (see orlau_session)
+LEGACY_MUSCLES = OrderedDict([('deltoid', 'delt'), ('biceps', 'bic')]) # muscle name: file suffix
+IMU_RATE       = 148.1 # Hz, rate of the imu of the Trigno sensors (not saved in the older configurations)
+CHUNK          = 60000 # lines parsed at a time
+
+def legacy_streams(folder, config):
+    """
+    Streams saved as text files in a session folder.
+
+    Returns
+    -------
+    streams : list of dict
+        'name', 'paths' (one per channel group), 'rate', 'names', 'meta' of each stream found.
+    """
+    rate    = config.get('rms_analogFreq', 2000)
+    muscles = list(config.get('emg_muscles_names') or LEGACY_MUSCLES.keys())
+    streams = []
+    for name, (multi, single) in LEGACY_STREAMS.items():
+        if os.path.exists(folder+'/'+multi):
+            paths = [folder+'/'+multi]
+            names = muscles if name in ('emg_raw', 'emg_filt', 'emg_rms', 'activ_hist') else None
+        elif single is not None:
+            found = [(muscle, folder+'/'+single.format(suffix)) for muscle, suffix in LEGACY_MUSCLES.items()]
+            found = [(muscle, path) for muscle, path in found if os.path.exists(path)]
+            if not found:
+                continue
+            names = [muscle for muscle, _ in found]
+            paths = [path   for _, path in found]
+        else:
+            continue
+        streams.append({'name': name, 'paths': paths, 'rate': rate, 'names': names, 'meta': None})
+
+    # imu: the subset of channels of imu_channels, or the 144 channels of the base station
+    imu_rate = config.get('imu_rate') or IMU_RATE
+    if os.path.exists(folder+'/data_imu.txt') and config.get('imu_channels'):
+        streams.append({'name': 'imu_all', 'paths': [folder+'/data_imu.txt'], 'rate': imu_rate, 'names': None,
+                        'meta': {'imu_channels': list(config['imu_channels'])}})
+    elif os.path.exists(folder+'/data_imu_all.txt'):
+        channels = _columns(folder+'/data_imu_all.txt')
+        streams.append({'name': 'imu_all', 'paths': [folder+'/data_imu_all.txt'], 'rate': imu_rate, 'names': None,
+                        'meta': {'imu_channels': list(range(channels))}})
+    return streams
+
+
+def _columns(path):
+    """
+    Number of columns of a text file, from its first line (0 if empty).
+    """
+    with open(path) as fp:
+        line = fp.readline()
+    return len(line.split(',')) if line.strip() else 0
+
+
+def read_chunks(paths, chunk=CHUNK):
+    """
+    Read text files side by side, 'chunk' lines at a time.
+
+    A last line without its end of line (session interrupted while it was
+    written) is ignored, and the files are read until the end of the
+    shortest one.
+
+    Parameters
+    ----------
+    paths : list of str
+        Files of the stream (one or several columns each).
+    chunk : int, optional
+        Number of lines parsed at a time.
+
+    Yields
+    ------
+    block : ndarray, shape=(channels, n)
+        Columns of all the files, one row per channel.
+    """
+    files = [open(path) for path in paths]
+    try:
+        while True:
+            blocks = []
+            for fp in files:
+                lines = list(itertools.islice(fp, chunk))
+                if lines and not lines[-1].endswith('\n'):
+                    lines = lines[:-1]
+                blocks.append(np.loadtxt(lines, delimiter=',', ndmin=2, dtype=np.float64) if lines else np.zeros((0, 1)))
+            n = min([len(block) for block in blocks])
+            if n == 0:
+                return
+            yield np.concatenate([block[:n] for block in blocks], axis=1).T
+            if n < chunk:
+                return
+    finally:
+        for fp in files:
+            fp.close()
+
+
+def count_lines(path):
+    """
+    Number of complete lines of a text file (read by blocks).
+    """
+    lines = 0
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            lines += block.count(b'\n')
+    return lines
+
+
+def session_start(folder, config):
+    """
+    Start time (time.time()) of a session: its session_date, or the time the folder was created.
+    """
+    date = config.get('session_date') or folder.rstrip('/\\').rsplit('_', 1)[-1]
+    try:
+        return time.mktime(datetime.strptime(date, "%Y%m%d-%Hh%Mm%Ss").timetuple())
+    except ValueError:
+        return os.path.getctime(folder)
+
+
+def needs_conversion(folder):
+    """
+    True if a folder has text streams and no session.orl yet.
+    """
+    if os.path.exists(os.path.join(folder, 'session'+EXTENSION)):
+        return False
+    names = set(os.listdir(folder))
+    if 'data_imu_all.txt' in names or 'data_imu.txt' in names:
+        return True
+    for multi, single in LEGACY_STREAMS.values():
+        if multi in names or (single is not None and any(single.format(suffix) in names for suffix in LEGACY_MUSCLES.values())):
+            return True
+    return False
+
+
+def find_sessions(paths):
+    """
+    Session folders to convert among paths (session folders or folders of sessions, e.g. Script/Data).
+    """
+    folders = []
+    for path in paths:
+        if not os.path.isdir(path):
+            printColor(f"convert: {path} is not a folder", 'red')
+            continue
+        if needs_conversion(path):
+            folders.append(path)
+            continue
+        for name in sorted(os.listdir(path)):
+            sub = os.path.join(path, name)
+            if os.path.isdir(sub) and needs_conversion(sub):
+                folders.append(sub)
+    return folders
+
+
+def convert_session(folder, chunk=CHUNK):
+    """
+    Convert the text streams of a session folder to session.orl.
+
+    Parameters
+    ----------
+    folder : str
+        Session folder.
+    chunk : int, optional
+        Number of lines parsed at a time.
+
+    Returns
+    -------
+    result : dict
+        'folder', 'samples' (per stream), 'warnings' (list of str), 'error' (str or None), 'time' (s).
+    """
+    tic    = time.perf_counter()
+    result = {'folder': folder, 'samples': OrderedDict(), 'warnings': [], 'error': None, 'time': 0}
+    part   = os.path.join(folder, 'session'+EXTENSION+'.part')
+    try:
+        config = {}
+        if os.path.exists(folder+'/conf_sharedConfig.json'):
+            with open(folder+'/conf_sharedConfig.json') as fp:
+                config = json.load(fp)
+        streams = legacy_streams(folder, config)
+        start   = session_start(folder, config)
+
+        with SessionWriter(part, meta={'config': config, 'converted_from': 'text'}, start_time=start) as writer:
+            for stream in streams:
+                channels = sum([_columns(path) for path in stream['paths']])
+                if channels == 0:
+                    result['warnings'].append(f"{stream['name']}: empty, not converted")
+                    continue
+                encoding = 'events' if stream['name'] in EVENT_STREAMS else 'samples'
+                writer.add_stream(stream['name'], channels, stream['rate'], names=stream['names'], meta=stream['meta'], encoding=encoding)
+                for block in read_chunks(stream['paths'], chunk):
+                    writer.write(stream['name'], block)
+
+        # check: every line of the text files is a sample of its stream
+        with SessionFile(part) as session:
+            for stream in streams:
+                if stream['name'] not in session:
+                    continue
+                samples = session[stream['name']].samples
+                lines   = [count_lines(path) for path in stream['paths']]
+                result['samples'][stream['name']] = samples
+                if samples != min(lines):
+                    raise ValueError(f"{stream['name']}: {samples} samples written for {min(lines)} lines")
+                if max(lines) != min(lines):
+                    result['warnings'].append(f"{stream['name']}: files of {lines} lines, cut to {samples} samples")
+                if samples and np.isnan(session[stream['name']][-1]).all():
+                    raise ValueError(f"{stream['name']}: last sample not readable")
+        os.replace(part, os.path.join(folder, 'session'+EXTENSION))
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+        if os.path.exists(part):
+            os.remove(part)
+    result['time'] = time.perf_counter() - tic
+    return result
+
+
+def _convert(args):
+    return convert_session(*args)
+
+
+def convert_sessions(folders, workers=None, chunk=CHUNK, verbose=True):
+    """
+    Convert session folders in parallel, one folder per worker process.
+
+    Returns
+    -------
+    results : list of dict
+        Result of each folder (see convert_session), in the order they finished.
+    """
+    results = []
+    workers = max(1, min(workers or os.cpu_count() or 1, len(folders)))
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(_convert, [(folder, chunk) for folder in folders]):
+            results.append(result)
+            if not verbose:
+                continue
+            name = os.path.basename(result['folder'].rstrip('/\\'))
+            if result['error']:
+                printColor(f"[{len(results)}/{len(folders)}] {name}: failed, {result['error']}", 'red')
+            else:
+                samples = ', '.join([f"{key} {n}" for key, n in result['samples'].items()])
+                printColor(f"[{len(results)}/{len(folders)}] {name}: {samples} ({result['time']:.1f} s)", 'green')
+            for warning in result['warnings']:
+                printColor(f"    {warning}", 'yellow')
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Convert sessions recorded as text files to session.orl")
+    parser.add_argument('paths',         nargs='*', default=[os.path.join(CURR_DIR, '..', 'Data')], help="session folders, or folders of sessions (default: Script/Data)")
+    parser.add_argument('-j', '--jobs',  default=None,  type=int, help="number of worker processes (default: number of cpus)")
+    parser.add_argument('--chunk',       default=CHUNK, type=int, help="lines parsed at a time")
+    parser.add_argument('--test',        action='store_true', help="convert a generated session and check it")
+    args = parser.parse_args()
+
+    if args.test:
+
+        ###
+        # Generate an old session (one file per muscle, a crash in the middle of a line) and convert it
+        ###
+
+        import tempfile
+
+        folder = tempfile.mkdtemp() + '/participantA_test1_20230101-10h00m00s'
+        os.makedirs(folder)
+        rng    = np.random.default_rng(0)
+        raw    = rng.normal(0, 0.0003, (2, 300*400))
+        imu    = rng.normal(0, 1, (144, 22*400))
+        for i, suffix in enumerate(['delt', 'bic']):
+            np.savetxt(folder+f'/data_raw_{suffix}.txt', raw[i], delimiter=',')
+            np.savetxt(folder+f'/data_activ_{suffix}_history.txt', raw[i] > 0, delimiter=',')
+        np.savetxt(folder+'/data_controller_value.txt', np.repeat(np.arange(400) % 7, 300), delimiter=',')
+        np.savetxt(folder+'/data_imu_all.txt', imu.T, delimiter=',')
+        with open(folder+'/data_raw_bic.txt', 'a') as fp:
+            fp.write('1.2e-0')
+
+        assert find_sessions([os.path.dirname(folder)]) == [folder]
+        results = convert_sessions([folder], chunk=args.chunk)
+        assert results[0]['error'] is None, results[0]['error']
+        with SessionFile(folder) as session:
+            assert np.array_equal(session['emg_raw'][:], raw.astype('<f4'))
+            assert session['emg_raw'].names == ['deltoid', 'biceps']
+            assert np.array_equal(session['imu_all'][:], imu.astype('<f4'))
+            assert session['controller_val_hist'].samples == raw.shape[1]
+            assert session.meta['start_time'] == time.mktime(datetime(2023, 1, 1, 10).timetuple())
+        assert find_sessions([folder]) == [] # resumed: nothing left to do
+        print("conversion ok")
+        sys.exit(0)
+
+    showTitle("Convert text sessions to session"+EXTENSION, 'cyan')
+    folders = find_sessions(args.paths)
+    print(f"{len(folders)} session(s) to convert")
+    if folders:
+        results = convert_sessions(folders, workers=args.jobs, chunk=args.chunk)
+        failed  = [result for result in results if result['error']]
+        print(f"converted {len(results) - len(failed)}, failed {len(failed)}")
+        sys.exit(1 if failed else 0)
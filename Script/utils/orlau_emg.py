@@ -58,11 +58,9 @@ def funcStreamEmg(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=
             #this_emg_bic  = np.concatenate( (np.zeros(75), wave) )
             #this_emg_bic= np.concatenate( (this_emg_bic, np.zeros(75)) )
             
-            return wave, wave
+            return wave
         
-        # open files on disk
-        fileRaw_delt = open(sharedConfig['dataSaveFolder']+'/data_raw_delt.txt', 'ab')
-        fileRaw_bic  = open(sharedConfig['dataSaveFolder']+'/data_raw_bic.txt',  'ab')
+        nMuscles = len(sharedConfig['emg_muscles_names'])
 
         fakeIndex     = 20 # first batch detected at index 20
         fakeFrequency = 80 # every 80 values
@@ -74,70 +72,62 @@ def funcStreamEmg(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=
         # Loop with a delay
         ###
         
-        iEmg = 0
+        iEmg    = 0
+        pending = np.zeros((nMuscles, 0)) # generated and not sent yet (batches of 300 sent by frames of samples_per_read)
         while not sharedConfig['emg_shutdown']:
 
-            # can induce artificial delay
-            sleep(0.5)
+            # can induce artificial delay (0.5s per batch of 300)
+            sleep(0.5 * samples_per_read / 300)
 
             ###
             # get the data
             ###
 
-            # we dummy always have a fresh sin wave in this_emg_delt and this_emg_bic
-            this_emg_delt, this_emg_bic = genWave()
-            this_emg_bic = np.array([0.0006]*300)
+            if pending.shape[1] < samples_per_read:
 
-            if iEmg==0: # as we receive the first batch, get the time to provide feedback on how long we have been streaming
-                sharedConfig['streamTimeStart'] = time.time()
-                if verbose: print(f"First batch, setting EMG start time at {time.time()}")
+                # we dummy always have a fresh sin wave on the first muscle, and a flat line on the others
+                this_emg       = np.full((nMuscles, 300), 0.0006)
+                this_emg[0]    = genWave()
 
-            # can fake a stimulation artifact at a specific value (on 2 values to have a nicer line +-)
-            stimValueDummy = 0.0011
+                if iEmg==0: # as we receive the first batch, get the time to provide feedback on how long we have been streaming
+                    sharedConfig['streamTimeStart'] = time.time()
+                    if verbose: print(f"First batch, setting EMG start time at {time.time()}")
 
-            # just one or two random spikes per batch to visualize them
-            """
-            #this_emg_delt[150]  = +stimValueDummy
-            #this_emg_delt[151]  = -stimValueDummy
-            """
+                # can fake a stimulation artifact at a specific value (on 2 values to have a nicer line +-)
+                stimValueDummy = 0.0011
 
-            # if it's every 80 values (so varies from batch to batch)
-            # init first batch at 20
-            listIndexes = []
-            for i in range(5):
-                listIndexes.append(fakeIndex + fakeFrequency*i)
-            listIndexes2 = [x for x in listIndexes if x < 300]
-            printColor(f"\n# emg iter {iEmg}: peaks on indexes {listIndexes2}")
+                # just one or two random spikes per batch to visualize them
+                """
+                #this_emg_delt[150]  = +stimValueDummy
+                #this_emg_delt[151]  = -stimValueDummy
+                """
 
-            for this_index in listIndexes2:
-                this_emg_delt[this_index] = stimValueDummy
-            #print(f"so next index should be at {(listIndexes[-1]+80)-300}")
-            fakeIndex = (listIndexes2[-1]+fakeFrequency)-300
+                # if it's every 80 values (so varies from batch to batch)
+                # init first batch at 20
+                listIndexes = []
+                for i in range(5):
+                    listIndexes.append(fakeIndex + fakeFrequency*i)
+                listIndexes2 = [x for x in listIndexes if x < 300]
+                printColor(f"\n# emg iter {iEmg}: peaks on indexes {listIndexes2}")
 
-            # add a peak at 0 to delimitate frames
-            #this_emg_delt[0] = 1
-            #print(f"this batch of len {len(this_emg_delt)} has {len(listIndexes2)} peaks")
+                for this_index in listIndexes2:
+                    this_emg[0, this_index] = stimValueDummy
+                #print(f"so next index should be at {(listIndexes[-1]+80)-300}")
+                fakeIndex = (listIndexes2[-1]+fakeFrequency)-300
+
+                # add a peak at 0 to delimitate frames
+                #this_emg_delt[0] = 1
+                #print(f"this batch of len {len(this_emg_delt)} has {len(listIndexes2)} peaks")
+
+                pending = np.hstack((pending, this_emg))
+            this_emg, pending = pending[:, :samples_per_read], pending[:, samples_per_read:]
 
-            ###
-            # dump in csv
-            ###
-            
-            np.savetxt(fileRaw_delt, this_emg_delt, delimiter=',')
-            np.savetxt(fileRaw_bic,  this_emg_bic,  delimiter=',')
-          
             ###
             # Put in shared dict
             ###
             
-            # add new batch to current array
-            sharedData['emg_delt_raw'] = np.concatenate( (sharedData['emg_delt_raw'],  this_emg_delt),  axis=0 )
-            sharedData['emg_bic_raw']  = np.concatenate( (sharedData['emg_bic_raw'],   this_emg_bic),   axis=0 )
-            
-            # remove the first part to keep size consistent (if reached max limit)
-            if len(sharedData['emg_delt_raw']) > sharedConfig['maxArraySize']:
-                # we remove length of frame from beginning of array
-                sharedData['emg_delt_raw'] = sharedData['emg_delt_raw'][samples_per_read:]
-                sharedData['emg_bic_raw']  = sharedData['emg_bic_raw'][samples_per_read:]
+            # add new batch to the ring in shared memory (it only keeps the latest values, the recorder process writes it to disk)
+            sharedData['emg_raw'].append(this_emg)
 
             ###
             # only then (after get;dump;resize), increment interNumber to let the other processes know they can process the next batch
@@ -149,8 +139,6 @@ def funcStreamEmg(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=
             if verbose: print(f"iter {iEmg}, q1 = {sharedQueue1.qsize()}, q2 = {sharedQueue2.qsize()}")
             
  
-        fileRaw_delt.close()
-        fileRaw_bic.close()
         print("emg dummy: goodbye")
         return
 
@@ -186,6 +174,11 @@ def funcStreamEmg(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=
 
     if verbose: printColor('Connected to EMG', color='green')
     devEMG.become_master()
+
+    # only decode the channels of the sensors placed on our muscles (rows of data_frame follow emg_muscles_names)
+    devEMG.set_channels(devEMG.sensor_channels(sharedConfig['emg_sensors']))
+    if verbose: print(f"EMG channel map: {devEMG.channels}")
+
     devEMG.start()
 
     # Notify the other processes that we have succeded
@@ -196,10 +189,6 @@ def funcStreamEmg(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=
     # Get the data in a loop
     ###
     
-    # open files on disk
-    fileRaw_delt = open(sharedConfig['dataSaveFolder']+'/data_raw_delt.txt', 'ab')
-    fileRaw_bic  = open(sharedConfig['dataSaveFolder']+'/data_raw_bic.txt',  'ab')    
-
     iEmg = 0
     while not sharedConfig['emg_shutdown']:
    
@@ -210,39 +199,24 @@ def funcStreamEmg(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=
         ###
         
         # blocking mechanism, so we read() until our local buffer has gotten enough frames from delsys to constitute a full batch
-        data_frame    = devEMG.read()
-        this_emg_delt = data_frame[0]
-        this_emg_bic  = data_frame[1]
+        # (one row per muscle of emg_muscles_names)
+        this_emg      = devEMG.read()
 
         if iEmg==0: # as we receive the first batch, get the time to provide feedback on how long we have been streaming
             sharedConfig['streamTimeStart'] = time.time()
 
-        ###
-        # dump in csv
-        ###
-        
-        np.savetxt(fileRaw_delt, this_emg_delt, delimiter=',')
-        np.savetxt(fileRaw_bic,  this_emg_bic,  delimiter=',')
-        
         ###
         # Put in shared dict
         ###
         
-        # add new batch to current array
-        sharedData['emg_delt_raw'] = np.concatenate( (sharedData['emg_delt_raw'],  this_emg_delt),  axis=0 )
-        sharedData['emg_bic_raw']  = np.concatenate( (sharedData['emg_bic_raw'],   this_emg_bic),   axis=0 )
-        
-        # remove the first part to keep size consistent (if reached max limit)
-        if len(sharedData['emg_delt_raw']) > sharedConfig['maxArraySize']:
-            # we remove length of frame from beginning of array
-            sharedData['emg_delt_raw'] = sharedData['emg_delt_raw'][samples_per_read:]
-            sharedData['emg_bic_raw']  = sharedData['emg_bic_raw'][samples_per_read:]
+        # add new batch to the ring in shared memory (it only keeps the latest values, the recorder process writes it to disk)
+        sharedData['emg_raw'].append(this_emg)
 
         ###
         # Put in queue: discarded
         ###
-        #sharedQueue1.put(this_emg_delt)
-        #sharedQueue2.put(this_emg_bic)
+        #sharedQueue1.put(this_emg[0])
+        #sharedQueue2.put(this_emg[1])
         #if verbose: print(f"iter {iEmg}, q1 = {sharedQueue1.qsize()}, q2 = {sharedQueue2.qsize()}")
 
         ###
@@ -254,8 +228,6 @@ def funcStreamEmg(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=
             
     print("emg thread: Stopping EMG gracefully")
     
-    fileRaw_delt.close()
-    fileRaw_bic.close()
     devEMG.stop()
     devEMG.__del__()
 
@@ -9,7 +9,6 @@ os.chdir(os.path.abspath(os.path.dirname(__file__)))       # change current work
 sys.path += [CURR_DIR]                                     # add relative folders to path, to load our modules easily without installing them
 
 import socket
-import struct
 import numpy
 import numpy as np
 import time
@@ -40,6 +39,9 @@ class _BaseTrignoDaq(object):
     ----------
     BYTES_PER_CHANNEL : int
         Number of bytes per sample per channel. EMG and accelerometer data
+    AUX_CHANNELS_PER_SENSOR : int
+        Number of channels reserved for each sensor in the auxiliary (IMU)
+        data stream (144 channels for 16 sensors).
     CMD_TERM : str
         Command string termination.
 
@@ -50,6 +52,7 @@ class _BaseTrignoDaq(object):
     """
 
     BYTES_PER_CHANNEL = 4
+    AUX_CHANNELS_PER_SENSOR = 9
     CMD_TERM = '\r\n\r\n'
     RESPONSE = ''
 
@@ -61,6 +64,9 @@ class _BaseTrignoDaq(object):
         self.timeout        = timeout        # default 10 seconds
 
         self._min_recv_size = self.total_channels * self.BYTES_PER_CHANNEL # make data accessible once chunk of data has been received (blocking method)
+        self._recv_buffer   = None                                         # preallocated receive buffer, (re)sized on the first read()
+        self._channel_index = None                                         # channel map used by the subclasses to decode only the channels we use (see set_channels)
+        self.channels       = None
 
         self._initialize()   # start socket connection to TCU
 
@@ -118,17 +124,91 @@ class _BaseTrignoDaq(object):
 
     def check_sensor_n_start_index(self, n):
         """
-        Check the type of connected sensor
+        Check the index of the first EMG channel of sensor n in the data stream
+        (starts at 1). Returns None if the TCU did not answer with a number.
         """
         cmd = 'SENSOR ' + str(n) + ' STARTINDEX?'
-        self._send_cmd(cmd)
+        return self._query_int(cmd)
 
     def check_sensor_n_auxchannel_count(self, n):
         """
-        Check the type of connected sensor
+        Check the number of auxiliary (IMU) channels streamed by sensor n.
+        Returns None if the TCU did not answer with a number.
         """
         cmd = 'SENSOR ' + str(n) + ' AUXCHANNELCOUNT?'
-        self._send_cmd(cmd)
+        return self._query_int(cmd)
+
+    def sensor_channels(self, sensors, aux=False, aux_channels=None):
+        """
+        Build the channel map (0-based indices in the data stream) of a list of sensors.
+
+        For the EMG stream, each sensor has a single channel given by STARTINDEX?
+        For the auxiliary (IMU) stream, each sensor owns a block of
+        AUX_CHANNELS_PER_SENSOR channels, of which the first AUXCHANNELCOUNT? are used.
+        If the TCU does not answer a query, we fall back on the default layout
+        (sensor n is EMG channel n-1, and uses its whole aux block).
+
+        Parameters
+        ----------
+        sensors : list of int
+            Sensor numbers as shown in the TCU (starts at 1).
+        aux : bool
+            True for the auxiliary (IMU) data stream, False for the EMG stream.
+        aux_channels : list of int, optional
+            Channels kept in the aux block of each sensor (e.g. [0, 1, 2] for
+            the accelerometer x/y/z only), all the used ones if None.
+
+        Returns
+        -------
+        channels : list of int
+            Channel indices, in the order of the sensors given.
+        """
+        channels = []
+        for n in sensors:
+            if aux:
+                count = self.check_sensor_n_auxchannel_count(n)
+                if not count:
+                    count = self.AUX_CHANNELS_PER_SENSOR
+                first = (n-1) * self.AUX_CHANNELS_PER_SENSOR
+                used  = range(min(count, self.AUX_CHANNELS_PER_SENSOR))
+                channels += [first + k for k in used if aux_channels is None or k in aux_channels]
+            else:
+                start = self.check_sensor_n_start_index(n)
+                if not start:
+                    start = n
+                channels.append(start-1)
+        return channels
+
+    def set_channels(self, channels):
+        """
+        Sets the channel map: only these channels are decoded by read().
+
+        A contiguous run of channels is selected with a slice (strided view of
+        the receive buffer, no copy), otherwise only the requested columns are
+        gathered.
+
+        Parameters
+        ----------
+        channels : list of int, or None
+            Channel indices (0-based) in the data stream. None goes back to
+            using channel_range.
+        """
+        if channels is None:
+            self._channel_index = None
+        elif len(channels) > 0 and list(channels) == list(range(channels[0], channels[0] + len(channels))):
+            self._channel_index = slice(channels[0], channels[0] + len(channels))
+        else:
+            self._channel_index = np.asarray(channels, dtype=int)
+        self.channels = None if channels is None else list(channels)
+        self.num_channels = len(channels) if channels is not None else self.channel_range[1] - self.channel_range[0] + 1
+
+    def _select_channels(self, data):
+        """
+        Keep only the channels of the channel map (or of channel_range) from a full frame.
+        """
+        if self._channel_index is None:
+            return data[self.channel_range[0]:self.channel_range[1]+1, :]
+        return data[self._channel_index, :]
 
     def check_sensor_channel_unit(self, n, m):
         """
@@ -144,6 +224,12 @@ class _BaseTrignoDaq(object):
         This is a blocking method, meaning it returns only once the requested
         number of samples are available.
 
+        The socket is read straight into a preallocated buffer (``recv_into``)
+        and decoded as a float32 view of that buffer, so no bytes object or
+        tuple is built per batch. The returned array is a view on this buffer:
+        it is only valid until the next call to ``read()``, copy it if it has
+        to be kept.
+
         Parameters
         ----------
         num_samples : int
@@ -156,22 +242,26 @@ class _BaseTrignoDaq(object):
             is a point in time.
         """
         l_des = num_samples * self._min_recv_size
+
+        # (re)allocate the receive buffer only if the batch size has changed
+        if self._recv_buffer is None or len(self._recv_buffer) != l_des:
+            self._recv_buffer = bytearray(l_des)
+            self._recv_view   = memoryview(self._recv_buffer)
+            self._recv_data   = numpy.frombuffer(self._recv_buffer, dtype='<f4').reshape((num_samples, self.total_channels))
+
         l = 0
-        packet = bytes()
         while l < l_des:
             try:
-                packet += self._data_socket.recv(l_des - l)
+                n = self._data_socket.recv_into(self._recv_view[l:], l_des - l)
             except socket.timeout:
-                l = len(packet)
-                packet += b'\x00' * (l_des - l)
+                self._recv_view[l:] = bytes(l_des - l)
                 raise IOError("Device disconnected.")
-            l = len(packet)
+            if n == 0:
+                raise IOError("Device disconnected.")
+            l += n
 
-        data = numpy.asarray(
-            struct.unpack('<'+'f'*self.total_channels*num_samples, packet))
-        data = numpy.transpose(data.reshape((-1, self.total_channels)))
-
-        return data
+        # channels as rows, samples as columns (transposed view, no copy)
+        return self._recv_data.T
 
     def stop(self):
         """Tell the device to stop streaming data."""
@@ -191,11 +281,21 @@ class _BaseTrignoDaq(object):
         except:
             pass
 
-    def _send_cmd(self, command):
+    def _send_cmd(self, command, validate=True):
         self._comm_socket.send(self._cmd(command))
         resp = self._comm_socket.recv(128)
         print("Response from trigno:: ", str(resp, 'utf-8'))
-        self._validate(resp)
+        if validate:
+            self._validate(resp)
+        return str(resp, 'utf-8').strip()
+
+    def _query_int(self, command):
+        resp = self._send_cmd(command, validate=False)
+        try:
+            return int(resp)
+        except ValueError:
+            print("warning: TrignoDaq query {} did not return a number: {}".format(command, resp))
+            return None
 
     @staticmethod
     def _cmd(command):
@@ -238,6 +338,9 @@ class TrignoEMG(_BaseTrignoDaq):
         configurable through the TCU graphical user interface.
     timeout : float, optional
         Number of seconds before socket returns a timeout exception.
+    channels : list of int, optional
+        Channel map (0-based channel indices) to decode instead of
+        channel_range, e.g. from ``sensor_channels()``.
 
     Attributes
     ----------
@@ -249,13 +352,14 @@ class TrignoEMG(_BaseTrignoDaq):
     """
 
     def __init__(self, channel_range, samples_per_read, units='V',
-                 host='localhost', cmd_port=50040, data_port=50043, timeout=10):
+                 host='localhost', cmd_port=50040, data_port=50043, timeout=10, channels=None):
         super(TrignoEMG, self).__init__(
             host=host, cmd_port=cmd_port, data_port=data_port,
             total_channels=16, timeout=timeout)
 
         self.channel_range = channel_range
         self.samples_per_read = samples_per_read
+        self.set_channels(channels)
 
         self.rate = 2000
 
@@ -277,6 +381,7 @@ class TrignoEMG(_BaseTrignoDaq):
         """
         self.channel_range = channel_range
         self.num_channels = channel_range[1] - channel_range[0] + 1
+        self.set_channels(None)
 
     def read(self):
         """
@@ -292,7 +397,7 @@ class TrignoEMG(_BaseTrignoDaq):
             is a point in time.
         """
         data = super(TrignoEMG, self).read(self.samples_per_read)
-        data = data[self.channel_range[0]:self.channel_range[1]+1, :]
+        data = self._select_channels(data)
         return self.scaler * data
 
 
@@ -320,15 +425,19 @@ class TrignoAccel(_BaseTrignoDaq):
         it is configurable through the TCU graphical user interface.
     timeout : float, optional
         Number of seconds before socket returns a timeout exception.
+    channels : list of int, optional
+        Channel map (0-based channel indices) to decode instead of
+        channel_range, e.g. from ``sensor_channels(sensors, aux=True)``.
     """
     def __init__(self, channel_range, samples_per_read, host='localhost',
-                 cmd_port=50040, data_port=50044, timeout=10):
+                 cmd_port=50040, data_port=50044, timeout=10, channels=None):
         super(TrignoAccel, self).__init__(
             host=host, cmd_port=cmd_port, data_port=data_port,
             total_channels=144, timeout=timeout)
 
         self.channel_range = channel_range
         self.samples_per_read = samples_per_read
+        self.set_channels(channels)
 
         self.rate = 148.1
 
@@ -343,6 +452,7 @@ class TrignoAccel(_BaseTrignoDaq):
         """
         self.channel_range = channel_range
         self.num_channels = channel_range[1] - channel_range[0] + 1
+        self.set_channels(None)
 
     def read(self):
         """
@@ -358,7 +468,7 @@ class TrignoAccel(_BaseTrignoDaq):
             is a point in time.
         """
         data = super(TrignoAccel, self).read(self.samples_per_read)
-        data = data[self.channel_range[0]:self.channel_range[1]+1, :]
+        data = self._select_channels(data)
         return data
 
 """
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Export of a whole recorded session to MATLAB (.mat) and numpy (.npz) files
+
+The streams are read from the recording on disk (session.orl, or the data_*.bin files, see
+orlau_session) and written block by block, so that the memory used does not depend on the length
+of the session; the export can also be run on a session that is still being recorded (it then
+contains everything written so far):
+
+    python orlau_export.py ../Data/A_test1_...              # session.mat
+    python orlau_export.py ../Data/A_test1_... --npz        # session.npz
+    python orlau_export.py ../Data/A_test1_... --mat --npz  # both
+
+Each file contains:
+    - config         : configuration of the session (a struct, or JSON text in the .npz)
+    - start_time     : time (time.time()) of the start of the session
+    - streams        : rate, channel names, samples and start (s) of each stream (a struct, or JSON text)
+    - <stream>       : all the samples of each stream (channels x samples, float32), NaN where data was
+                       lost; the streams saved as events (activity, controller...) are expanded to samples
+    - <stream>_batches : batch index of each stream (batch number, sample after the batch, time of the
+                       batch in s since start_time), to align the streams and the imu by batch
+    - <stream>_events  : changes of value of the streams saved as events (sample, batch, time, values)
+
+The .mat file is a MATLAB v7.3 file (HDF5) if h5py is installed, otherwise a v5 file (readable by
+MATLAB and scipy.io.loadmat) written by hand for the large streams, limited to 4 GB per stream.
+The .npz file is compressed (zip deflate) and read with np.load.
+"""
+
+# Reset the vars at run if using ipython-based IDE if in main
+if __name__ == "__main__":
+    try:
+        from IPython import get_ipython
+        get_ipython().run_line_magic('reset', '-sf')
+    except: pass
+
+import sys, os, copy, time, json
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))     # get current directory variable
+sys.path.append(CURR_DIR)                                  # load from the utils directory
+
+import io
+import struct
+import zipfile
+import argparse
+import numpy as np
+import scipy.io as sio
+from datetime import datetime
+from collections import OrderedDict
+
+from orlau_session import SessionFile, BATCH_DTYPE
+from orlau_utils import showTitle, printColor, show
+
+BLOCK = 60000 # samples of a stream read and written at a time
+
+# MATLAB v5 data types and classes (see the MAT-file format specification)
+miINT8, miINT32, miUINT32, miSINGLE, miMATRIX = 1, 5, 6, 7, 14
+mxSINGLE_CLASS                                = 7
+
+def _matlab(value):
+    """
+    Configuration value converted for scipy.io.savemat (None and lists of mixed types are not supported).
+    """
+    if value is None:
+        return np.zeros((0, 0))
+    if isinstance(value, dict):
+        return {key: _matlab(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all([isinstance(item, (bool, int, float)) for item in value]):
+            return np.array(value, dtype=float)
+        cell    = np.empty(len(value), dtype=object)
+        cell[:] = [_matlab(item) for item in value]
+        return cell
+    return value
+
+
+def _tables(session):
+    """
+    Batch index (batch, stop, time since the start) and events of each stream, as plain 2D float arrays.
+    """
+    start  = session.meta['start_time']
+    tables = OrderedDict()
+    for name in session:
+        stream  = session[name]
+        batches = stream.batches
+        clock   = stream.header.get('clock')
+        if len(batches) == 0 and clock in session:
+            batches = session[clock].batches # events: same batches as their clock
+        tables[name+'_batches'] = np.column_stack([batches['batch'], batches['stop'], batches['time'] - start]).astype(float)
+        if stream.encoding == 'events':
+            events = stream.events
+            tables[name+'_events'] = np.column_stack([events['offset'], events['batch'], events['time'] - start, events['value']]).astype(float)
+    return tables
+
+
+def _info(session):
+    """
+    Rate, channel names, samples and start of each stream.
+    """
+    return OrderedDict((name, {'rate': session[name].rate, 'names': session[name].names or [], 'samples': session[name].samples,
+                               'start': session[name].header['start_time'] - session.meta['start_time'], 'encoding': session[name].encoding})
+                       for name in session)
+
+
+def _write_v5_matrix(fp, name, stream, block):
+    """
+    Stream a (channels x samples) float32 matrix into a MATLAB v5 file: the element header is written first
+    (its size is known), then the samples block by block, already in the column-major order of MATLAB.
+    """
+    size = stream.channels * stream.samples * 4
+    if size >= 2**32:
+        raise ValueError(f"{name}: {size/1e9:.1f} GB does not fit in a v5 .mat file, install h5py (v7.3) or export to .npz")
+    name    = name.encode('latin1')
+    element = b''.join([
+        struct.pack('<II', miUINT32, 8), struct.pack('<II', mxSINGLE_CLASS, 0),            # array flags
+        struct.pack('<II', miINT32, 8),  struct.pack('<ii', stream.channels, stream.samples), # dimensions
+        struct.pack('<II', miINT8, len(name)), name, b'\x00' * (-len(name) % 8),          # name
+        struct.pack('<II', miSINGLE, size),                                               # real part, then the samples
+        ])
+    fp.write(struct.pack('<II', miMATRIX, len(element) + size + (-size % 8)) + element)
+    for _, data in stream.blocks(block):
+        fp.write(np.ascontiguousarray(data.T, dtype='<f4').tobytes())
+    fp.write(b'\x00' * (-size % 8))
+
+
+def _export_v5(session, path, block):
+    small = {'config': _matlab(session.meta.get('config', {})), 'start_time': session.meta['start_time'], 'streams': _matlab(_info(session))}
+    small.update(_tables(session))
+    buffer = io.BytesIO()
+    sio.savemat(buffer, small, long_field_names=True, do_compression=True)
+    with open(path, 'wb') as fp:
+        fp.write(buffer.getvalue()) # header and the small variables
+        for name in session:
+            _write_v5_matrix(fp, name, session[name], block)
+
+
+def _export_v73(session, path, block):
+    import h5py
+
+    def char(group, key, text):
+        data = group.create_dataset(key, data=np.frombuffer(text.encode('utf-16-le'), dtype='<u2').reshape(-1, 1))
+        data.attrs['MATLAB_class']      = np.bytes_('char')
+        data.attrs['MATLAB_int_decode'] = np.int32(2)
+
+    def double(group, key, value):
+        data = group.create_dataset(key, data=np.atleast_2d(np.asarray(value, dtype=float)).T) # MATLAB reads the dimensions reversed
+        data.attrs['MATLAB_class'] = np.bytes_('double')
+
+    def struct_(group, key, values):
+        sub = group.create_group(key)
+        sub.attrs['MATLAB_class'] = np.bytes_('struct')
+        for k, value in values.items():
+            if isinstance(value, dict):
+                struct_(sub, k, value)
+            elif isinstance(value, str):
+                char(sub, k, value)
+            elif isinstance(value, (bool, int, float)) or (isinstance(value, list) and value and all([isinstance(v, (bool, int, float)) for v in value])):
+                double(sub, k, value)
+            else:
+                char(sub, k, json.dumps(value)) # None, lists of names...: as JSON text
+
+    with h5py.File(path, 'w', userblock_size=512) as fp:
+        struct_(fp, 'config', session.meta.get('config', {}))
+        struct_(fp, 'streams', _info(session))
+        double(fp, 'start_time', session.meta['start_time'])
+        for key, table in _tables(session).items():
+            double(fp, key, table)
+        for name in session:
+            stream = session[name]
+            chunks = (min(block, stream.samples), stream.channels) if stream.samples else None
+            data   = fp.create_dataset(name, shape=(stream.samples, stream.channels), dtype='<f4', chunks=chunks)
+            data.attrs['MATLAB_class'] = np.bytes_('single')
+            for start, values in stream.blocks(block):
+                data[start:start+values.shape[1]] = values.T
+
+    # MATLAB header in the user block
+    text = f"MATLAB 7.3 MAT-file, Platform: {sys.platform}, Created on: {datetime.now().strftime('%a %b %d %H:%M:%S %Y')} HDF5 schema 1.00 ."
+    with open(path, 'r+b') as fp:
+        fp.write(text.encode('ascii').ljust(116) + b'\x00' * 8 + struct.pack('<H', 0x0200) + b'IM')
+
+
+def _export_npz(session, path, block, compress):
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with zipfile.ZipFile(path, 'w', compression=compression, allowZip64=True) as zf:
+        small = {'config': np.array(json.dumps(session.meta.get('config', {}))), 'start_time': np.array(session.meta['start_time']),
+                 'streams': np.array(json.dumps(_info(session)))}
+        small.update(_tables(session))
+        for key, value in small.items():
+            with zf.open(key+'.npy', 'w', force_zip64=True) as fp:
+                np.lib.format.write_array(fp, value, allow_pickle=False)
+        for name in session:
+            stream = session[name]
+            with zf.open(name+'.npy', 'w', force_zip64=True) as fp:
+                # (channels x samples) in Fortran order: the samples x channels layout of the recording, written block by block
+                np.lib.format.write_array_header_1_0(fp, {'descr': '<f4', 'fortran_order': True, 'shape': (stream.channels, stream.samples)})
+                for _, data in stream.blocks(block):
+                    fp.write(np.ascontiguousarray(data.T, dtype='<f4').tobytes())
+
+
+def export_session(folder, formats=('mat',), block=BLOCK, version=None, compress=True):
+    """
+    Export a recorded session to .mat and/or .npz files, next to the recording.
+
+    Parameters
+    ----------
+    folder : str
+        Session folder, or session.orl.
+    formats : list of str, optional
+        'mat' and/or 'npz'.
+    block : int, optional
+        Samples read and written at a time.
+    version : str, optional
+        '7.3' (needs h5py) or '5' for the .mat file, 7.3 if h5py is installed if None.
+    compress : bool, optional
+        Compress the .npz file.
+
+    Returns
+    -------
+    paths : list of str
+        Files written (session.mat, session.npz).
+    """
+    if version is None:
+        try:
+            import h5py
+            version = '7.3'
+        except ImportError:
+            version = '5'
+    base  = os.path.join(folder if os.path.isdir(folder) else os.path.dirname(folder), 'session')
+    paths = []
+    with SessionFile(folder) as session: # a container being written is scanned: everything written so far
+        for fmt in formats:
+            path = base+'.'+fmt
+            part = path+'.part' # so that a failed export never leaves a partial file
+            if fmt == 'mat':
+                (_export_v73 if version == '7.3' else _export_v5)(session, part, block)
+            elif fmt == 'npz':
+                _export_npz(session, part, block, compress)
+            else:
+                raise ValueError(f"unknown export format {fmt}")
+            os.replace(part, path)
+            paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Export a recorded session to .mat/.npz")
+    parser.add_argument('folders', nargs='*', help="session folders")
+    parser.add_argument('--mat',   action='store_true', help="export to session.mat (default)")
+    parser.add_argument('--npz',   action='store_true', help="export to session.npz")
+    parser.add_argument('--v5',    action='store_true', help="write a MATLAB v5 file even if h5py is installed")
+    parser.add_argument('--block', default=BLOCK, type=int, help="samples read and written at a time")
+    parser.add_argument('--test',  action='store_true', help="export a generated session and read it back")
+    args    = parser.parse_args()
+    formats = (['mat'] if args.mat or not args.npz else []) + (['npz'] if args.npz else [])
+
+    if args.test:
+
+        ###
+        # Export a session with a gap and an events stream, while it is still being written, and read it back
+        ###
+
+        import tempfile
+        from orlau_session import SessionWriter
+
+        folder = tempfile.mkdtemp()
+        t0     = time.time()
+        rng    = np.random.default_rng(0)
+        emg    = rng.normal(0, 0.0003, (2, 300*200)).astype('<f4')
+        active = np.repeat(rng.random((2, 200)) > 0.8, 300, axis=1)
+        writer = SessionWriter(folder+'/session.orl', meta={'config': {'participant_name': 'A', 'emg_muscles_names': ['deltoid', 'biceps'], 'imu_rate': None}}, start_time=t0)
+        writer.add_stream('emg_raw', 2, 2000, names=['deltoid', 'biceps'], start_time=t0)
+        writer.add_stream('activ_hist', 2, 2000, encoding='events', clock='emg_raw', start_time=t0)
+        for i in range(0, 200, 4):
+            if i == 100:
+                continue # lost
+            batches = np.array([(k, (k+1)*300, t0 + (k+1)*0.15) for k in range(i, i+4)], dtype=BATCH_DTYPE)
+            writer.write('emg_raw',    emg[:, i*300:(i+4)*300],    start=i*300, batches=batches)
+            writer.write('activ_hist', active[:, i*300:(i+4)*300], start=i*300, batches=batches)
+        expected = {'emg_raw': emg.copy(), 'activ_hist': active.astype('<f4')}
+        for data in expected.values():
+            data[:, 30000:31200] = np.nan
+
+        failed = False
+        for version in ['5'] + (['7.3'] if not args.v5 else []):
+            try:
+                paths = export_session(folder, formats=['mat', 'npz'], block=7000, version=version)
+            except ImportError:
+                printColor(f"v{version}: not tested, h5py is not installed (install it, or use --v5 to only test v5)", 'red')
+                failed = True
+                continue
+            if version == '7.3':
+                # read back with h5py: datasets (samples x channels, as MATLAB reverses the dimensions), classes, and the MATLAB header of the user block
+                import h5py
+                with h5py.File(paths[0], 'r') as fp:
+                    assert fp.userblock_size == 512
+                    for name, data in expected.items():
+                        assert fp[name].shape == data.T.shape and fp[name].dtype == np.dtype('<f4'), name
+                        assert np.array_equal(fp[name][()].T, data, equal_nan=True), name
+                        assert fp[name].attrs['MATLAB_class'] == b'single', name
+                    assert fp['config'].attrs['MATLAB_class'] == b'struct' and fp['streams'].attrs['MATLAB_class'] == b'struct'
+                    assert fp['config/participant_name'].attrs['MATLAB_class'] == b'char'
+                    assert fp['config/participant_name'][()].tobytes().decode('utf-16-le') == 'A'
+                    assert fp['start_time'].attrs['MATLAB_class'] == b'double' and fp['start_time'][0, 0] == t0
+                    assert fp['activ_hist_events'].shape[0] == 5 and fp['emg_raw_batches'].shape == (3, 196)
+                with open(paths[0], 'rb') as fp:
+                    header = fp.read(128)
+                assert header.startswith(b'MATLAB 7.3 MAT-file') and header[124:126] == struct.pack('<H', 0x0200) and header[126:128] == b'IM', header
+            if version == '5':
+                mat = sio.loadmat(paths[0])
+                for name, data in expected.items():
+                    assert np.array_equal(mat[name], data, equal_nan=True), name
+                assert mat['config']['participant_name'][0, 0][0] == 'A'
+                assert mat['activ_hist_events'].shape[1] == 5 and mat['emg_raw_batches'].shape == (196, 3)
+            npz = np.load(paths[1])
+            for name, data in expected.items():
+                assert np.array_equal(npz[name], data, equal_nan=True), name
+            assert json.loads(str(npz['config']))['participant_name'] == 'A'
+            print(f"v{version}: " + ", ".join([f"{os.path.basename(path)} {os.path.getsize(path)/1e6:.2f} MB" for path in paths]) + ": ok")
+        writer.close()
+        sys.exit(1 if failed else 0)
+
+    for folder in args.folders:
+        tic   = time.perf_counter()
+        paths = export_session(folder, formats=formats, block=args.block, version='5' if args.v5 else None)
+        printColor(f"{folder}: " + ", ".join(paths) + f" ({time.perf_counter() - tic:.1f} s)", 'green')
@@ -25,175 +25,384 @@ import multiprocessing
 from multiprocessing import Process, Pipe, freeze_support, Manager
 
 from orlau_utils import showTitle, printColor, show
-
-def funcFilter(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=False, debug=False):
+from orlau_ring import catch_up
+
+def blank_artifacts(raw, history, thresh, window, fill=('hold','zero'), pending=None):
+    """
+    Remove the stimulation artifacts from a batch of emg, for all the muscles at once.
+
+    Each sample above 'thresh' (absolute value) is replaced, together with the 'window'
+    samples before it and the 'window'-1 samples after it (within the batch), by the last
+    good value ('hold') or by 0 ('zero').
+
+    Gives the same output as the original per-sample loop (blank_artifacts_loop), but only the
+    samples above the threshold are looked at in python (to know which ones the loop would
+    have already overwritten when reaching them): the blanked runs are then dilated and filled
+    in bulk with a cumsum of their start/stop marks.
+
+    Parameters
+    ----------
+    raw : ndarray, shape=(channels, n)
+        New batch of raw emg.
+    history : ndarray, shape=(channels, m)
+        Previous filtered output of each channel: only the last window+1 samples are used
+        (padded with 0 if there are fewer).
+    thresh : float
+        Stimulation artifact threshold.
+    window : int
+        Number of samples to blank before and after each artifact.
+    fill : list of str, optional
+        'hold' (last good value) or 'zero' for each channel.
+    pending : ndarray, shape=(channels, 2), optional
+        [number of samples, fill value] of the blanking left over by the previous batch for
+        each channel, updated in place with what spills after the end of this batch. If None,
+        the blanking stops at the end of the batch (like the original loop).
+
+    Returns
+    -------
+    filt : ndarray, shape=(channels, n)
+        Filtered batch.
+    """
+    raw     = np.atleast_2d(raw)
+    history = np.atleast_2d(history)
+    channels, n = raw.shape
+    tail        = window + 1
+    length      = tail + n
+    ahead       = max(window, 1) - 1 # samples blanked after each artifact (the artifact itself is always blanked)
+
+    # work on [last window+1 filtered samples, new batch] of each channel, one after the other in a flat array:
+    # the last good value of a run starting at the beginning of the batch is at most window+1 samples back
+    ext = np.zeros((channels, length), dtype=np.result_type(raw, history))
+    m   = min(history.shape[1], tail)
+    if m > 0:
+        ext[:, tail-m:tail] = history[:, history.shape[1]-m:]
+    ext[:, tail:] = raw
+
+    # blanking carried over from the previous batch: those samples are overwritten before being looked at
+    if pending is not None:
+        for channel in np.flatnonzero(pending[:, 0] > 0).tolist():
+            ext[channel, tail:tail+int(pending[channel, 0])] = pending[channel, 1]
+        pending[:] = 0
+    ext = ext.ravel()
+
+    channel_above, sample_above = np.nonzero(np.abs(ext.reshape(channels, length)[:, tail:]) >= thresh)
+    if channel_above.size == 0:
+        return ext.reshape(channels, length)[:, tail:]
+    candidates = (channel_above * length + sample_above + tail).tolist()
+
+    # find the runs [start, stop] to blank (flat positions), and their fill value
+    starts, stops, values = [], [], []
+    spills  = {} # channel: (last sample overwritten ahead, fill value) of the latest artifact
+    channel = -1
+    for j in candidates:
+        if j // length != channel:
+            channel = j // length
+            last    = (channel + 1) * length - 1
+            hold    = fill[channel] == 'hold'
+            end     = -1 # last sample overwritten ahead by the latest artifact
+            run     = False
+        # the loop had already replaced this sample by the fill value when reaching it (below the threshold, see below)
+        if j <= end:
+            continue
+        if run and j - window - 1 <= stops[-1]:
+            stops[-1] = min(j + ahead, last)   # overlaps or touches the current run: same last good value
+        else:
+            starts.append(j - window)
+            stops.append(min(j + ahead, last))
+            values.append(float(ext[j - window - 1]) if hold else 0.0)
+            run = True
+        end = j + ahead
+        # if the fill value is itself above the threshold (e.g. the threshold was lowered), the loop detects
+        # it again on the next sample, and so on until the end of the batch
+        if window >= 2 and abs(values[-1]) >= thresh:
+            stops[-1] = last
+            end       = last
+            spills[channel] = (last + ahead, values[-1])
+        else:
+            spills[channel] = (end, values[-1])
+
+    # what goes beyond the end of the batch is for the next one
+    if pending is not None:
+        for channel in spills:
+            end, value = spills[channel]
+            last       = (channel + 1) * length - 1
+            if end > last:
+                pending[channel] = [end - last, value]
+
+    # dilate: +1 at the start of each run and -1 after its stop (the runs do not touch), same with their fill value
+    starts = np.array(starts)
+    stops  = np.array(stops) + 1
+    values = np.array(values)
+    marks  = np.zeros(ext.size + 1)
+    fills  = np.zeros(ext.size + 1)
+    marks[starts] =  1
+    marks[stops]  = -1
+    fills[starts] =  values
+    fills[stops]  = -values
+    blanked = np.cumsum(marks[:-1]) > 0
+    ext     = np.where(blanked, np.cumsum(fills[:-1]), ext).reshape(channels, length)
+
+    return ext[:, tail:]
+
+class ArtifactFilter(object):
+    """
+    Streaming artifact blanking (see blank_artifacts), batch after batch.
+
+    Only keeps what is needed from the past between two batches: the last window+1
+    filtered samples of each channel (for the last good value), and optionally the
+    blanking that spills over into the next batch.
+
+    Parameters
+    ----------
+    channels : int
+        Number of channels (muscles).
+    fill : list of str, optional
+        'hold' (last good value) or 'zero' for each channel.
+    spill : bool, optional
+        If True, the samples following an artifact at the end of a batch are blanked at the
+        start of the next one. If False, the blanking stops at the end of each batch (like the original loop).
+    """
+
+    def __init__(self, channels, fill=('hold','zero'), spill=False):
+        self.channels = channels
+        self.fill     = fill
+        self.history  = np.zeros((channels, 0))
+        self.pending  = np.zeros((channels, 2)) if spill else None
+
+    def process(self, raw, thresh, window):
+        """
+        Filter the next batch.
+
+        Parameters
+        ----------
+        raw : ndarray, shape=(channels, n)
+            New batch of raw emg.
+        thresh : float
+            Stimulation artifact threshold.
+        window : int
+            Number of samples to blank before and after each artifact.
+
+        Returns
+        -------
+        filt : ndarray, shape=(channels, n)
+            Filtered batch.
+        """
+        filt = blank_artifacts(raw, self.history, thresh, window, self.fill, self.pending)
+
+        # keep the end of the output (more if the window was larger before)
+        keep         = max(window + 1, self.history.shape[1])
+        self.history = np.hstack((self.history, filt))[:, -keep:]
+        return filt
+
+def blank_artifacts_loop(raw, history, thresh, window, fill='hold'):
+    """
+    Original per-sample implementation of the artifact blanking, for one channel.
+
+    Kept as the reference for blank_artifacts (see the benchmark below). Needs at least
+    window+1 samples of history.
+
+    Parameters
+    ----------
+    raw : ndarray, shape=(n,)
+        New batch of raw emg.
+    history : ndarray, shape=(m,)
+        Previous filtered output.
+    thresh : float
+        Stimulation artifact threshold.
+    window : int
+        Number of samples to blank before and after each artifact.
+    fill : str, optional
+        'hold' (last good value) or 'zero'.
+
+    Returns
+    -------
+    filt : ndarray, shape=(n,)
+        Filtered batch.
+    """
+    # we take what has been filtered so far, and we add the new batch of unfiltered data, and we will loop through it to filter
+    # this is because if one of the first frames (within the filter_delWindow) is above the threshold, we need the previous good value which only exists in the previous batch of data
+    copy_filt = np.concatenate( (history, raw), axis=0 )
+
+    # we loop through the last batch of data
+    for index in range(-len(raw),0):
+
+        this_value = copy_filt[index]
+
+        # if we have a value that is above the threshold
+        if abs(this_value) >= thresh:
+
+            latestGoodKnownValue = copy_filt[index - window - 1] if fill == 'hold' else 0
+
+            # we change the values before
+            copy_filt[index - window : index] = latestGoodKnownValue
+
+            # we change this value
+            copy_filt[index] = latestGoodKnownValue
+
+            # we change the values after (special case if there's less than the window remaining in the array)
+            if index < -window:
+                copy_filt[index : index + window] = latestGoodKnownValue
+            elif index >= -window:
+                copy_filt[index : ] = latestGoodKnownValue
+
+    return copy_filt[-len(raw):]
+
+def funcFilter(sharedConfig, sharedData, sharedControl, sharedQueue1, sharedQueue2, verbose=False, debug=False):
     
     # using sharedDict and not queues
 
-    # open files on disk
-    fileFilter_delt = open(sharedConfig['dataSaveFolder']+'/data_filter_delt.txt', 'ab')
-    fileFilter_bic  = open(sharedConfig['dataSaveFolder']+'/data_filter_bic.txt',  'ab')
-
     samples_per_read = sharedConfig['samples_per_read']
+
+    # all the muscles at once (one row each), the artifacts are replaced by the last good value or by 0 depending on the muscle
+    # (with the frames of emg_lowLatency, most of the blankings reach the end of a frame: they always continue in the next one)
+    artifactFilter   = ArtifactFilter(len(sharedConfig['emg_muscles_names']), fill=sharedConfig['filter_fillMode'], spill=sharedConfig['filter_spill'] or sharedConfig['emg_lowLatency'])
     
+    skippedBatches = 0 # batches skipped since the start (stage_catchUp 'latest')
     iFilter = 0
     while not sharedConfig['emg_shutdown']:
               
         #induce delay
         #sleep(0.4)
 
-        if debug: print(f"\n# filt: current raw is {len(sharedData['emg_delt_raw'])}, current filt is {len(sharedData['emg_delt_filt'])}")
+        if debug: print(f"\n# filt: current raw is {sharedData['emg_raw'].cursor}, current filt is {sharedData['emg_filt'].cursor}")
 
-        # Pass if we don't have any new data from raw (could change to blocking mechanism)
-        if not sharedConfig['emg_iter'] > iFilter:
+        # Block until the emg process has published a new batch (all the muscles at once)
+        # we wake up every 0.5s anyway to check the shutdown flag
+        emg_iter = sharedData['emg_raw'].wait(iFilter, timeout=0.5)
+        if not emg_iter > iFilter:
             if debug: print(f"# filt: no new data from raw, skipping")
             pass
 
-        # if the array has been populated, process the latest batch of data
-        if sharedConfig['emg_iter'] > iFilter :
+        # if the array has been populated, process the next batch of data
+        if emg_iter > iFilter :
 
             if verbose: printColor(f"\nFilter iter {iFilter}", 'green')
             
             # create local vars just in case a flag changes through the function, we want to finish the loop
+            # (parameters are read once per batch)
             this_emg_filter_do = sharedConfig['emg_filter_do']
-            this_stim_do       = sharedConfig['stim_do']
+            this_stim_do       = sharedControl['stim_do']
+            this_stim_thresh   = sharedConfig['stim_thresh']
+            this_delWindow     = sharedConfig['filter_delWindow']
             
             ###
-            # get the latest filtered data
+            # get the next batches of raw data
             ###
             
-            # latest batch of raw data
-            this_emg_delt_raw = sharedData['emg_delt_raw'][-samples_per_read:]
-            this_emg_bic_raw  = sharedData['emg_bic_raw'][-samples_per_read:]
-            
-            # getting a copy of the array of the past filtered data
-            # we can't edit a nested value in the manager's shared dict directly, so will need to replace it
-            # not a deep copy, and a numpy array, so should not impact performance
-            copy_delt_filt =  sharedData['emg_delt_filt']
-            copy_bic_filt  =  sharedData['emg_bic_filt']
-            this_emg_delt_filt = None
-            this_emg_bic_filt  = None
+            # all the batches published since the last one we filtered (several if we fell behind: filtered in one go), or only the latest one
+            # if stage_catchUp is 'latest': the ones we skip are left empty (NaN) in emg_filt, and listed in stage_gaps
+            first = catch_up(sharedData['emg_raw'], iFilter, emg_iter, samples_per_read, sharedConfig['stage_catchUp'])
+            if first > iFilter:
+                printColor(f"filter: {emg_iter - iFilter} batches behind, skipping batches {iFilter} to {first-1}", 'red')
+                skippedBatches                 += first - iFilter
+                sharedConfig['filter_skipped']  = skippedBatches
+                sharedConfig['stage_gaps']      = (sharedConfig['stage_gaps'] + [['filter', iFilter, first - iFilter]])[-sharedConfig['stage_gapsKept']:]
+
+            # read in place from the shared ring, all the muscles at once
+            this_emg_raw  = sharedData['emg_raw'].read(first*samples_per_read, emg_iter*samples_per_read)
 
             ###
-            # and do the filtering (if asked)
+            # and do the filtering
             ###
 
             # if not asked, just pass the raw data through (for debugging/assessment only)
             # now directly in RMS that chooses who to take from
-            #if not this_emg_filter_do:
-            #    this_emg_delt_filt = sharedData['emg_delt_raw'][-samples_per_read:]
-            #    this_emg_bic_filt  = sharedData['emg_bic_raw'][-samples_per_read:]
-            #    pass
 
             ##
             # Option 1 : simpliest, for variable frequency noise
-
-            # we take what has been filtered so far, and we add the new batch of unfiltered data, and we will loop through it to filter
-            # this is because if one of the first frames (within the filter_delWindow) is above the threshold, we need the previous good value which only exists in the previous batch of data           
-            copy_delt_filt =  np.concatenate( (copy_delt_filt, this_emg_delt_raw),  axis=0 )
-            copy_bic_filt  =  np.concatenate( (copy_bic_filt,  this_emg_bic_raw),   axis=0 )
-
-            # Delt
-            if verbose: print("# emg: applying filter to delt")
-            # Loop through the latest batch of data DELT
-            ifilter1 = -samples_per_read
-            
-            # we loop through the last batch of data
-            for index in range(ifilter1,0):
-
-                this_value = copy_delt_filt[index]
-
-                # if we have a value that is above the threshold            
-                if abs(this_value) >= sharedConfig['stim_thresh']:
-                    
-                    if verbose: print("FILT : found threshold value in DELT")
-                    
-                    latestGoodKnownValue = copy_delt_filt[index - sharedConfig['filter_delWindow'] - 1]
-                    
-                    # we change the values before
-                    copy_delt_filt[index - sharedConfig['filter_delWindow'] : index] = latestGoodKnownValue
-
-                    # we change this value
-                    copy_delt_filt[index] = latestGoodKnownValue
-                    
-                    # we change the values after (special case if there's less than the window remaining in the array)
-                    if index < -sharedConfig['filter_delWindow']:
-                        copy_delt_filt[index : index + sharedConfig['filter_delWindow']] = latestGoodKnownValue
-                    elif index >= -sharedConfig['filter_delWindow']:
-                        copy_delt_filt[index : ] = latestGoodKnownValue
-
-
-            # Bic
-            if verbose: print("# emg: applying filter to bic")
-            # Loop through the latest batch of data BIC
-            ifilter2 = -samples_per_read
-            
-            # we loop through the last batch of data
-            for index in range(ifilter2,0):
-                
-                this_value = copy_bic_filt[index]
-
-                # if we have a value that is above the threshold            
-                if abs(this_value) >= sharedConfig['stim_thresh']:
-                    
-                    if verbose: print("FILT : found threshold value in DELT")
-                                        
-                    # we change the values before
-                    copy_bic_filt[index - sharedConfig['filter_delWindow'] : index] = 0
-
-                    # we change this value
-                    copy_bic_filt[index] = 0
-                    
-                    # we change the values after (special case if there's less than the window remaining in the array)
-                    if index < -sharedConfig['filter_delWindow']:
-                        copy_bic_filt[index : index + sharedConfig['filter_delWindow']] = 0
-                    elif index >= -sharedConfig['filter_delWindow']:
-                        copy_bic_filt[index : ] = 0
-
-
-            # Replace the shared array by the one we have just processed
-            this_emg_delt_filt = copy_delt_filt[-samples_per_read:]
-            this_emg_bic_filt  = copy_bic_filt[-samples_per_read:]
+            # the filter keeps the end of the previous batch: if one of the first samples (within the filter_delWindow) is above the threshold,
+            # we need the previous good value which only exists in the previous batch of data
+            if verbose: print(f"# emg: applying filter, {np.count_nonzero(np.abs(this_emg_raw) >= this_stim_thresh)} values above threshold")
+            this_emg_filt = artifactFilter.process(this_emg_raw, this_stim_thresh, this_delWindow)
             
             ##
             # Debug/testing: divide by two
-            #this_emg_delt_filt = sharedData['emg_delt_raw'][-samples_per_read:] /2
-            #this_emg_bic_filt  = sharedData['emg_bic_raw'][-samples_per_read:]  /2
+            #this_emg_filt = sharedData['emg_raw'].latest(samples_per_read) /2
             
-            ###
-            # dump filtered data in csv
-            ###
-
-            np.savetxt(fileFilter_delt, this_emg_delt_filt, delimiter=',')
-            np.savetxt(fileFilter_bic,  this_emg_bic_filt,  delimiter=',')
-
             ###
             # Put in shared dict
             ###
 
-            # add to our shared dict
-            sharedData['emg_delt_filt'] = np.concatenate( (sharedData['emg_delt_filt'],  this_emg_delt_filt),  axis=0 )
-            sharedData['emg_bic_filt']  = np.concatenate( (sharedData['emg_bic_filt'],   this_emg_bic_filt),   axis=0 )
-            if verbose: print(f"now filt is {len(sharedData['emg_delt_filt'])}")
-            
-            # remove the first part to keep size consistent (if reached max limit)
-            if len(sharedData['emg_delt_filt']) > sharedConfig['maxArraySize']:
-                # we remove length of frame from beginning of array
-                sharedData['emg_delt_filt'] = sharedData['emg_delt_filt'][samples_per_read:]
-                sharedData['emg_bic_filt']  = sharedData['emg_bic_filt'][samples_per_read:]
+            # add to our shared ring (it only keeps the latest values, the recorder process writes it to disk), one batch for each batch of raw data
+            if first > iFilter:
+                this_emg_filt = np.hstack((np.full((this_emg_filt.shape[0], (first - iFilter)*samples_per_read), np.nan), this_emg_filt))
+            sharedData['emg_filt'].append(this_emg_filt, batches=emg_iter - iFilter)
+            if verbose: print(f"now filt is {sharedData['emg_filt'].cursor}")
 
             ###
             # only then (after get;dump;resize), increment iterNumber to let rms processe know it can process the next batch
             ###
 
-            iFilter+=1
+            iFilter = emg_iter
             sharedConfig['filter_iter'] = iFilter
             if verbose: print(f"# filt: new data, done iter {iFilter}")    
 
-    # Graceful exit
-    fileFilter_delt.close()
-    fileFilter_bic.close()
 
 if __name__ == "__main__":
     
     print("orlau_filter loaded as main")
+
+    ###
+    # Check blank_artifacts against the original loop, and benchmark both
+    ###
+
+    samples_per_read = 300
+    batches          = 500
+    rng              = np.random.default_rng(0)
+
+    # noise with stimulation artifacts (a few samples every 25 ms), plus some random spikes
+    n   = samples_per_read * batches
+    emg = rng.normal(0, 0.0002, (2, n))
+    for start in range(0, n, 50):
+        emg[:, start:start+rng.integers(1,4)] = 0.0011
+    emg[rng.random((2, n)) < 0.002] = -0.0015
+
+    # the threshold changes from time to time (like in the GUI), sometimes below the noise level
+    thresh = np.where(rng.random(batches) < 0.05, 0.0003, 0.0009)
+
+    for window in [0, 1, 2, 10, 20]:
+        hist_loop = np.zeros((2, window+1))
+        artifactFilter = ArtifactFilter(2, fill=('hold','zero'))
+        time_loop = 0
+        time_vect = 0
+        for i in range(batches):
+            raw = emg[:, i*samples_per_read:(i+1)*samples_per_read]
+
+            t0 = time.perf_counter()
+            out_loop = np.vstack((blank_artifacts_loop(raw[0], hist_loop[0], thresh[i], window, 'hold'),
+                                  blank_artifacts_loop(raw[1], hist_loop[1], thresh[i], window, 'zero')))
+            t1 = time.perf_counter()
+            out_vect = artifactFilter.process(raw, thresh[i], window)
+            t2 = time.perf_counter()
+            time_loop += t1 - t0
+            time_vect += t2 - t1
+
+            if not np.array_equal(out_loop, out_vect):
+                printColor(f"window {window}, batch {i}: outputs differ at {np.argwhere(out_loop != out_vect)[:5].tolist()}", 'red')
+                sys.exit(1)
+            hist_loop = out_loop
+
+        printColor(f"window {window:2d}: {batches} batches of {samples_per_read} samples x 2 muscles, identical outputs", 'green')
+        print(f"    loop       : {1e6*time_loop/batches:8.1f} us per batch")
+        print(f"    vectorized : {1e6*time_vect/batches:8.1f} us per batch (x{time_loop/time_vect:.1f})")
+
+    # with spill, streaming batch after batch gives the same as the original loop over the whole recording at once,
+    # except for the last 'window' samples of each batch (already sent when an artifact at the start of the next batch blanks them)
+    for window in [0, 1, 2, 10, 20]:
+        artifactFilter = ArtifactFilter(2, fill=('hold','zero'), spill=True)
+        out_stream = np.hstack([artifactFilter.process(emg[:, i*samples_per_read:(i+1)*samples_per_read], 0.0009, window) for i in range(batches)])
+        out_whole  = np.vstack((blank_artifacts_loop(emg[0], np.zeros(window+1), 0.0009, window, 'hold'),
+                                blank_artifacts_loop(emg[1], np.zeros(window+1), 0.0009, window, 'zero')))
+        sent = np.arange(n) % samples_per_read < samples_per_read - window
+        if not np.array_equal(out_stream[:, sent], out_whole[:, sent]):
+            printColor(f"window {window}, spill: outputs differ at {np.argwhere(out_stream[:, sent] != out_whole[:, sent])[:5].tolist()}", 'red')
+            sys.exit(1)
+        printColor(f"window {window:2d}: spill over batches identical to a single pass", 'green')
+
+    # on top of that, funcFilter used to read stim_thresh from the manager for every sample (and filter_delWindow for each artifact)
+    sharedConfig = Manager().dict({'stim_thresh': 0.0009})
+    t0 = time.perf_counter()
+    for i in range(1000):
+        sharedConfig['stim_thresh']
+    time_proxy = (time.perf_counter() - t0) / 1000
+    print(f"manager reads of stim_thresh in the original funcFilter: {1e3*time_proxy*2*samples_per_read:8.1f} ms per batch")
@@ -63,6 +63,17 @@ def funcStreamImu(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=
 
     if verbose: printColor('Connected to IMU', color='green')
     devIMU.become_master()
+
+    # only decode the aux channels of the sensors we are interested in (all 144 channels if imu_sensors is None), possibly only some of each sensor (imu_auxChannels)
+    if sharedConfig['imu_sensors']:
+        devIMU.set_channels(devIMU.sensor_channels(sharedConfig['imu_sensors'], aux=True, aux_channels=sharedConfig['imu_auxChannels']))
+        imu_channels = devIMU.channels
+    else:
+        imu_channels = list(range(devIMU.total_channels))
+    sharedConfig['imu_rate']     = devIMU.rate
+    sharedConfig['imu_channels'] = imu_channels
+    if verbose: print(f"IMU channel map: {imu_channels}")
+
     devIMU.start()
 
     # Notify the other processes that we have succeded
@@ -73,11 +84,6 @@ def funcStreamImu(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=
     # Get the data in a loop
     ###
     
-    # open files on disk
-    #fileImu_delt = open(sharedConfig['dataSaveFolder']+'/data_imu_delt.txt', 'ab')
-    #fileImu_bic  = open(sharedConfig['dataSaveFolder']+'/data_imu_bic.txt',  'ab')
-    fileImu_all  = open(sharedConfig['dataSaveFolder']+'/data_imu_all.txt',  'ab')
-
     iImu = 0
     while not sharedConfig['imu_shutdown']:
    
@@ -96,25 +102,16 @@ def funcStreamImu(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=
         
         # blocking mechanism, so we read() until our local buffer has gotten enough frames from delsys to constitute a full batch
         this_data_frame    = devIMU.read()
-        #this_imu_delt = this_data_frame[27:31]
-        #this_imu_bic  = this_data_frame[63:67]
 
         if iImu==0: # as we receive the first batch, get the time to provide feedback on how long we have been streaming
             sharedConfig['streamTimeStart'] = time.time()
 
-        ###
-        # dump in csv
-        ###
-        
-        #np.savetxt(fileImu_delt, this_imu_delt, delimiter=',')
-        #np.savetxt(fileImu_bic,  this_imu_bic,  delimiter=',')
-        np.savetxt(fileImu_all, this_data_frame.T, delimiter=',')
-        
         ###
         # Put in shared dict
         ###
         
-        # as we have no preview, no need for it
+        # no preview, but keep the latest values available to the other processes (and to the recorder process, that writes them to disk)
+        sharedData['imu_all'].append(this_data_frame, rows=imu_channels)
 
         ###
         # only then (after get;dump;resize), increment iterNumber to let the filter process know it can process the next batch
@@ -125,7 +122,6 @@ def funcStreamImu(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=
             
     print("imu thread: Stopping IMU gracefully")
     
-    fileImu_all.close()
     devIMU.stop()
     devIMU.__del__()
 
@@ -41,7 +41,7 @@ def funcMonitor(sharedConfig, sharedData):
         printColor(f"\nMonitor: (refreshRate {refreshRate}s)", 'cyan')
         
         behind_iters   = sharedConfig['emg_iter']        - sharedConfig['rms_iter']        # how many iterations behind is the filter from the raw delsys
-        behind_lengths = len(sharedData['emg_delt_raw']) - len(sharedData['emg_delt_rms']) # how many batches of data behind is the filter from the raw delsys
+        behind_lengths = sharedData['emg_raw'].cursor    - sharedData['emg_rms'].cursor    # how many samples behind is the filter from the raw delsys
 
         streamTimeElapsed = 0
         if sharedConfig['streamTimeStart']:
@@ -53,12 +53,21 @@ def funcMonitor(sharedConfig, sharedData):
             'iterFilter'        : sharedConfig['filter_iter'],
             'iterRms'           : sharedConfig['rms_iter'],
                         
-            'len emg_delt_raw'  : len(sharedData['emg_delt_raw']),
-            'len emg_delt_filt' : len(sharedData['emg_delt_filt']),
-            'len emg_delt_rms'  : len(sharedData['emg_delt_rms']),
+            'len emg_raw'       : len(sharedData['emg_raw']),
+            'len emg_filt'      : len(sharedData['emg_filt']),
+            'len emg_rms'       : len(sharedData['emg_rms']),
             
-            'time_streaming'    : streamTimeElapsed, # len(sharedDict['emg_delt_raw'])/sharedConfig['rms_analogFreq'],
-            'iter behind'       : behind_iters
+            'time_streaming'    : streamTimeElapsed, # len(sharedDict['emg_raw'])/sharedConfig['rms_analogFreq'],
+            'iter behind'       : behind_iters,
+            'batches skipped'   : sharedConfig['filter_skipped'] + sharedConfig['rms_skipped'],
+
+            'latency (ms)'      : sharedConfig['rms_latency'], # from each batch received to the decision of the controller, add the batch duration for its first sample
+            'batch (ms)'        : round(1e3 * sharedConfig['samples_per_read'] / sharedConfig['rms_analogFreq'], 1),
+            'stim updates'      : (sharedConfig['stim_timing'] or {}).get('sends'),
+            'stim missed'       : (sharedConfig['stim_timing'] or {}).get('misses'),
+
+            'record backlog (s)': sharedConfig['record_backlog'],
+            'record dropped'    : sharedConfig['record_dropped'],
             }
         
         #pprint(this_dic)
@@ -71,17 +80,17 @@ def funcMonitor(sharedConfig, sharedData):
         if not sharedConfig['emg_shutdown']: print(table)
         
         """
-        #print(f"shape emg_delt_raw  {sharedData['emg_delt_raw'].shape}")
-        #print(f"shape emg_delt_filt {sharedData['emg_delt_filt'].shape}")
-        #print(f"shape emg_delt_rms  {sharedData['emg_delt_rms'].shape}")
+        #print(f"shape emg_raw  {sharedData['emg_raw'].shape}")
+        #print(f"shape emg_filt {sharedData['emg_filt'].shape}")
+        #print(f"shape emg_rms  {sharedData['emg_rms'].shape}")
         
         print(f"iterEmg    = {sharedConfig['emg_iter']}")
         print(f"iterRms    = {sharedConfig['rms_iter']}")
         print(f"iterFilter = {sharedConfig['filter_iter']}")
         
-        print(f"len emg_delt_raw = {len(sharedDict['emg_delt_raw'])}")
-        print(f"len emg_delt_filt = {len(sharedDict['emg_delt_filt'])}")
-        print(f"len emg_delt_rms = {len(sharedDict['emg_delt_rms'])}")
+        print(f"len emg_raw = {len(sharedDict['emg_raw'])}")
+        print(f"len emg_filt = {len(sharedDict['emg_filt'])}")
+        print(f"len emg_rms = {len(sharedDict['emg_rms'])}")
 
         print(f"iters behind {behind_iters}")
         """
@@ -35,7 +35,7 @@ def downSampleData(data, times=1):
         data = data[list(range(0,len(data),2))]
     return data
 
-def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=False, debug=False):
+def functionLivePlot(sharedConfig, sharedData, sharedControl, sharedQueue1, sharedQueue2, verbose=False, debug=False):
 
     from PyQt5.QtWidgets import QApplication, QWidget,QDesktopWidget, QGroupBox, QLabel, QPushButton, QMessageBox, QShortcut, QGridLayout, QHBoxLayout, QVBoxLayout, QFormLayout, QLineEdit, QScrollArea
     from PyQt5.QtGui import QKeySequence, QIcon, QFont
@@ -50,7 +50,7 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     def slot_aboutToQuit():
         print(f'stopping stimulator straight away on closing window')
         # make sure to stop stimulator now, otherwise it will continue for the 2 seconds of the midlevel mode, and might take a while between the moment the window is closing and the process is actually terminated
-        sharedConfig['stim_do']       = False
+        sharedControl['stim_do']      = False
     app.aboutToQuit.connect(slot_aboutToQuit) # myExitHandler is a callable
 
     # Create a main widget
@@ -85,24 +85,24 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     boxFeedback = QGridLayout()
     groupboxFeedback.setLayout(boxFeedback)
     
-    global delt_activ_label
-    delt_activ_label1 = QLabel(f"DELT active")
-    boxFeedback.addWidget(delt_activ_label1,0,0)
-    delt_activ_label2 = QLabel(f"{sharedConfig['active_delt']}")
-    delt_activ_label2.setStyleSheet("QLabel{color: red;font-size:20px;font-family:'Orbitron'}")
-    boxFeedback.addWidget(delt_activ_label2,0,1)
+    # one row per muscle (in the order of emg_muscles_names, as the rows of the emg data streams)
+    muscles      = list(sharedConfig['emg_muscles_names'])
+    muscleColors = ['red','blue','green','orange','purple','brown','magenta','olive']
     
-    global bic_activ_label
-    bic_activ_label1 = QLabel(f"BIC active")
-    boxFeedback.addWidget(bic_activ_label1,1,0)
-    bic_activ_label2 = QLabel(f"{sharedConfig['active_bic']}")
-    bic_activ_label2.setStyleSheet("QLabel{color: red;font-size:20px;font-family:'Orbitron'}")
-    boxFeedback.addWidget(bic_activ_label2,1,1)
+    global activ_labels
+    activ_labels = []
+    for i, muscle in enumerate(muscles):
+        activ_label1 = QLabel(f"{muscle.upper()} active")
+        boxFeedback.addWidget(activ_label1,i,0)
+        activ_label2 = QLabel(f"{sharedControl['emg_active'][i]}")
+        activ_label2.setStyleSheet("QLabel{color: red;font-size:20px;font-family:'Orbitron'}")
+        boxFeedback.addWidget(activ_label2,i,1)
+        activ_labels.append(activ_label2)
 
     global controller_value_label
     controller_value_label1 = QLabel(f"Controller")
     boxFeedback.addWidget(controller_value_label1,0,2)
-    controller_value_label2 = QLabel(f"{sharedConfig['controller_value']}")
+    controller_value_label2 = QLabel(f"{sharedControl['controller_value']}")
     controller_value_label2.setStyleSheet("QLabel{color: black;font-size:20px;font-family:'Orbitron'}")
     boxFeedback.addWidget(controller_value_label2,0,3)
     
@@ -110,13 +110,13 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     pulse_intensity_label1 = QLabel(f"Pulse intensity")
     boxFeedback.addWidget(pulse_intensity_label1,1,2)
     pulse_intensity_label2 = QLabel()
-    if sharedConfig['controller_on']:
-        # if auto, the current pulse_intensity is max_allowed_intensity * sharedData['controller_value']
-        new_pulse_intensity = sharedConfig['controller_value'] * sharedConfig['stim_max_intensity']
-        pulse_intensity_label2.setText(f"{new_pulse_intensity:.3f}")
+    if sharedControl['controller_on']:
+        # if auto, the current pulse_intensity is max_allowed_intensity * sharedData['controller_value'] (for each stimulated muscle)
+        new_pulse_intensity = np.multiply(sharedControl['controller_value'], sharedControl['stim_max_intensity'])
+        pulse_intensity_label2.setText(", ".join(f"{value:.3f}" for value in new_pulse_intensity))
     else:
         # if mode manual, it is set manually in the editbox
-        pulse_intensity_label2.setText(f"{sharedConfig['pulse_intensity_man']}")
+        pulse_intensity_label2.setText(", ".join(str(value) for value in sharedControl['pulse_intensity_man']))
     pulse_intensity_label2.setStyleSheet("QLabel{color: black;font-size:20px;font-family:'Orbitron'}")
     boxFeedback.addWidget(pulse_intensity_label2,1,3)
     
@@ -516,97 +516,56 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     boxCalibNoEmg = QGridLayout()
     groupboxCalibNoEmg.setLayout(boxCalibNoEmg)
 
-    #Muscle threshold without stimulation : Delt
-    paramMuscle0Thres = QLabel(f"Delt Thres")
-    paramMuscle0Thres.setStyleSheet("QLabel {background-color: ;}")
-    btn_paramMuscle0Thres_plus  = QPushButton("+")
-    btn_paramMuscle0Thres_minus = QPushButton("-")
-    btn_paramMuscle0Thres_set   = QPushButton("SET")
-    editMuscle0Thres = QLineEdit(f"{sharedConfig['emg_thresh_noStim'][0]:.7f}")
-    boxCalibNoEmg.addWidget(paramMuscle0Thres,0,0)
-    boxCalibNoEmg.addWidget(editMuscle0Thres,0,1)
-    boxCalibNoEmg.addWidget(btn_paramMuscle0Thres_plus,0,2)
-    boxCalibNoEmg.addWidget(btn_paramMuscle0Thres_minus,0,3)
-    boxCalibNoEmg.addWidget(btn_paramMuscle0Thres_set,0,4)
-    def slot_muscle0Thres_set():
-        new_val = float(editMuscle0Thres.text())
-        # can't edit directly nested elements from a manager object (like the dicts)
-        curr_values = sharedConfig['emg_thresh_noStim']
-        curr_values[0] = new_val
-        print(f"new val from gui is {new_val}")
-        sharedConfig['emg_thresh_noStim'] = curr_values
-        print(f"now in shared dict is its")
-        print(sharedConfig['emg_thresh_noStim'])
-        # update on graph
-        print(f"set {sharedConfig['emg_thresh_noStim'][0]} in shared dict, applying to line3")
-        try:
-            xaxis = np.array(range(0,previewData_size))
-            line3.set_data(xaxis, sharedConfig['emg_thresh_noStim'][0])
-            line3.figure.canvas.draw()
-        except:
-            print("failed")
-        print(f"new value is now { sharedConfig['emg_thresh_noStim'][0]}")
-    btn_paramMuscle0Thres_set.clicked.connect(slot_muscle0Thres_set)
-    def slot_muscle0Thres_plus():
-        this_muscle0Thres = float(editMuscle0Thres.text())
-        new_muscle0Thres = round( (this_muscle0Thres + 0.00001), 5)
-        print(f'muscle0Thres: set value from {this_muscle0Thres} to {new_muscle0Thres}')
-        editMuscle0Thres.setText(str(f"{new_muscle0Thres:.7f}"))
-        slot_muscle0Thres_set()
-    btn_paramMuscle0Thres_plus.clicked.connect(slot_muscle0Thres_plus)
-    def slot_muscle0Thres_minus():
-        this_muscle0Thres = float(editMuscle0Thres.text())
-        new_muscle0Thres = round( (this_muscle0Thres - 0.00001), 5)
-        print(f'muscle0Thres: set value from {this_muscle0Thres} to {new_muscle0Thres}')
-        editMuscle0Thres.setText(str(f"{new_muscle0Thres:.7f}"))
-        slot_muscle0Thres_set()
-    btn_paramMuscle0Thres_minus.clicked.connect(slot_muscle0Thres_minus)
-    
-    #Muscle threshold B : Bic
-    paramMuscle1Thres = QLabel(f"Bic Thres")
-    btn_paramMuscle1Thres_plus  = QPushButton("+")
-    btn_paramMuscle1Thres_minus = QPushButton("-")
-    btn_paramMuscle1Thres_set   = QPushButton("SET")
-    editMuscle1Thres = QLineEdit(f"{sharedConfig['emg_thresh_noStim'][1]:.7f}")
-    boxCalibNoEmg.addWidget(paramMuscle1Thres,1,0)
-    boxCalibNoEmg.addWidget(editMuscle1Thres,1,1)
-    boxCalibNoEmg.addWidget(btn_paramMuscle1Thres_plus,1,2)
-    boxCalibNoEmg.addWidget(btn_paramMuscle1Thres_minus,1,3)
-    boxCalibNoEmg.addWidget(btn_paramMuscle1Thres_set,1,4)
-    
-    def slot_muscle1Thres_set():
-        new_val = float(editMuscle1Thres.text())
-        # can't edit directly nested elements from a manager object (like the dicts)
-        curr_values = sharedConfig['emg_thresh_noStim']
-        curr_values[1] = new_val
-        print(f"new val from gui is {new_val}")
-        sharedConfig['emg_thresh_noStim'] = curr_values
-        print(f"now in shared dict is its")
-        print(sharedConfig['emg_thresh_noStim'])
-        # update on graph
-        print(f"set {sharedConfig['emg_thresh_noStim'][0]} in shared dict, applying to line5")
-        try:
-            xaxis = np.array(range(0,previewData_size))
-            line5.set_data(xaxis, sharedConfig['emg_thresh_noStim'][1])
-            line5.figure.canvas.draw()
-        except:
-            print("failed")
-        print(f"new value is now { sharedConfig['emg_thresh_noStim'][1]}")
-    btn_paramMuscle1Thres_set.clicked.connect(slot_muscle1Thres_set)
-    def slot_muscle1Thres_plus():
-        this_muscle1Thres = float(editMuscle1Thres.text())
-        new_muscle1Thres = round( (this_muscle1Thres + 0.00001), 5)
-        print(f'stimThres: set value from {this_muscle1Thres} to {new_muscle1Thres}')
-        editMuscle1Thres.setText(str(f"{new_muscle1Thres:.7f}"))
-        slot_muscle1Thres_set()
-    btn_paramMuscle1Thres_plus.clicked.connect(slot_muscle1Thres_plus)
-    def slot_muscle1Thres_minus():
-        this_muscle1Thres = float(editMuscle1Thres.text())
-        new_muscle1Thres = round( (this_muscle1Thres - 0.00001), 5)
-        print(f'muscle1Thres: set value from {this_muscle1Thres} to {new_muscle1Thres}')
-        editMuscle1Thres.setText(str(f"{new_muscle1Thres:.7f}"))
-        slot_muscle1Thres_set()
-    btn_paramMuscle1Thres_minus.clicked.connect(slot_muscle1Thres_minus)
+    # Muscle thresholds: one row per muscle, for each of the two sets of thresholds (without and with stimulation)
+    def addMuscleThres(box, row, i, key, title):
+        paramMuscleThres = QLabel(title)
+        paramMuscleThres.setStyleSheet("QLabel {background-color: ;}")
+        btn_paramMuscleThres_plus  = QPushButton("+")
+        btn_paramMuscleThres_minus = QPushButton("-")
+        btn_paramMuscleThres_set   = QPushButton("SET")
+        editMuscleThres = QLineEdit(f"{sharedConfig[key][i]:.7f}")
+        box.addWidget(paramMuscleThres,row,0)
+        box.addWidget(editMuscleThres,row,1)
+        box.addWidget(btn_paramMuscleThres_plus,row,2)
+        box.addWidget(btn_paramMuscleThres_minus,row,3)
+        box.addWidget(btn_paramMuscleThres_set,row,4)
+        def slot_muscleThres_set():
+            new_val = float(editMuscleThres.text())
+            # can't edit directly nested elements from a manager object (like the dicts)
+            curr_values = sharedConfig[key]
+            curr_values[i] = new_val
+            print(f"new val from gui is {new_val}")
+            sharedConfig[key] = curr_values
+            print(f"now in shared dict is its")
+            print(sharedConfig[key])
+            # update on graph
+            print(f"set {sharedConfig[key][i]} in shared dict, applying to its threshold line")
+            try:
+                xaxis = np.array(range(0,previewData_size))
+                threshLines[key][i].set_data(xaxis, sharedConfig[key][i])
+                threshLines[key][i].figure.canvas.draw()
+            except:
+                print("failed")
+            print(f"new value is now { sharedConfig[key][i]}")
+        btn_paramMuscleThres_set.clicked.connect(slot_muscleThres_set)
+        def slot_muscleThres_plus():
+            this_muscleThres = float(editMuscleThres.text())
+            new_muscleThres = round( (this_muscleThres + 0.00001), 5)
+            print(f'{key}[{i}]: set value from {this_muscleThres} to {new_muscleThres}')
+            editMuscleThres.setText(str(f"{new_muscleThres:.7f}"))
+            slot_muscleThres_set()
+        btn_paramMuscleThres_plus.clicked.connect(slot_muscleThres_plus)
+        def slot_muscleThres_minus():
+            this_muscleThres = float(editMuscleThres.text())
+            new_muscleThres = round( (this_muscleThres - 0.00001), 5)
+            print(f'{key}[{i}]: set value from {this_muscleThres} to {new_muscleThres}')
+            editMuscleThres.setText(str(f"{new_muscleThres:.7f}"))
+            slot_muscleThres_set()
+        btn_paramMuscleThres_minus.clicked.connect(slot_muscleThres_minus)
+
+    #Muscle thresholds without stimulation
+    for i, muscle in enumerate(muscles):
+        addMuscleThres(boxCalibNoEmg, i, i, 'emg_thresh_noStim', f"{muscle.capitalize()} Thres")
 
     ###
     # Calibration EMG thresholds WITH stim
@@ -633,7 +592,7 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     
     #Stim sends pulses ONOFF
     paramStimOnOff1 = QLabel(f"Stim active")
-    paramStimOnOff2 = QLabel(f"{sharedConfig['stim_do']}")
+    paramStimOnOff2 = QLabel(f"{sharedControl['stim_do']}")
     paramStimOnOff2.setStyleSheet("QLabel{color: red;font-size:12px;font-family:'Orbitron'}")
     paramStimOnOff1.setAlignment(Qt.AlignCenter)
     paramStimOnOff2.setAlignment(Qt.AlignCenter)
@@ -644,13 +603,13 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     boxCalibWithEmg.addWidget(btn_paramStimOnOff_on,1,2)
     boxCalibWithEmg.addWidget(btn_paramStimOnOff_off,1,3)
     def slot_paramStimOnOff_on():
-        sharedConfig['stim_do'] = True
-        paramStimOnOff2.setText(f"{sharedConfig['stim_do']}")
+        sharedControl['stim_do'] = True
+        paramStimOnOff2.setText(f"{sharedControl['stim_do']}")
         paramStimOnOff2.setStyleSheet("QLabel{color: green;font-size:12px;font-family:'Orbitron'}")
     btn_paramStimOnOff_on.clicked.connect(slot_paramStimOnOff_on)
     def slot_paramStimOnOff_off():
-        sharedConfig['stim_do'] = False
-        paramStimOnOff2.setText(f"{sharedConfig['stim_do']}")
+        sharedControl['stim_do'] = False
+        paramStimOnOff2.setText(f"{sharedControl['stim_do']}")
         paramStimOnOff2.setStyleSheet("QLabel{color: red;font-size:12px;font-family:'Orbitron'}")
     btn_paramStimOnOff_off.clicked.connect(slot_paramStimOnOff_off)
 
@@ -757,7 +716,7 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     btn_paramStimWindow_minus.clicked.connect(slot_StimWindow_minus)
 
     # Controller: defines if the pulses sent are defined by the controller or set manually
-    controllerOn         = sharedConfig['controller_on']
+    controllerOn         = sharedControl['controller_on']
     paramSetController1 = QLabel("Controller")
     paramSetController2 = QLabel()
     paramSetController1.setStyleSheet("QLabel{color: black;font-size:12px;font-family:'Orbitron'}")
@@ -774,50 +733,67 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     boxCalibWithEmg.addWidget(btn_paramSetController_auto,5,2)
     boxCalibWithEmg.addWidget(btn_paramSetController_manual,5,3)
     def slot_SetController_auto():
-        sharedConfig['controller_on'] = True
+        sharedControl['controller_on'] = True
         paramSetController2.setText(f"auto")
     btn_paramSetController_auto.clicked.connect(slot_SetController_auto)
     def slot_SetController_manual():
-        sharedConfig['controller_on'] = False
+        sharedControl['controller_on'] = False
         paramSetController2.setText(f"manual")
         # (re)set the current manual stim value to 0 just in case?
         #sharedData['pulse_intensity_man'] = 0
-        #print(f"set pulse_intensity_man value to 0 : {sharedConfig['pulse_intensity_man']}")
+        #print(f"set pulse_intensity_man value to 0 : {sharedControl['pulse_intensity_man']}")
         # it is updated by the canvas loop
     btn_paramSetController_manual.clicked.connect(slot_SetController_manual)
 
     #pulse_intensity
-    param1 = QLabel(f"Intensity (<{sharedConfig['stim_max_intensity']})")
+    param1 = QLabel(f"Intensity (<{sharedControl['stim_max_intensity']})")
     param1.setStyleSheet("QLabel {background-color: ;}")
     btn_param1_plus  = QPushButton("+")
     btn_param1_minus = QPushButton("-")
     btn_param1_set   = QPushButton("SET")
-    edit1 = QLineEdit(str( sharedConfig['pulse_intensity_man'] ))
+    edit1 = QLineEdit(", ".join(str(value) for value in sharedControl['pulse_intensity_man'])) # one per stimulated muscle, or one for all of them
     boxCalibWithEmg.addWidget(param1,6,0)
     boxCalibWithEmg.addWidget(edit1,6,1)
     boxCalibWithEmg.addWidget(btn_param1_plus,6,2)
     boxCalibWithEmg.addWidget(btn_param1_minus,6,3)
     boxCalibWithEmg.addWidget(btn_param1_set,6,4)
+    def read_param1():
+        # one integer intensity per stimulated muscle, or one for all of them: None (and a warning) otherwise
+        nStim = len(sharedControl['stim_max_intensity'])
+        try:
+            values = [int(value) for value in edit1.text().split(',')]
+        except ValueError:
+            values = None
+        if values is None or len(values) not in (1, nStim) or min(values) < 0:
+            printColor(f"param1: pulse_intensity_man: invalid value {edit1.text()!r}", 'red')
+            QMessageBox.warning(w, "Intensity", f"Enter one intensity (integer >= 0) for all the muscles, or {nStim} separated by commas.")
+            return None
+        return np.array(values)
     def slot_btn_param1_set():
+        values = read_param1()
+        if values is None:
+            return
         print(f'param1: pulse_intensity_man: applying new value {edit1.text()}')
-        sharedConfig['pulse_intensity_man'] = int(edit1.text())
+        sharedControl['pulse_intensity_man'] = values
     btn_param1_set.clicked.connect(slot_btn_param1_set)
     def slot_btn_param1_plus():
-        this_val = int(edit1.text())
+        this_val = read_param1()
+        if this_val is None:
+            return
         new_val  = this_val + 1
-        # make sure we don't go over the limit
-        if new_val > sharedConfig['stim_max_intensity']:
-            new_val = sharedConfig['stim_max_intensity']
-        edit1.setText(str(new_val))
+        # make sure we don't go over the limit (of each muscle)
+        new_val  = np.minimum(new_val, sharedControl['stim_max_intensity'])
+        edit1.setText(", ".join(str(value) for value in new_val))
         slot_btn_param1_set()
     btn_param1_plus.clicked.connect(slot_btn_param1_plus)
     def slot_btn_param1_minus():
-        this_val = int(edit1.text())
+        this_val = read_param1()
+        if this_val is None:
+            return
         new_val  = this_val - 1
         # make sure lowest value is 0
-        if new_val < 0:
-            new_val = 0
-        edit1.setText(str(new_val))
+        new_val  = np.maximum(new_val, 0)
+        edit1.setText(", ".join(str(value) for value in new_val))
         slot_btn_param1_set()
     btn_param1_minus.clicked.connect(slot_btn_param1_minus)
 
@@ -827,7 +803,7 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     btn_param2_set   = QPushButton("SET")
     btn_param2_plus  = QPushButton("+")
     btn_param2_minus = QPushButton("-")   
-    edit2 = QLineEdit(str( sharedConfig['pulse_width'] ))
+    edit2 = QLineEdit(str( sharedControl['pulse_width'] ))
     boxCalibWithEmg.addWidget(param2,7,0)
     boxCalibWithEmg.addWidget(edit2,7,1)
     boxCalibWithEmg.addWidget(btn_param2_plus,7,2)
@@ -835,7 +811,7 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     boxCalibWithEmg.addWidget(btn_param2_set,7,4)   
     def slot_btn_param2_set():
         print(f'param2: pulse_width: applying new value {edit2.text()}')
-        sharedConfig['pulse_width'] = int(edit2.text())
+        sharedControl['pulse_width'] = int(edit2.text())
     btn_param2_set.clicked.connect(slot_btn_param2_set)
     def slot_btn_param2_plus():
         this_val = int(edit2.text())
@@ -856,7 +832,7 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     btn_param3_plus  = QPushButton("+")
     btn_param3_minus = QPushButton("-")
     btn_param3_set   = QPushButton("SET")
-    edit3 = QLineEdit(str( sharedConfig['pulse_period'] ))
+    edit3 = QLineEdit(str( sharedControl['pulse_period'] ))
     boxCalibWithEmg.addWidget(param3,8,0)
     boxCalibWithEmg.addWidget(edit3,8,1)
     boxCalibWithEmg.addWidget(btn_param3_plus,8,2)
@@ -864,7 +840,7 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     boxCalibWithEmg.addWidget(btn_param3_set,8,4)
     def slot_btn_param3_set():
         print(f'param2: pulse_period: applying new value {edit3.text()}')
-        sharedConfig['pulse_period'] = float(edit3.text())
+        sharedControl['pulse_period'] = float(edit3.text())
     btn_param3_set.clicked.connect(slot_btn_param3_set)
     def slot_btn_param3_plus():
         this_val = int(edit3.text())
@@ -879,95 +855,9 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
         slot_btn_param3_set()
     btn_param3_minus.clicked.connect(slot_btn_param3_minus)
 
-    #Muscle threshold With stimulation : Delt
-    paramMuscle0ThresWithStim = QLabel(f"Delt thres stim") # add a text
-    btn_paramMuscle0ThresWithStim_plus  = QPushButton("+")
-    btn_paramMuscle0ThresWithStim_minus = QPushButton("-")
-    btn_paramMuscle0ThresWithStim_set   = QPushButton("SET")
-    editMuscle0ThresWithStim = QLineEdit(f"{sharedConfig['emg_thresh_withStim'][0]:.7f}")
-    boxCalibWithEmg.addWidget(paramMuscle0ThresWithStim,9,0)
-    boxCalibWithEmg.addWidget(editMuscle0ThresWithStim,9,1)
-    boxCalibWithEmg.addWidget(btn_paramMuscle0ThresWithStim_plus,9,2)
-    boxCalibWithEmg.addWidget(btn_paramMuscle0ThresWithStim_minus,9,3)
-    boxCalibWithEmg.addWidget(btn_paramMuscle0ThresWithStim_set,9,4)
-    def slot_muscle0ThresWithStim_set():
-        new_val = float(editMuscle0ThresWithStim.text())
-        # can't edit directly nested elements from a manager object (like the dicts)
-        curr_values = sharedConfig['emg_thresh_withStim']
-        curr_values[0] = new_val
-        print(f"new val from gui is {new_val}")
-        sharedConfig['emg_thresh_withStim'] = curr_values
-        print(f"now in shared dict is its")
-        print(sharedConfig['emg_thresh_withStim'])
-        # update on graph
-        print(f"set {sharedConfig['emg_thresh_withStim'][0]} in shared dict, applying to line3")
-        try:
-            xaxis = np.array(range(0,previewData_size))
-            line9.set_data(xaxis, sharedConfig['emg_thresh_withStim'][0])
-            line9.figure.canvas.draw()
-        except:
-            print("failed")
-        print(f"new value is now { sharedConfig['emg_thresh_withStim'][0]}")
-    btn_paramMuscle0ThresWithStim_set.clicked.connect(slot_muscle0ThresWithStim_set)
-    def slot_muscle0ThresWithStim_plus():
-        this_muscle0ThresWithStim = float(editMuscle0ThresWithStim.text())
-        new_muscle0ThresWithStim = round( (this_muscle0ThresWithStim + 0.00001), 5)
-        print(f'muscle0ThresWithStim: set value from {this_muscle0ThresWithStim} to {new_muscle0ThresWithStim}')
-        editMuscle0ThresWithStim.setText(str(f"{new_muscle0ThresWithStim:.7f}"))
-        slot_muscle0ThresWithStim_set()
-    btn_paramMuscle0ThresWithStim_plus.clicked.connect(slot_muscle0ThresWithStim_plus)
-    def slot_muscle0ThresWithStim_minus():
-        this_muscle0ThresWithStim = float(editMuscle0ThresWithStim.text())
-        new_muscle0ThresWithStim = round( (this_muscle0ThresWithStim - 0.00001), 5)
-        print(f'muscle0ThresWithStim: set value from {this_muscle0ThresWithStim} to {new_muscle0ThresWithStim}')
-        editMuscle0ThresWithStim.setText(str(f"{new_muscle0ThresWithStim:.7f}"))
-        slot_muscle0ThresWithStim_set()
-    btn_paramMuscle0ThresWithStim_minus.clicked.connect(slot_muscle0ThresWithStim_minus)
-    
-    #Muscle threshold B : Bic
-    paramMuscle1ThresWithStim = QLabel(f"Bic thres stim")
-    btn_paramMuscle1ThresWithStim_plus  = QPushButton("+")
-    btn_paramMuscle1ThresWithStim_minus = QPushButton("-")
-    btn_paramMuscle1ThresWithStim_set   = QPushButton("SET")
-    editMuscle1ThresWithStim = QLineEdit(f"{sharedConfig['emg_thresh_withStim'][1]:.7f}")
-    boxCalibWithEmg.addWidget(paramMuscle1ThresWithStim,10,0)
-    boxCalibWithEmg.addWidget(editMuscle1ThresWithStim,10,1)
-    boxCalibWithEmg.addWidget(btn_paramMuscle1ThresWithStim_plus,10,2)
-    boxCalibWithEmg.addWidget(btn_paramMuscle1ThresWithStim_minus,10,3)
-    boxCalibWithEmg.addWidget(btn_paramMuscle1ThresWithStim_set,10,4)
-    def slot_muscle1ThresWithStim_set():
-        new_val = float(editMuscle1ThresWithStim.text())
-        # can't edit directly nested elements from a manager object (like the dicts)
-        curr_values = sharedConfig['emg_thresh_withStim']
-        curr_values[1] = new_val
-        print(f"new val from gui is {new_val}")
-        sharedConfig['emg_thresh_withStim'] = curr_values
-        print(f"now in shared dict is its")
-        print(sharedConfig['emg_thresh_withStim'])
-        # update on graph
-        print(f"set {sharedConfig['emg_thresh_withStim'][0]} in shared dict, applying to line5")
-        try:
-            xaxis = np.array(range(0,previewData_size))
-            line10.set_data(xaxis, sharedConfig['emg_thresh_withStim'][1])
-            line10.figure.canvas.draw()
-        except:
-            print("failed")
-        print(f"new value is now { sharedConfig['emg_thresh_withStim'][1]}")
-    btn_paramMuscle1ThresWithStim_set.clicked.connect(slot_muscle1ThresWithStim_set)
-    def slot_muscle1ThresWithStim_plus():
-        this_muscle1ThresWithStim = float(editMuscle1ThresWithStim.text())
-        new_muscle1ThresWithStim = round( (this_muscle1ThresWithStim + 0.00001), 5)
-        print(f'stimThresWithStim: set value from {this_muscle1ThresWithStim} to {new_muscle1ThresWithStim}')
-        editMuscle1ThresWithStim.setText(str(f"{new_muscle1ThresWithStim:.7f}"))
-        slot_muscle1ThresWithStim_set()
-    btn_paramMuscle1ThresWithStim_plus.clicked.connect(slot_muscle1ThresWithStim_plus)
-    def slot_muscle1ThresWithStim_minus():
-        this_muscle1ThresWithStim = float(editMuscle1ThresWithStim.text())
-        new_muscle1ThresWithStim = round( (this_muscle1ThresWithStim - 0.00001), 5)
-        print(f'muscle1ThresWithStim: set value from {this_muscle1ThresWithStim} to {new_muscle1ThresWithStim}')
-        editMuscle1ThresWithStim.setText(str(f"{new_muscle1ThresWithStim:.7f}"))
-        slot_muscle1ThresWithStim_set()
-    btn_paramMuscle1ThresWithStim_minus.clicked.connect(slot_muscle1ThresWithStim_minus)
+    #Muscle thresholds with stimulation
+    for i, muscle in enumerate(muscles):
+        addMuscleThres(boxCalibWithEmg, 9+i, i, 'emg_thresh_withStim', f"{muscle.capitalize()} thres stim")
 
     ###
     # Record
@@ -1037,25 +927,29 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
     numberPointsToUpdateGraph  = 50                  # disregarded : we get the whole available array. if we just update the last x values we might miss frames on the plot!
     previewData_size           = 6000                # number of points to plot in the graph (we take x latest values in corresponding emg array)
 
-    # Initialise our arrays
-    global previewData_DELT
-    global previewData_BIC
-    previewData_DELT = np.zeros(previewData_size)    # list with complete data before reduction
-    previewData_BIC  = np.zeros(previewData_size)
+    # Initialise our arrays (one row per muscle)
+    global previewData
+    previewData = np.zeros((len(muscles), previewData_size)) # list with complete data before reduction
 
-    # Prepare data
+    # Prepare data: for each muscle, its emg and its two thresholds (same color)
     xaxis     = np.array(range(0,previewData_size))
     data_zero = np.array([0] * previewData_size)     # data to plot, start with 0
-    line1,    = dynamic_ax.plot(xaxis, data_zero , color='red',   label='Emg_0 DELT'   )
-    line2,    = dynamic_ax.plot(xaxis, data_zero , color='blue',  label='Emg_1 BIC'    )
-    line3,    = dynamic_ax.plot(xaxis,  [  sharedConfig['emg_thresh_noStim'][0] ] * previewData_size, color='red',  linestyle='dashdot', label='DELT thresh')
-    line5,    = dynamic_ax.plot(xaxis,  [  sharedConfig['emg_thresh_noStim'][1] ] * previewData_size, color='blue', linestyle='dashdot', label='BIC thresh' )
-    #line4,    = dynamic_ax.plot(xaxis, data_zero , color='red',   label='DELT_max'     )
-    #line6,    = dynamic_ax.plot(xaxis, data_zero , color='blue',  label='BIC_max'      )
+    dataLines   = []
+    threshLines = {'emg_thresh_noStim': [], 'emg_thresh_withStim': []}
+    for i, muscle in enumerate(muscles):
+        color = muscleColors[i % len(muscleColors)]
+        line, = dynamic_ax.plot(xaxis, data_zero , color=color, label=f'Emg_{i} {muscle.upper()}')
+        dataLines.append(line)
+    for i, muscle in enumerate(muscles):
+        color = muscleColors[i % len(muscleColors)]
+        line, = dynamic_ax.plot(xaxis,  [  sharedConfig['emg_thresh_noStim'][i] ] * previewData_size, color=color, linestyle='dashdot', label=f'{muscle.upper()} thresh')
+        threshLines['emg_thresh_noStim'].append(line)
     line7,    = dynamic_ax.plot(xaxis,  [ +sharedConfig['stim_thresh'] ] * previewData_size , color='black', label='Stim Filter Thresh' )
     line8,    = dynamic_ax.plot(xaxis,  [ -sharedConfig['stim_thresh'] ] * previewData_size , color='black')
-    line9,    = dynamic_ax.plot(xaxis,  [  sharedConfig['emg_thresh_withStim'][0] ] * previewData_size , color='red',  linestyle='dotted', label='DELT thresh stim')
-    line10,   = dynamic_ax.plot(xaxis,  [  sharedConfig['emg_thresh_withStim'][1] ] * previewData_size , color='blue', linestyle='dotted', label='BIC thresh stim')
+    for i, muscle in enumerate(muscles):
+        color = muscleColors[i % len(muscleColors)]
+        line, = dynamic_ax.plot(xaxis,  [  sharedConfig['emg_thresh_withStim'][i] ] * previewData_size , color=color, linestyle='dotted', label=f'{muscle.upper()} thresh stim')
+        threshLines['emg_thresh_withStim'].append(line)
 
     # Pretty up the graph
     dynamic_ax.legend(loc='upper right')                # add the legends to the graph
@@ -1073,8 +967,7 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
                 
         global frameNumberPlot
         global timer
-        global previewData_DELT
-        global previewData_BIC
+        global previewData
         global streamTimeElapsed
 
         ###
@@ -1086,28 +979,22 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
             paramStimConnected2.setText(f"{sharedConfig['stim_connected']}")
             paramStimConnected2.setStyleSheet("QLabel{color: green;font-size:20px;font-family:'Orbitron'}")
         # also edit the text saying if one muscle or the other is active : biofeedback
-        if sharedConfig['active_delt']:
-            delt_activ_label2.setText(f"{sharedConfig['active_delt']}")
-            delt_activ_label2.setStyleSheet("QLabel{color: green;font-size:20px;font-family:'Orbitron'}")
-        else:
-            delt_activ_label2.setText(f"{sharedConfig['active_delt']}")
-            delt_activ_label2.setStyleSheet("QLabel{color: red;font-size:20px;font-family:'Orbitron'}")
-        if sharedConfig['active_bic']:
-            bic_activ_label2.setText(f"{sharedConfig['active_bic']}")
-            bic_activ_label2.setStyleSheet("QLabel{color: green;font-size:20px;font-family:'Orbitron'}")
-        else:
-            bic_activ_label2.setText(f"{sharedConfig['active_bic']}")
-            bic_activ_label2.setStyleSheet("QLabel{color: red;font-size:20px;font-family:'Orbitron'}")
+        for activ_label2, active in zip(activ_labels, sharedControl['emg_active']):
+            activ_label2.setText(f"{active}")
+            if active:
+                activ_label2.setStyleSheet("QLabel{color: green;font-size:20px;font-family:'Orbitron'}")
+            else:
+                activ_label2.setStyleSheet("QLabel{color: red;font-size:20px;font-family:'Orbitron'}")
         
         # and the controller value + pulse intensity
-        controller_value_label2.setText(f"{sharedConfig['controller_value']}")
-        if sharedConfig['controller_on']:
-            # if auto, the current pulse_intensity is max_allowed_intensity * sharedData['controller_value']
-            new_pulse_intensity = sharedConfig['controller_value'] * sharedConfig['stim_max_intensity']
-            pulse_intensity_label2.setText(f"{new_pulse_intensity:.3f}")
+        controller_value_label2.setText(f"{sharedControl['controller_value']}")
+        if sharedControl['controller_on']:
+            # if auto, the current pulse_intensity is max_allowed_intensity * sharedData['controller_value'] (for each stimulated muscle)
+            new_pulse_intensity = np.multiply(sharedControl['controller_value'], sharedControl['stim_max_intensity'])
+            pulse_intensity_label2.setText(", ".join(f"{value:.3f}" for value in new_pulse_intensity))
         else:
             # if mode manual, it is set manually in the editbox
-            pulse_intensity_label2.setText(f"{sharedConfig['pulse_intensity_man']}")
+            pulse_intensity_label2.setText(", ".join(str(value) for value in sharedControl['pulse_intensity_man']))
 
         # refresh rate of the plot
         if timer.interval != sharedConfig['gui_refresh_delay']:
@@ -1122,71 +1009,54 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
         ###
 
         # Here, we have to decide which data to get depending on what is asked in the gui : raw/rms/filtered
-        # we have already initialised previewData_BIC, now we want to replace it by taking the latest frames
+        # we have already initialised previewData, now we want to replace it by taking the latest frames
 
         # special case before emg has started streaming (takes typically 2 seconds)
         # we have initialised the plot with 0s
         #if len(sharedData['emg_raw_delt']) >= previewData_size:
         # edit : that would cause a delay to display 
         # options could be to
-            # a) concat what we get from sharedData to previewData_DELT, and remove len(previewData) values from the beginning of previewData_DELT
+            # a) concat what we get from sharedData to previewData, and remove len(previewData) values from the beginning of previewData
             # b) add the number of known frames into a the preview array
             # c) initialise the shared ones with 0s as well
             # --> going with a)
 
-        dataToAddToPreview_DELT = None
-        dataToAddToPreview_BIC  = None
+        dataToAddToPreview = None
 
-        # get the selected type
+        # get the selected type (all the muscles at once)
         if verbose: print(f"Asking for previewtype {sharedConfig['gui_preview_type']}")
         if sharedConfig['gui_preview_type'] == 'raw':
             
             if  debug: print(f"getting raw filtered")
-            dataToAddToPreview_DELT = sharedData['emg_delt_raw'][-sharedConfig['maxArraySize']:]
-            dataToAddToPreview_BIC  = sharedData['emg_bic_raw'][-sharedConfig['maxArraySize']:]
+            dataToAddToPreview = sharedData['emg_raw'].latest(sharedConfig['maxArraySize'])
 
         elif sharedConfig['gui_preview_type'] == 'filt':
             
             if  debug: print(f"getting filtered data")
-            dataToAddToPreview_DELT = sharedData['emg_delt_filt'][-sharedConfig['maxArraySize']:]
-            dataToAddToPreview_BIC  = sharedData['emg_bic_filt'][-sharedConfig['maxArraySize']:]
+            dataToAddToPreview = sharedData['emg_filt'].latest(sharedConfig['maxArraySize'])
 
         elif sharedConfig['gui_preview_type'] == 'rms':
             
             if  debug: print(f"getting rms")
-            dataToAddToPreview_DELT = sharedData['emg_delt_rms'][-sharedConfig['maxArraySize']:]
-            dataToAddToPreview_BIC  = sharedData['emg_bic_rms'][-sharedConfig['maxArraySize']:]
+            dataToAddToPreview = sharedData['emg_rms'].latest(sharedConfig['maxArraySize'])
 
-        if verbose: print(f"\nPlot: added {len(dataToAddToPreview_DELT)} values of {sharedConfig['gui_preview_type']}")
+        if verbose: print(f"\nPlot: added {dataToAddToPreview.shape[1]} values of {sharedConfig['gui_preview_type']}")
         
         # if it's at least the size of what data we want to preview, we take it
         
-        if len(dataToAddToPreview_DELT) >= previewData_size:
-            previewData_DELT = dataToAddToPreview_DELT
+        # (copy, the views on the shared rings will be overwritten by the other processes)
+        if dataToAddToPreview.shape[1] >= previewData_size:
+            previewData = np.array(dataToAddToPreview[:, -previewData_size:])
         # otherwise, we add 0s behind
         else:
-            previewData_DELT = np.concatenate( (np.zeros(previewData_size-len(dataToAddToPreview_DELT)),dataToAddToPreview_DELT), axis=0 )
-        if len(dataToAddToPreview_BIC) >= previewData_size:
-            previewData_BIC = dataToAddToPreview_BIC
-        # otherwise, we add 0s behind
-        else:
-            previewData_BIC  = np.concatenate( (np.zeros(previewData_size-len(dataToAddToPreview_BIC)), dataToAddToPreview_BIC),  axis=0 )
-        """
-        # we concatenate this to the previewData
-        previewData_DELT = np.concatenate( (previewData_DELT,dataToAddToPreview_DELT), axis=0 )
-        previewData_BIC  = np.concatenate( (previewData_BIC, dataToAddToPreview_BIC),  axis=0 )
-        
-        # we remove length of frame from beginning of array
-        previewData_DELT = previewData_DELT[len(dataToAddToPreview_DELT):]
-        previewData_BIC  = previewData_BIC[len(dataToAddToPreview_BIC):]
-        """
+            previewData = np.concatenate( (np.zeros((len(muscles), previewData_size-dataToAddToPreview.shape[1])), dataToAddToPreview), axis=1 )
 
         ###
         # Update graph with this current data
         ###
 
         behind_iters   = sharedConfig['emg_iter']        - sharedConfig['rms_iter']        # how many iterations behind is the filter from the raw delsys
-        behind_lengths = len(sharedData['emg_delt_raw']) - len(sharedData['emg_delt_rms']) # how many batches of data behind is the filter from the raw delsys
+        behind_lengths = sharedData['emg_raw'].cursor    - sharedData['emg_rms'].cursor    # how many samples behind is the filter from the raw delsys
         newTitle = f"iters: plot {frameNumberPlot}, emg: {sharedConfig['emg_iter']}, filter: {sharedConfig['filter_iter']}, rms: {sharedConfig['rms_iter']} ⇒ behind_iters {behind_iters}"
         dynamic_ax.set_title(newTitle)        
 
@@ -1197,9 +1067,11 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
         if sharedConfig['streamTimeStart']:
             streamTimeElapsed = round( (time.time() - sharedConfig['streamTimeStart']), 2)
         
-        if behind_iters>1:
+        # batches skipped by the filter/rms to get back to the latest one (stage_catchUp 'latest'), otherwise they catch up with all of them
+        skipped = sharedConfig['filter_skipped'] + sharedConfig['rms_skipped']
+        if behind_iters>1 or skipped:
             label_updateKeepup.setStyleSheet("QLabel{color: red;font-size:20px;font-family:'Orbitron'}")
-            label_updateKeepup.setText(f"Keeping up: RMS is behind RAW by {behind_iters} batches (t = {streamTimeElapsed}s)")
+            label_updateKeepup.setText(f"Keeping up: RMS is behind RAW by {behind_iters} batches, {skipped} batches skipped (t = {streamTimeElapsed}s)")
         else:
             label_updateKeepup.setStyleSheet("QLabel{color: green;font-size:20px;font-family:'Orbitron'}")
             label_updateKeepup.setText(f"Keeping up: RMS is up to date with RAW (t = { str(streamTimeElapsed).zfill(2)}s )")
@@ -1213,21 +1085,15 @@ def functionLivePlot(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbo
 
             timesHalf = sharedConfig['gui_downsample'] # number of time to reduce data by half
 
-            # emg0
-            line1.set_data(downSampleData(xaxis,times=timesHalf), downSampleData(previewData_DELT,times=timesHalf))
-            line1.figure.canvas.draw()
-            # emg1
-            line2.set_data(downSampleData(xaxis,times=timesHalf), downSampleData(previewData_BIC,times=timesHalf))
-            line2.figure.canvas.draw()            
+            for line, this_previewData in zip(dataLines, previewData):
+                line.set_data(downSampleData(xaxis,times=timesHalf), downSampleData(this_previewData,times=timesHalf))
+            dynamic_canvas.draw()
 
         # or full sample
         else:
-            # emg0
-            line1.set_data(xaxis, previewData_DELT)
-            line1.figure.canvas.draw()
-            # emg1
-            line2.set_data(xaxis, previewData_BIC)
-            line2.figure.canvas.draw()
+            for line, this_previewData in zip(dataLines, previewData):
+                line.set_data(xaxis, this_previewData)
+            dynamic_canvas.draw()
         
         return
 
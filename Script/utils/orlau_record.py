@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binary recording of the data streams of a session
+
+Each stream (raw, filt, rms, activity, controller, imu) is saved in its own append-only file:
+    - an 8 bytes magic string and the length of the header (uint32 little-endian)
+    - a JSON header describing the stream: dtype, number of channels, channel names, sample rate,
+      start time, plus any extra information given by the writer (e.g. the imu channel map)
+    - then the samples, float32 little-endian, one record of 'channels' values per sample: each
+      batch (channels x samples, as in the shared rings) is transposed once and written with a
+      single write() call
+
+The data starts at a multiple of 64 bytes, so the file can be memory-mapped as is, and a file
+cut by a crash only loses its last incomplete sample.
+"""
+
+import sys, os, copy, time
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))     # get current directory variable
+sys.path.append(CURR_DIR)                                  # load from the utils directory
+
+import json
+import struct
+import numpy as np
+
+MAGIC       = b'ORLREC\x00\x01' # format name and version
+ALIGNMENT   = 64                # the samples start at a multiple of this offset
+EXTENSION   = '.bin'
+
+class RecordWriter(object):
+    """
+    Append-only binary file of one data stream.
+
+    Parameters
+    ----------
+    path : str
+        File to create (overwritten if it exists).
+    channels : int
+        Number of channels (rows of the batches).
+    rate : float
+        Sample rate in Hz.
+    names : list of str, optional
+        Name of each channel (e.g. the muscles).
+    start_time : float, optional
+        Time (time.time()) of the first sample, now if None.
+    meta : dict, optional
+        Extra information saved in the header (must be JSON serialisable).
+    dtype : str, optional
+        Numpy dtype of the samples on disk.
+    """
+
+    def __init__(self, path, channels, rate, names=None, start_time=None, meta=None, dtype='<f4'):
+        self.path     = path
+        self.channels = channels
+        self.dtype    = np.dtype(dtype)
+        self.samples  = 0
+
+        self.header = {
+            'dtype'      : self.dtype.str,
+            'channels'   : channels,
+            'names'      : list(names) if names is not None else None,
+            'rate'       : rate,
+            'start_time' : time.time() if start_time is None else start_time,
+            }
+        if meta:
+            self.header.update(meta)
+
+        # unbuffered: each batch goes to the OS in one write() call, nothing is left in a python buffer if the process dies
+        self._fp = open(path, 'wb', buffering=0)
+        write_all(self._fp, encode_header(self.header))
+
+    def write(self, batch):
+        """
+        Append a batch of samples.
+
+        Parameters
+        ----------
+        batch : ndarray, shape=(channels, n) or (n,) for a single channel stream
+            New samples.
+        """
+        batch = np.asarray(batch)
+        if batch.ndim == 1:
+            batch = batch[None, :]
+        buffer = np.ascontiguousarray(batch.T, dtype=self.dtype) # samples x channels
+        end    = self._fp.tell()
+        try:
+            write_all(self._fp, buffer)
+        except OSError:
+            # remove the part of the batch that was written: the file ends with the last whole batch
+            self._fp.seek(end)
+            self._fp.truncate()
+            raise
+        self.samples += buffer.shape[0]
+
+    def sync(self):
+        """
+        Make sure the samples written so far are on the disk (fsync), not only in the OS cache.
+        """
+        os.fsync(self._fp.fileno())
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_all(fp, data):
+    """
+    Write all of data to an unbuffered file, whose write() may write only part of it
+    (interrupted by a signal, disk full). OSError if nothing more can be written.
+    """
+    view = memoryview(data).cast('B')
+    while view.nbytes:
+        written = fp.write(view)
+        if not written:
+            raise OSError(f"{fp.name}: {view.nbytes} bytes could not be written")
+        view = view[written:]
+
+
+def is_record(path):
+    """
+    True if the file is a recorded stream (other .bin files of a session folder, e.g. the log of
+    the simulated stimulator of older sessions, start with another magic).
+    """
+    with open(path, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def encode_header(header, magic=MAGIC):
+    """
+    Bytes preceding the samples: magic, header length, JSON header padded with spaces to ALIGNMENT.
+    """
+    text   = json.dumps(header).encode('utf-8')
+    length = len(magic) + 4 + len(text)
+    text  += b' ' * (-length % ALIGNMENT)
+    return magic + struct.pack('<I', len(text)) + text
+
+
+def read_header(path, magic=MAGIC):
+    """
+    Header of a recorded stream (or of another file starting with encode_header and this magic).
+
+    Returns
+    -------
+    header : dict
+        Content of the JSON header.
+    offset : int
+        Position of the first sample in the file.
+    """
+    with open(path, 'rb') as fp:
+        if fp.read(len(magic)) != magic:
+            raise ValueError(f"{path} is not a recorded stream")
+        length = struct.unpack('<I', fp.read(4))[0]
+        header = json.loads(fp.read(length).decode('utf-8'))
+    return header, len(magic) + 4 + length
+
+
+def load_record(path, mmap=False):
+    """
+    Load a recorded stream.
+
+    Parameters
+    ----------
+    path : str
+        File written by RecordWriter.
+    mmap : bool, optional
+        Map the file instead of reading it (read-only, nothing is loaded until accessed).
+
+    Returns
+    -------
+    data : ndarray, shape=(channels, samples)
+        Samples of each channel (a transposed view: channel rows are strided).
+    header : dict
+        Content of the JSON header.
+    """
+    header, offset = read_header(path)
+    dtype    = np.dtype(header['dtype'])
+    channels = header['channels']
+    # ignore a last sample cut by a crash
+    samples  = (os.path.getsize(path) - offset) // (dtype.itemsize * channels)
+    if mmap:
+        data = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(samples, channels))
+    else:
+        data = np.fromfile(path, dtype=dtype, count=samples*channels, offset=offset).reshape(samples, channels)
+    return data.T, header
+
+
+if __name__ == "__main__":
+
+    print("orlau_record loaded as main")
+
+    ###
+    # Compare with the text files: write time and size of a 2 muscles stream
+    ###
+
+    import tempfile
+
+    samples_per_read = 300
+    batches          = 500
+    channels         = 2
+    rng              = np.random.default_rng(0)
+    data             = rng.normal(0, 0.0003, (channels, samples_per_read*batches))
+
+    folder = tempfile.mkdtemp()
+
+    t0 = time.perf_counter()
+    with open(folder+'/data_raw.txt', 'ab') as fp:
+        for i in range(batches):
+            np.savetxt(fp, data[:, i*samples_per_read:(i+1)*samples_per_read].T, delimiter=',')
+    t_txt = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with RecordWriter(folder+'/data_raw'+EXTENSION, channels, 2000, names=['deltoid','biceps']) as writer:
+        for i in range(batches):
+            writer.write(data[:, i*samples_per_read:(i+1)*samples_per_read])
+    t_bin = time.perf_counter() - t0
+
+    loaded, header = load_record(folder+'/data_raw'+EXTENSION)
+    assert loaded.shape == data.shape and np.array_equal(loaded, data.astype('<f4')), "binary record does not match"
+    mapped, _      = load_record(folder+'/data_raw'+EXTENSION, mmap=True)
+    assert np.array_equal(mapped, loaded)
+
+    # short writes (signal): the rest is written. Disk full: error, and the file still ends with the last whole batch
+    class ShortWrites(object):
+        def __init__(self, fp, limit):
+            self.fp, self.name, self.limit = fp, fp.name, limit
+        def write(self, data):
+            written     = min(self.limit, memoryview(data).nbytes, 1000)
+            self.limit -= written
+            return self.fp.write(memoryview(data)[:written])
+        def __getattr__(self, key):
+            return getattr(self.fp, key)
+    with RecordWriter(folder+'/data_short'+EXTENSION, channels, 2000) as writer:
+        writer._fp = ShortWrites(writer._fp, 10**9)
+        writer.write(data[:, :1000])
+        writer._fp.limit = 3000
+        try:
+            writer.write(data[:, 1000:2000])
+            raise AssertionError("no error when the disk is full")
+        except OSError:
+            pass
+    short, _ = load_record(folder+'/data_short'+EXTENSION)
+    assert writer.samples == 1000 and np.array_equal(short, data[:, :1000].astype('<f4'))
+
+    # a crash in the middle of a sample: only that sample is lost
+    with open(folder+'/data_raw'+EXTENSION, 'ab') as fp:
+        fp.write(b'\x00\x00')
+    assert load_record(folder+'/data_raw'+EXTENSION)[0].shape == data.shape
+
+    size_txt = os.path.getsize(folder+'/data_raw.txt')
+    size_bin = os.path.getsize(folder+'/data_raw'+EXTENSION)
+    print(f"header: {header}")
+    print(f"write {batches} batches: text {t_txt*1000:.1f} ms, binary {t_bin*1000:.1f} ms ({t_txt/t_bin:.1f}x faster)")
+    print(f"size: text {size_txt/1e6:.2f} MB, binary {size_bin/1e6:.2f} MB ({size_txt/size_bin:.1f}x smaller)")
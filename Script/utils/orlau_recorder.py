@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+recorder: the only process writing the data streams to disk
+
+The acquisition and processing stages only append their batches to the shared rings: this
+process follows each ring with its own cursor, and every 'record_flushInterval' seconds writes
+everything that is new, one large write() per stream, either as chunks of the single session.orl
+container with the batch index of each stream (see orlau_session), or to one data_*.bin file
+per stream (see orlau_record) if 'record_container' is False.
+In the container, the piecewise-constant streams of 'record_events' (activity, controller value,
+pulse intensity: one value per batch) are saved as their changes of value only, and the streams of
+'record_compress' (imu) are compressed chunk by chunk in a background thread of this process, so
+that compressing them never delays the writes of the other streams.
+A slow disk (or an antivirus scan) then only delays the recording, never the acquisition or
+the controller, as long as it does not last longer than the rings can hold ('record_maxBacklog').
+
+The backlog (data not written yet, in seconds) and the number of samples lost because a ring
+was overwritten before we could write it are published in sharedConfig for the monitor.
+
+Every 'record_manifestInterval' seconds, manifest.json is replaced (atomically) with a snapshot of
+the configuration, the samples written of each stream and the last batch written in all of them:
+if live.py dies before saving conf_sharedConfig.*, or the recorder before closing session.orl,
+orlau_recover rebuilds them from there.
+"""
+
+# Reset the vars at run if using ipython-based IDE if in main
+if __name__ == "__main__":
+    try:
+        from IPython import get_ipython
+        get_ipython().run_line_magic('reset', '-sf')
+    except: pass
+
+import sys, os, copy, time
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))     # get current directory variable
+sys.path.append(CURR_DIR)                                  # load from the utils directory
+
+from time import sleep
+import queue
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from orlau_utils import showTitle, printColor, show
+from orlau_record import RecordWriter
+from orlau_session import SessionWriter, BATCH_DTYPE, EXTENSION, last_consistent, write_manifest
+
+class StreamRecorder(object):
+    """
+    Follows one shared ring and appends its new samples to the session
+    container (with the index of its batches), or to a RecordWriter.
+
+    The stream is only declared (or its file created) when the first samples
+    arrive, so that the streams whose channels are only known once connected
+    (imu) can be opened.
+
+    Parameters
+    ----------
+    ring : SharedRing
+        Ring to record.
+    name : str
+        Name of the stream in the container, or file to write if session is None.
+    rate : float
+        Sample rate in Hz.
+    rows : list of int, optional
+        Rows of the ring to record, all of them if None.
+    names : list of str, optional
+        Name of each recorded channel.
+    meta : dict, optional
+        Extra information saved in the header.
+    session : SessionWriter, optional
+        Container to write to.
+    clock : str, optional
+        Save the stream as events (changes of value) in the container, with
+        the times of the batches of this other stream.
+    compression : str, optional
+        Compress the chunks of the stream in the container ('zdelta', see
+        orlau_session), from a background thread.
+    queue_size : int, optional
+        Writes waiting for the background thread at most: beyond, the samples
+        are left in the ring until it catches up (and counted in the backlog).
+    """
+
+    def __init__(self, ring, name, rate, rows=None, names=None, meta=None, session=None, clock=None, compression=None, queue_size=4):
+        self.ring        = ring
+        self.reader      = ring.reader(0)
+        self.name        = name
+        self.rate        = rate
+        self.rows        = rows
+        self.names       = names
+        self.meta        = meta
+        self.session     = session
+        self.clock       = clock
+        self.compression = compression if session is not None else None
+        self.writer      = None
+        self.queue_size  = queue_size
+        self._queue      = None   # batches waiting to be compressed and written by the thread
+        self._thread     = None
+        self._lock       = threading.Lock()
+        self._queued     = 0      # samples read from the ring and not written by the thread yet
+        self.batches     = 0      # batches of the ring already indexed
+        self.failed      = 0      # samples the thread failed to write (counted in dropped)
+
+    @property
+    def dropped(self):
+        """
+        Samples lost: overwritten in the ring before being read, or that the background thread failed to write.
+        """
+        return self.reader.dropped + self.failed
+
+    def backlog(self):
+        """
+        Data written in the ring and not on disk yet (including what waits for
+        the background thread), in seconds.
+        """
+        with self._lock:
+            queued = self._queued
+        return (self.reader.pending() + queued) / self.rate
+
+    def write(self, wait=False):
+        """
+        Write all the new samples of the ring in one write() call.
+
+        Parameters
+        ----------
+        wait : bool, optional
+            If the queue of the background thread is full, wait for it instead
+            of leaving the samples in the ring until the next call.
+
+        Returns
+        -------
+        samples : int
+            Number of samples written (or queued).
+        """
+        if self.reader.pending() <= 0:
+            return 0
+        if self._queue is not None and self._queue.full() and not wait:
+            return 0
+        dropped = self.reader.dropped
+        batch   = self.reader.read()
+        start   = self.reader.cursor - batch.shape[1]
+        batch   = np.array(batch if self.rows is None else batch[self.rows]) # copy out of the shared memory before the producer reaches it
+
+        # the producer may have overwritten the beginning of what we have just copied
+        lost = self.ring.cursor - self.ring.capacity - start
+        if lost > 0:
+            batch               = batch[:, lost:]
+            self.reader.dropped += lost
+        if self.reader.dropped > dropped:
+            printColor(f"recorder: {self.reader.dropped - dropped} samples of {os.path.basename(self.name)} overwritten before being written", 'red')
+
+        if self.writer is None:
+            channels    = batch.shape[0]
+            start_time  = time.time() - (self.ring.cursor - start) / self.rate
+            if self.session is not None:
+                encoding    = 'events' if self.clock is not None else 'samples'
+                self.session.add_stream(self.name, channels, self.rate, names=self.names, start_time=start_time, meta=self.meta, encoding=encoding, clock=self.clock, compression=self.compression)
+                self.writer = self.session
+            else:
+                self.writer = RecordWriter(self.name, channels, self.rate, names=self.names, start_time=start_time, meta=self.meta)
+
+        if self.session is not None:
+            # index of the batches published since the last write (batch number = iter of the stage that appended them)
+            numbers, stops, times = self.ring.batch_log(self.batches)
+            batches               = np.zeros(len(numbers), dtype=BATCH_DTYPE)
+            batches['batch'], batches['stop'], batches['time'] = numbers, stops, times
+            if len(numbers):
+                self.batches      = int(numbers[-1]) + 1
+            if self.compression is None:
+                self.session.write(self.name, batch, start=self.reader.cursor - batch.shape[1], batches=batches)
+            else:
+                if self._thread is None:
+                    self._queue  = queue.Queue(maxsize=self.queue_size)
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+                with self._lock:
+                    self._queued += batch.shape[1]
+                self._queue.put((batch, self.reader.cursor - batch.shape[1], batches)) # already copied out of the shared memory
+        else:
+            self.writer.write(batch)
+        return batch.shape[1]
+
+    def _run(self):
+        # background thread: compress and write the batches in the order they were read
+        # (a write that fails loses its samples, counted in dropped, but not the next ones)
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch, start, batches = item
+            try:
+                self.session.write(self.name, batch, start=start, batches=batches)
+            except Exception as error:
+                self.failed += batch.shape[1]
+                printColor(f"recorder: could not write {batch.shape[1]} samples of {self.name}: {error!r}", 'red')
+            finally:
+                with self._lock:
+                    self._queued -= batch.shape[1]
+
+    def samples(self):
+        """
+        Samples of the stream written so far (in the container: after the last one written).
+        """
+        if self.writer is None:
+            return 0
+        if self.session is not None:
+            return self.session.streams[self.name]['samples']
+        return self.writer.samples
+
+    def sync(self):
+        if self.writer is not None and self.session is None:
+            self.writer.sync()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+        if self.writer is not None and self.session is None:
+            self.writer.sync()
+            self.writer.close()
+
+
+def funcRecorder(sharedConfig, sharedData, sharedControl=None, verbose=False, debug=False):
+
+    folder  = sharedConfig['dataSaveFolder']
+    muscles = list(sharedConfig['emg_muscles_names'])
+    rate    = sharedConfig['rms_analogFreq']
+
+    # one container for all the streams (named after their ring), or one file per stream
+    session = None
+    if sharedConfig['record_container']:
+        session = SessionWriter(folder+'/session.orl', meta={'config': sharedConfig.copy()})
+    def target(key):
+        return key if session is not None else folder+'/'+sharedConfig['record_streams'][key]+'.bin'
+
+    # streams of the emg/controller (rings filled at each batch of the emg)
+    recorders = OrderedDict()
+    for key in sharedConfig['record_streams']:
+        if key == 'imu_all':
+            continue
+        names = muscles if sharedData[key].channels == len(muscles) else None
+        if key == 'pulse_val_hist':
+            names = list(sharedConfig['stim_musclesName'])
+        clock = sharedConfig['record_events'].get(key) if session is not None else None
+        recorders[key] = StreamRecorder(sharedData[key], target(key), rate, names=names, session=session, clock=clock,
+                                        compression='zdelta' if key in sharedConfig['record_compress'] else None)
+
+    flushInterval    = sharedConfig['record_flushInterval']
+    fsyncInterval    = sharedConfig['record_fsyncInterval']
+    manifestInterval = sharedConfig['record_manifestInterval']
+    lastSync         = time.time()
+    lastManifest     = time.time()
+
+    def record(wait=False):
+        # the imu channels and rate are only known once the imu process has connected
+        if 'imu_all' in sharedConfig['record_streams'] and 'imu_all' not in recorders and sharedConfig['imu_channels']:
+            recorders['imu_all'] = StreamRecorder(sharedData['imu_all'], target('imu_all'), sharedConfig['imu_rate'],
+                                                  rows=sharedConfig['imu_channels'], meta={'imu_channels': sharedConfig['imu_channels']}, session=session,
+                                                  compression='zdelta' if 'imu_all' in sharedConfig['record_compress'] else None)
+        backlog = max([recorder.backlog() for recorder in recorders.values()])
+        written = 0
+        for recorder in recorders.values():
+            written += recorder.write(wait=wait)
+        sharedConfig['record_backlog'] = round(backlog, 3)
+        sharedConfig['record_dropped'] = sum([recorder.dropped for recorder in recorders.values()])
+        if debug: print(f"# recorder: backlog {backlog:.3f}s, wrote {written} samples")
+
+    def manifest(closed=False):
+        config = sharedConfig.copy()
+        if sharedControl is not None:
+            config.update(sharedControl.snapshot())
+        counts         = OrderedDict((key, (recorder.rate, recorder.samples())) for key, recorder in recorders.items() if recorder.writer is not None)
+        batch, samples = last_consistent(counts, sharedConfig['samples_per_read'])
+        write_manifest(folder, {
+            'time'       : time.time(),
+            'closed'     : closed,
+            'container'  : 'session'+EXTENSION if session is not None else None,
+            'config'     : config,
+            'streams'    : OrderedDict((key, {'file': os.path.basename(recorder.name) if session is None else None, 'rate': recorder.rate,
+                                              'samples': recorder.samples(), 'dropped': recorder.dropped}) for key, recorder in recorders.items() if recorder.writer is not None),
+            'consistent' : {'batch': batch, 'samples': samples},
+            })
+
+    iRecord = 0
+    while not (sharedConfig['emg_shutdown'] and sharedConfig['imu_shutdown']):
+
+        # sleep between the writes, so that each of them gathers all the batches received meanwhile
+        sleep(flushInterval)
+        record()
+
+        # fsync policy: never (None), after every write (0), or every fsyncInterval seconds
+        if fsyncInterval is not None and time.time() - lastSync >= fsyncInterval:
+            for recorder in recorders.values():
+                recorder.sync()
+            if session is not None:
+                session.sync()
+            lastSync = time.time()
+
+        if manifestInterval is not None and time.time() - lastManifest >= manifestInterval:
+            manifest()
+            lastManifest = time.time()
+
+        iRecord += 1
+
+    # Graceful exit: the stages finish their current batch, then we write what is left and close the files
+    sleep(flushInterval)
+    record(wait=True) # everything left, even if a background thread is behind
+    for recorder in recorders.values():
+        recorder.close()
+    if session is not None:
+        session.close()
+    manifest(closed=True)
+    if verbose: print(f"recorder: goodbye ({sharedConfig['record_dropped']} samples dropped)")
+
+if __name__ == "__main__":
+
+    print("orlau_recorder loaded as main")
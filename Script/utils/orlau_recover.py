@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Recovery of the sessions interrupted by a crash
+
+If the recorder dies before closing session.orl, the container has no index, and its last chunk may be
+cut; if live.py dies before its end, conf_sharedConfig.* are never written. This tool repairs such
+session folders from what is on the disk and from the manifest kept by the recorder (see orlau_recorder):
+
+    python orlau_recover.py                         # every session of Script/Data that needs it
+    python orlau_recover.py ../Data/A_test1_...     # some session folders
+
+    - the chunk cut by the crash is removed, and the streams at the rate of the emg (raw, filt, rms,
+      activity, controller...) are ended at the last batch that all of them have, the imu at the time
+      of that batch; the index of the container is then written as when closing it
+    - with one data_*.bin file per stream, the files are truncated the same way; the text files of the
+      older sessions are truncated after their last complete line
+    - manifest.json is rebuilt with the samples kept, and conf_sharedConfig.json/pickle are written from
+      the configuration of the manifest (or of the container) if they are missing
+
+Only the last batch is lost, and the container is only scanned once (a few seconds for hours of data).
+Do not run it on the session being recorded: it would be seen as interrupted.
+"""
+
+# Reset the vars at run if using ipython-based IDE if in main
+if __name__ == "__main__":
+    try:
+        from IPython import get_ipython
+        get_ipython().run_line_magic('reset', '-sf')
+    except: pass
+
+import sys, os, copy, time, json
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))     # get current directory variable
+sys.path.append(CURR_DIR)                                  # load from the utils directory
+
+import pickle
+import argparse
+import numpy as np
+from collections import OrderedDict
+
+from orlau_session import SessionWriter, SessionFile, BATCH_DTYPE, EXTENSION, last_consistent, read_manifest, write_manifest
+from orlau_record import read_header, is_record
+from orlau_utils import showTitle, printColor, show
+
+def _cut_time(batches, samples):
+    """
+    Time of the end of the batch ending at sample 'samples', None if not in the index.
+    """
+    found = np.flatnonzero(batches['stop'] == samples)
+    return float(batches['time'][found[-1]]) if len(found) else None
+
+def _cut_samples(batches, t, samples):
+    """
+    Samples of a stream (at another rate) published up to time t, from its batch index.
+    """
+    if t is None or len(batches) == 0:
+        return samples
+    before = batches['stop'][batches['time'] <= t]
+    return min(samples, int(before[-1])) if len(before) else 0
+
+
+def recover_container(path, samples_per_read):
+    """
+    Truncate the streams of a container that was not closed at their last consistent batch, and close it.
+
+    Returns
+    -------
+    streams : OrderedDict
+        For each stream: (samples found, samples kept). None if the container was closed.
+    batch : int
+        Last consistent batch.
+    """
+    session = SessionFile(path)
+    if session.complete:
+        session.close()
+        return None, None
+    counts         = OrderedDict((name, (stream['header']['rate'], stream['samples'])) for name, stream in session.streams.items())
+    batch, samples = last_consistent(counts, samples_per_read)
+    rate           = max([r for r, _ in counts.values()]) if counts else None
+    batches        = OrderedDict((name, np.array(session._table(name, 'batches', BATCH_DTYPE))) for name in session.streams)
+
+    # time of the end of the last consistent batch, to cut the streams at other rates (imu)
+    t = None
+    for name, (r, _) in counts.items():
+        if r == rate and t is None:
+            t = _cut_time(batches[name], samples)
+
+    writer  = SessionWriter.reopen(session) # also removes the chunk cut by the crash
+    streams = OrderedDict()
+    for name, (r, n) in counts.items():
+        cut = samples if r == rate else _cut_samples(batches[name], t, n)
+        writer.truncate(name, cut)
+        streams[name] = (n, min(n, cut))
+    writer.close()
+    return streams, batch
+
+
+def recover_records(folder, samples_per_read, names):
+    """
+    Truncate the data_*.bin files of a session (one per stream) at their last consistent batch.
+
+    Returns
+    -------
+    streams : OrderedDict
+        For each stream: (samples found, samples kept).
+    batch : int
+        Last consistent batch.
+    """
+    files = OrderedDict()
+    for fileName in sorted(os.listdir(folder)):
+        if fileName.endswith('.bin') and is_record(os.path.join(folder, fileName)):
+            header, offset = read_header(os.path.join(folder, fileName))
+            sampleSize     = np.dtype(header['dtype']).itemsize * header['channels']
+            samples        = (os.path.getsize(os.path.join(folder, fileName)) - offset) // sampleSize
+            files[names.get(fileName[:-len('.bin')], fileName[:-len('.bin')])] = (fileName, header, offset, sampleSize, samples)
+    counts         = OrderedDict((name, (header['rate'], samples)) for name, (_, header, _, _, samples) in files.items())
+    batch, samples = last_consistent(counts, samples_per_read)
+    rate           = max([r for r, _ in counts.values()]) if counts else None
+
+    streams = OrderedDict()
+    for name, (fileName, header, offset, sampleSize, n) in files.items():
+        # no batch index in those files: the imu only loses its incomplete sample
+        cut = min(n, samples) if header['rate'] == rate else n
+        os.truncate(os.path.join(folder, fileName), offset + cut * sampleSize)
+        streams[name] = (n, cut)
+    return streams, batch
+
+
+def recover_text(folder):
+    """
+    Remove the incomplete last line of the data_*.txt files of an older session.
+
+    Returns
+    -------
+    streams : OrderedDict
+        For each file: (lines found, lines kept).
+    """
+    streams = OrderedDict()
+    for fileName in sorted(os.listdir(folder)):
+        if not (fileName.startswith('data_') and fileName.endswith('.txt')):
+            continue
+        path = os.path.join(folder, fileName)
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fp:
+            lines = sum([block.count(b'\n') for block in iter(lambda: fp.read(1 << 20), b'')])
+            # position after the last end of line, looking back from the end of the file
+            end = size
+            while end > 0:
+                fp.seek(max(0, end - 4096))
+                block = fp.read(end - max(0, end - 4096))
+                if b'\n' in block:
+                    end = end - len(block) + block.rindex(b'\n') + 1
+                    break
+                end = max(0, end - 4096)
+        if end < size:
+            os.truncate(path, end)
+        streams[fileName] = (lines + (end < size), lines)
+    return streams
+
+
+def needs_recovery(folder):
+    """
+    True if a session folder was not closed properly: container without index, manifest not closed,
+    or configuration not saved.
+    """
+    path = os.path.join(folder, 'session'+EXTENSION)
+    if os.path.exists(path):
+        with SessionFile(path) as session:
+            if not session.complete:
+                return True
+    manifest = read_manifest(folder)
+    if manifest is not None and not manifest.get('closed'):
+        return True
+    return manifest is not None and not os.path.exists(os.path.join(folder, 'conf_sharedConfig.json'))
+
+
+def recover_session(folder):
+    """
+    Repair a session folder (see the module description).
+
+    Returns
+    -------
+    result : dict
+        'folder', 'streams' (samples found and kept of each stream), 'batch' (last consistent batch),
+        'config' (True if conf_sharedConfig.* were rebuilt), 'time' (s).
+    """
+    tic      = time.perf_counter()
+    manifest = read_manifest(folder) or {}
+    config   = manifest.get('config')
+    path     = os.path.join(folder, 'session'+EXTENSION)
+    result   = {'folder': folder, 'streams': OrderedDict(), 'batch': None, 'config': False, 'time': 0}
+
+    if config is None and os.path.exists(path):
+        with SessionFile(path) as session:
+            config = session.meta.get('config')
+    if config is None and os.path.exists(folder+'/conf_sharedConfig.json'):
+        with open(folder+'/conf_sharedConfig.json') as fp:
+            config = json.load(fp)
+    config           = config or {}
+    samples_per_read = config.get('samples_per_read', 300)
+
+    if os.path.exists(path):
+        streams, batch = recover_container(path, samples_per_read)
+        if streams is None: # closed: only the manifest/configuration are missing
+            with SessionFile(path) as session:
+                counts         = OrderedDict((name, (stream['header']['rate'], stream['samples'])) for name, stream in session.streams.items())
+                streams        = OrderedDict((name, (n, n)) for name, (_, n) in counts.items())
+                batch, _       = last_consistent(counts, samples_per_read)
+    elif any([fileName.endswith('.bin') and is_record(os.path.join(folder, fileName)) for fileName in os.listdir(folder)]):
+        names          = {fileName: key for key, fileName in config.get('record_streams', {}).items()}
+        streams, batch = recover_records(folder, samples_per_read, names)
+    else:
+        streams, batch = recover_text(folder), None
+    result['streams'], result['batch'] = streams, batch
+
+    # manifest of what is kept, and the configuration files that live.py did not write
+    write_manifest(folder, {
+        'time'       : time.time(),
+        'closed'     : True,
+        'recovered'  : True,
+        'container'  : 'session'+EXTENSION if os.path.exists(path) else None,
+        'config'     : config,
+        'streams'    : OrderedDict((name, {'samples': kept, 'lost': found - kept}) for name, (found, kept) in streams.items()),
+        'consistent' : {'batch': batch, 'samples': None if batch is None else (batch + 1) * samples_per_read},
+        })
+    if config and not os.path.exists(folder+'/conf_sharedConfig.json'):
+        with open(folder+'/conf_sharedConfig.pickle', 'wb') as fp:
+            pickle.dump(config, fp)
+        with open(folder+'/conf_sharedConfig.json', 'w') as fp:
+            json.dump(config, fp)
+        result['config'] = True
+    result['time'] = time.perf_counter() - tic
+    return result
+
+
+def find_sessions(paths):
+    """
+    Session folders to recover among paths (session folders or folders of sessions, e.g. Script/Data).
+    """
+    folders = []
+    for path in paths:
+        if not os.path.isdir(path):
+            printColor(f"recover: {path} is not a folder", 'red')
+            continue
+        subs = [path] + [os.path.join(path, name) for name in sorted(os.listdir(path))]
+        folders += [sub for sub in subs if os.path.isdir(sub) and needs_recovery(sub)]
+    return folders
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Recover the sessions interrupted by a crash")
+    parser.add_argument('paths',  nargs='*', default=[os.path.join(CURR_DIR, '..', 'Data')], help="session folders, or folders of sessions (default: Script/Data)")
+    parser.add_argument('--test', action='store_true', help="recover a generated crashed session and check it")
+    args = parser.parse_args()
+
+    if args.test:
+
+        ###
+        # A recording killed in the middle of a chunk, after writing its manifest, without conf_sharedConfig.*
+        ###
+
+        import tempfile
+
+        folder = tempfile.mkdtemp()
+        t0     = time.time()
+        rng    = np.random.default_rng(0)
+        emg    = rng.normal(0, 0.0003, (2, 300*200)).astype('<f4')
+        imu    = rng.normal(0, 1, (6, 27*200)).astype('<f4')
+        writer = SessionWriter(folder+'/session'+EXTENSION, meta={'config': {'samples_per_read': 300}}, start_time=t0)
+        writer.add_stream('emg_raw', 2, 2000, start_time=t0)
+        writer.add_stream('emg_rms', 2, 2000, start_time=t0)
+        writer.add_stream('activ_hist', 2, 2000, encoding='events', clock='emg_rms', start_time=t0)
+        writer.add_stream('imu_all', 6, 148.1, start_time=t0)
+        for i in range(0, 200, 4):
+            last    = i + (3 if i == 196 else 4) # the rms stage is one batch late when the recorder dies
+            batches = np.array([(k, (k+1)*300, t0 + (k+1)*0.15) for k in range(i, i+4)], dtype=BATCH_DTYPE)
+            writer.write('emg_raw',    emg[:, i*300:(i+4)*300], batches=batches)
+            writer.write('emg_rms',    emg[:, i*300:last*300],  batches=batches[:last-i])
+            writer.write('activ_hist', emg[:, i*300:last*300] > 0)
+            writer.write('imu_all',    imu[:, i*27:(i+4)*27],   batches=np.array([(k, (k+1)*27, t0 + (k+1)*0.15 - 0.01) for k in range(i, i+4)], dtype=BATCH_DTYPE))
+            if i == 100:
+                write_manifest(folder, {'closed': False, 'config': {'samples_per_read': 300, 'session_name': 'test'}})
+        writer._fp.write(b'DATA' + b'\x00' * 30) # killed while writing a chunk header
+        writer._fp.close()
+
+        assert find_sessions([folder]) == [folder]
+        result = recover_session(folder)
+        with SessionFile(folder) as session:
+            assert session.complete
+            assert session['emg_raw'].samples == session['emg_rms'].samples == session['activ_hist'].samples == 199*300 # the rms stage had 199 batches
+            assert np.array_equal(session['emg_raw'][:], emg[:, :199*300])
+            assert session['imu_all'].samples == 199*27
+            assert np.array_equal(session['activ_hist'][-300:], emg[:, 198*300:199*300] > 0)
+        with open(folder+'/conf_sharedConfig.json') as fp:
+            assert json.load(fp)['session_name'] == 'test'
+        assert read_manifest(folder)['consistent']['batch'] == 198 and not find_sessions([folder])
+        for name, (found, kept) in result['streams'].items():
+            print(f"{name}: {found} samples found, {kept} kept")
+        print(f"recovered in {result['time']*1000:.1f} ms")
+
+        ###
+        # One file per stream, killed in the middle of a batch, with the log of the simulated stimulator
+        # (stim_log.bin in the older sessions: it is not a recorded stream and is left as it is)
+        ###
+
+        from orlau_record import RecordWriter
+        from orlau_stim_sim import StimulatorSim
+
+        folder = tempfile.mkdtemp()
+        with RecordWriter(folder+'/data_emg_raw.bin', 2, 2000, start_time=t0) as record:
+            record.write(emg[:, :150*300+123])
+        StimulatorSim(probe_time=0, log=folder+'/stim_log.bin').close()
+        size = os.path.getsize(folder+'/stim_log.bin')
+        write_manifest(folder, {'closed': False, 'config': {'samples_per_read': 300, 'record_streams': {'emg_raw': 'data_emg_raw'}}})
+
+        assert find_sessions([folder]) == [folder]
+        result = recover_session(folder)
+        assert result['streams'] == OrderedDict([('emg_raw', (150*300+123, 150*300))]) and result['batch'] == 149
+        assert os.path.getsize(folder+'/stim_log.bin') == size
+        with SessionFile(folder) as session:
+            assert list(session) == ['emg_raw'] and np.array_equal(session['emg_raw'][:], emg[:, :150*300])
+        print("one file per stream, with a stimulator log: ok")
+        sys.exit(0)
+
+    showTitle("Recover interrupted sessions", 'cyan')
+    folders = find_sessions(args.paths)
+    print(f"{len(folders)} session(s) to recover")
+    for folder in folders:
+        result = recover_session(folder)
+        printColor(f"{os.path.basename(folder.rstrip('/'))}: last consistent batch {result['batch']}, recovered in {result['time']:.1f} s" +
+                   (", configuration rebuilt from the manifest" if result['config'] else ""), 'green')
+        for name, (found, kept) in result['streams'].items():
+            if found != kept:
+                print(f"    {name}: {found - kept} samples after the last consistent batch removed")
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ring buffers in shared memory, used to pass the data streams between the processes
+
+Each stream (raw/filt/rms of all the muscles, imu, controller history) has its own fixed-capacity ring
+of (channels x capacity) samples living in a multiprocessing.shared_memory block:
+    - the producer appends one batch and then moves a monotonically increasing write cursor
+      (total number of samples ever written), so nothing is pickled or sent to the manager process
+    - each consumer keeps its own cursor (see RingReader) and only reads what is new
+    - reads return numpy views on the shared memory (no copy)
+
+To be able to always return a contiguous view, the data is stored twice (mirrored: sample k is
+at column k and k+capacity), so any window of up to 'capacity' samples is a plain slice.
+
+A view is only valid as long as the producer has not written 'capacity' samples over it:
+consumers that keep up (which is the whole point) never see this, the others can check
+with ring.overwritten(start).
+
+Consumers do not poll: ring.wait(seen) blocks on a condition variable until the producer
+has published more than 'seen' batches, and returns the batch sequence number. A consumer that
+has fallen behind gets all the batches published since 'seen' in one read (catch_up chooses
+where to start), and can append its output for all of them at once (ring.append(..., batches=k)).
+
+The ring also logs where each batch ends and when it was published (ring.batch_log), so that
+the recorder can index the recorded samples by batch number (emg_iter, rms_iter...) and time.
+"""
+
+import sys, os, copy, time
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))     # get current directory variable
+sys.path.append(CURR_DIR)                                  # load from the utils directory
+
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+
+class SharedRing(object):
+    """
+    Fixed-capacity ring buffer of (channels x samples) in shared memory.
+
+    Create it in the main process before starting the other processes and
+    pass it to them as an argument: it is shared as is when forking, and
+    re-attached by name when pickled (spawn on Windows).
+
+    Parameters
+    ----------
+    channels : int
+        Number of channels (rows) of the stream.
+    capacity : int
+        Number of samples per channel kept in the ring.
+    dtype : str, optional
+        Numpy dtype of the samples.
+    name : str, optional
+        Name of an existing shared memory block to attach to (used when
+        unpickling). A new block is created if None.
+    condition : multiprocessing.Condition, optional
+        Condition notified at each append (used when unpickling).
+
+    Attributes
+    ----------
+    cursor : int
+        Total number of samples written since the creation of the ring.
+    batches : int
+        Total number of batches appended since the creation of the ring.
+    """
+
+    HEADER_SIZE = 64 # bytes reserved before the data: cursor, batches (int64)
+
+    def __init__(self, channels, capacity, dtype='float64', name=None, condition=None):
+        self.channels = channels
+        self.capacity = capacity
+        self.dtype    = np.dtype(dtype)
+        self._owner   = name is None
+        self._cond    = condition if condition is not None else multiprocessing.Condition()
+
+        # data (mirrored), then the log of the last 'capacity' batches: cursor after the batch, and time of publication
+        dataSize = 2 * channels * capacity * self.dtype.itemsize
+        size     = self.HEADER_SIZE + dataSize + 2 * capacity * 8
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+
+        self._header = np.ndarray((2,), dtype=np.int64, buffer=self._shm.buf, offset=0)
+        self._data   = np.ndarray((channels, 2*capacity), dtype=self.dtype, buffer=self._shm.buf, offset=self.HEADER_SIZE)
+        self._stops  = np.ndarray((capacity,), dtype=np.int64,   buffer=self._shm.buf, offset=self.HEADER_SIZE+dataSize)
+        self._times  = np.ndarray((capacity,), dtype=np.float64, buffer=self._shm.buf, offset=self.HEADER_SIZE+dataSize+capacity*8)
+        if self._owner:
+            self._header[:] = 0
+            self._data[:]   = 0
+            self._stops[:]  = 0
+            self._times[:]  = 0
+
+    def __reduce__(self):
+        return (self.__class__, (self.channels, self.capacity, self.dtype.str, self.name, self._cond))
+
+    @property
+    def cursor(self):
+        return int(self._header[0])
+
+    @property
+    def batches(self):
+        return int(self._header[1])
+
+    def __len__(self):
+        """
+        Number of samples currently available (at most capacity).
+        """
+        return min(self.cursor, self.capacity)
+
+    def append(self, batch, rows=None, batches=1):
+        """
+        Append a batch at the end of the ring and publish it.
+
+        Parameters
+        ----------
+        batch : ndarray, shape=(channels, n) or (n,) for a single channel ring
+            New samples. Only the last 'capacity' samples are kept if n is larger.
+        rows : list of int, optional
+            Rows (channels) of the ring that the batch fills, the others are
+            left to 0. All rows by default.
+        batches : int, optional
+            Number of batches (of n/batches samples each) in these samples: they are
+            logged as separate batches, and published at once (e.g. by a stage
+            processing several batches in one go after falling behind).
+
+        Returns
+        -------
+        cursor : int
+            New write cursor.
+        """
+        batch = np.asarray(batch)
+        if batch.ndim == 1:
+            batch = batch[None, :]
+        n      = batch.shape[1]
+        cursor = self.cursor
+        stops  = cursor + (np.arange(1, batches + 1) * n) // batches
+        if n > self.capacity:
+            cursor += n - self.capacity
+            batch   = batch[:, -self.capacity:]
+            n       = self.capacity
+        rows = slice(None) if rows is None else rows
+
+        # write the data (twice, see module docstring), possibly in two parts if we reach the end of the ring
+        p     = cursor % self.capacity
+        first = min(n, self.capacity - p)
+        self._data[rows, p:p+first]                             = batch[:, :first]
+        self._data[rows, p+self.capacity:p+self.capacity+first] = batch[:, :first]
+        if first < n:
+            self._data[rows, :n-first]                            = batch[:, first:]
+            self._data[rows, self.capacity:self.capacity+n-first] = batch[:, first:]
+
+        # log the batch(es)
+        numbers = self.batches + np.arange(batches)
+        self._stops[numbers % self.capacity] = stops
+        self._times[numbers % self.capacity] = time.time()
+
+        # only then publish: move the cursor (single aligned 8 bytes store), and wake up the consumers
+        self._header[0] = cursor + n
+        self._header[1] = numbers[-1] + 1
+        with self._cond:
+            self._cond.notify_all()
+        return cursor + n
+
+    def wait(self, batches, timeout=None):
+        """
+        Block until more than 'batches' batches have been appended.
+
+        Parameters
+        ----------
+        batches : int
+            Number of batches already seen by the consumer.
+        timeout : float, optional
+            Maximum time to wait in seconds (e.g. to check a shutdown flag regularly).
+
+        Returns
+        -------
+        batches : int
+            Sequence number of the latest batch published (equal to the
+            'batches' given if we timed out).
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.batches > batches, timeout)
+        return self.batches
+
+    def batch_log(self, first, last=None):
+        """
+        Where the batches first..last-1 end, and when they were published.
+
+        Parameters
+        ----------
+        first : int
+            Number of the first batch (0 for the first batch ever appended).
+            Clipped to the oldest batch still in the log.
+        last : int, optional
+            Number after the last batch, all the batches published if None.
+
+        Returns
+        -------
+        numbers : ndarray of int64
+            Number of each batch.
+        stops : ndarray of int64
+            Cursor after the last sample of each batch.
+        times : ndarray of float64
+            Time (time.time()) of publication of each batch.
+        """
+        if last is None:
+            last = self.batches
+        first   = max(first, last - self.capacity, 0)
+        numbers = np.arange(first, last, dtype=np.int64)
+        return numbers, self._stops[numbers % self.capacity].copy(), self._times[numbers % self.capacity].copy()
+
+    def overwritten(self, start):
+        """
+        True if the sample at cursor 'start' is no longer in the ring.
+        """
+        return start < self.cursor - self.capacity
+
+    def read(self, start, stop=None):
+        """
+        Zero-copy view of the samples between the cursors start and stop.
+
+        Parameters
+        ----------
+        start : int
+            Cursor of the first sample. Clipped to the oldest sample still in the ring.
+        stop : int, optional
+            Cursor after the last sample, current write cursor if None.
+
+        Returns
+        -------
+        data : ndarray, shape=(channels, stop-start)
+            View on the shared memory.
+        """
+        if stop is None:
+            stop = self.cursor
+        start = max(start, stop - self.capacity, 0)
+        p     = start % self.capacity
+        return self._data[:, p:p+(stop-start)]
+
+    def latest(self, n):
+        """
+        Zero-copy view of the last n samples (less if not written yet).
+        """
+        stop = self.cursor
+        return self.read(stop - min(n, stop, self.capacity), stop)
+
+    def reader(self, start=None):
+        """
+        Create a reader with its own cursor, starting at 'start' (now if None).
+        """
+        return RingReader(self, self.cursor if start is None else start)
+
+    def close(self):
+        """
+        Detach from the shared memory, and free it if we created it.
+        """
+        self._header = None
+        self._data   = None
+        self._stops  = None
+        self._times  = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass # views still referenced somewhere: the memory is released when they are garbage collected
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class RingReader(object):
+    """
+    Consumer of a SharedRing, keeping its own read cursor.
+
+    Parameters
+    ----------
+    ring : SharedRing
+        Ring to read from.
+    start : int
+        Initial read cursor.
+    """
+
+    def __init__(self, ring, start=0):
+        self.ring    = ring
+        self.cursor  = start
+        self.dropped = 0      # samples overwritten by the producer before we could read them
+
+    def pending(self):
+        """
+        Number of samples written and not read yet.
+        """
+        return self.ring.cursor - self.cursor
+
+    def read(self, n=None):
+        """
+        Zero-copy view of the next n samples (all the new ones if None), and move the cursor.
+
+        Returns fewer than n samples if they have not been written yet.
+        """
+        stop = self.ring.cursor
+        if self.ring.overwritten(self.cursor):
+            self.dropped += (stop - self.ring.capacity) - self.cursor
+            self.cursor   = stop - self.ring.capacity
+        if n is not None:
+            stop = min(stop, self.cursor + n)
+        data        = self.ring.read(self.cursor, stop)
+        self.cursor = stop
+        return data
+
+
+def catch_up(ring, seen, batches, samples_per_read, policy='all'):
+    """
+    First batch to process by a stage that has processed 'seen' batches of a ring
+    when 'batches' have been published (the ones before it are skipped).
+
+    Parameters
+    ----------
+    ring : SharedRing
+        Ring the stage reads from, with batches of samples_per_read samples.
+    seen : int
+        Batches already processed by the stage.
+    batches : int
+        Batches published in the ring.
+    samples_per_read : int
+        Samples per batch.
+    policy : str, optional
+        'all' to catch up with all the pending batches (in one go), 'latest' to
+        skip to the latest one. The batches already overwritten in the ring are
+        skipped in any case.
+
+    Returns
+    -------
+    first : int
+        First batch to process, between seen and batches-1.
+    """
+    first  = seen if policy == 'all' else batches - 1
+    oldest = -(-(ring.cursor - ring.capacity) // samples_per_read) # first batch still entirely in the ring
+    return min(max(first, oldest, seen), batches - 1)
@@ -24,28 +24,32 @@ from collections import OrderedDict
 import multiprocessing
 from multiprocessing import Process, Pipe, freeze_support, Manager
 
-from orlau_utils import showTitle, printColor, show, convert_to_rms, time_normalise
-from orlau_controller import controller
+from orlau_utils import showTitle, printColor, show, StreamingRms, LatencyMeter
+from orlau_controller import controller, frame_lambda
+from orlau_ring import catch_up
 
-def funcRms(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=False, debug=False):
+def funcRms(sharedConfig, sharedData, sharedControl, sharedQueue1, sharedQueue2, verbose=False, debug=False):
     
     ###########################################################################
     # Normal mode (not dummy)
     ###########################################################################
 
-    # open files on disk
-    fileRms_delt          = open(sharedConfig['dataSaveFolder']+'/data_rms_delt.txt',             'ab')
-    fileRms_bic           = open(sharedConfig['dataSaveFolder']+'/data_rms_bic.txt',              'ab')
-    fileRms_delt_timenorm = open(sharedConfig['dataSaveFolder']+'/data_rms_delt_timenorm.txt',    'ab')
-    fileRms_bic_timenorm  = open(sharedConfig['dataSaveFolder']+'/data_rms_bic_timenorm.txt',     'ab')
+    samples_per_read = sharedConfig['samples_per_read']
+    muscles          = list(sharedConfig['emg_muscles_names'])
 
-    fileActiv_delt        = open(sharedConfig['dataSaveFolder']+'/data_activ_delt_history.txt',   'ab')
-    fileActiv_bic         = open(sharedConfig['dataSaveFolder']+'/data_activ_bic_history.txt',    'ab')
+    # rows given to the controller: the muscle that triggers the stimulation, and the one that inhibits it
+    iTrigger, iInhibit = [muscles.index(muscle) for muscle in sharedConfig['controller_muscles']]
 
-    fileController_value  = open(sharedConfig['dataSaveFolder']+'/data_controller_value.txt',     'ab')
-    fileController_pulse  = open(sharedConfig['dataSaveFolder']+'/data_controller_intensity.txt', 'ab')
+    # moving rms of all the muscles, continuous across batches (one value per sample)
+    streamingRms     = StreamingRms(channels=len(muscles))
 
-    samples_per_read = sharedConfig['samples_per_read']
+    # the controller ramps by stim_lambda at each call: with smaller batches (emg_lowLatency, one call per frame) it ramps
+    # by less at each call, so that it keeps the same speed over time
+    stim_lambda      = frame_lambda(0.5, samples_per_read)
+
+    # time from the publication of each batch of raw emg to the decision of the controller on it (published every second)
+    latencyMeter     = LatencyMeter()
+    lastLatency      = time.time()
 
     ###
     # option1 : using sharedDict and not queues
@@ -53,225 +57,185 @@ def funcRms(sharedConfig, sharedData, sharedQueue1, sharedQueue2, verbose=False,
 
     # Loop with a delay
 
+    skippedBatches = 0 # batches skipped since the start (stage_catchUp 'latest')
     iRms = 0
     while not sharedConfig['emg_shutdown']:
                
         # induce delay
         #sleep(0.5)
                         
-        #if not len_emg_raw > len_emg_filt:
-        if not sharedConfig['filter_iter'] > iRms:
+        # Block until the filter process has published a new batch (all the muscles at once)
+        # we wake up every 0.5s anyway to check the shutdown flag
+        filter_iter = sharedData['emg_filt'].wait(iRms, timeout=0.5)
+        if not filter_iter > iRms:
             #if verbose: print(f"# rms: no new data from filter, skipping")
             pass
 
-        if sharedConfig['filter_iter'] > iRms :
+        if filter_iter > iRms :
 
             if verbose: print(f"\niRms {iRms}")
 
             # the array has been populated, so process the latest batch of data
             
-            if verbose: print(f"\n# rms: current filtered is {len(sharedData['emg_delt_filt'])}, current rms is {len(sharedData['emg_delt_rms'])} so we process")
+            if verbose: print(f"\n# rms: current filtered is {sharedData['emg_filt'].cursor}, current rms is {sharedData['emg_rms'].cursor} so we process")
             
             # create local vars just in case a flag changes through the function, we want to finish the loop
+            # (one consistent snapshot of the control block, no manager round-trip)
+            this_control              = sharedControl.snapshot()
             this_emg_filter_do        = sharedConfig['emg_filter_do']
-            this_stim_do              = sharedConfig['stim_do']
-            this_controller_on        = sharedConfig['controller_on']
-            this_pulse_intensity_man  = sharedConfig['pulse_intensity_man']
-            this_pulse_intensity_auto = sharedConfig['pulse_intensity_auto']
+            this_stim_do              = this_control['stim_do']
+            this_controller_on        = this_control['controller_on']
+            this_pulse_intensity_man  = np.asarray(this_control['pulse_intensity_man'],  dtype=float) # one per stimulated muscle
+            this_pulse_intensity_auto = np.asarray(this_control['pulse_intensity_auto'], dtype=float)
             
             ###
-            # get the latest raw data and do the filtering
+            # get the latest filtered data
             ###
-
-            this_emg_delt_filt = None
-            this_emg_bic_filt  = None
             
+            # all the batches published since the last one we processed (several if we fell behind: processed in one go), or only the latest
+            # one if stage_catchUp is 'latest': the ones we skip are left empty (NaN) in our rings, and listed in stage_gaps
             # If we want to bypass the filtering and display the RMS value of the RAW directly (for debug purposes, but accessible from GUI)
-            if this_emg_filter_do:
-                this_emg_delt_filt = sharedData['emg_delt_filt'][-samples_per_read:]
-                this_emg_bic_filt  = sharedData['emg_bic_filt'][-samples_per_read:]
-            else:
-                this_emg_delt_filt = sharedData['emg_delt_raw'][-samples_per_read:]
-                this_emg_bic_filt  = sharedData['emg_bic_raw'][-samples_per_read:]
+            source = sharedData['emg_filt'] if this_emg_filter_do else sharedData['emg_raw']
+            first  = catch_up(source, iRms, filter_iter, samples_per_read, sharedConfig['stage_catchUp'])
+            count  = filter_iter - first
+            if first > iRms:
+                printColor(f"rms: {filter_iter - iRms} batches behind, skipping batches {iRms} to {first-1}", 'red')
+                skippedBatches              += first - iRms
+                sharedConfig['rms_skipped']  = skippedBatches
+                sharedConfig['stage_gaps']   = (sharedConfig['stage_gaps'] + [['rms', iRms, first - iRms]])[-sharedConfig['stage_gapsKept']:]
+
+            # read in place from the shared ring, all the muscles at once
+            this_emg_filt = source.read(first*samples_per_read, filter_iter*samples_per_read)
 
-            if verbose: print(f"\nRMS got 2 new filt arrays of length {len(this_emg_delt_filt)} and {len(this_emg_bic_filt)}")
+            if verbose: print(f"\nRMS got new filt arrays of shape {this_emg_filt.shape}")
 
-            # get the parameters as can be changed from the GUI
-            analogFreq = sharedConfig['rms_analogFreq']
+            # get the parameters as can be changed from the GUI (rms_analogFreq, rms_high and rms_low are only for the bandpass, which is not used)
             power      = sharedConfig['rms_power']
-            high       = sharedConfig['rms_high']
-            low        = sharedConfig['rms_low']
             window     = sharedConfig['rms_window']
 
-            # perform RMS on this batch
-            this_emg_delt_rms = convert_to_rms(this_emg_delt_filt, analogFrequency=analogFreq, power=power, highFreq=high, lowFreq=low, window=window)
-            this_emg_bic_rms  = convert_to_rms(this_emg_bic_filt,  analogFrequency=analogFreq, power=power, highFreq=high, lowFreq=low, window=window)
-            #this_emg_delt_rms = sharedData['emg_delt_filt'][-samples_per_read:] /2
-            #this_emg_bic_rms  = sharedData['emg_bic_filt'][-samples_per_read:]  /2
+            # perform RMS on these batches, using the end of the previous one for the first samples
+            # (the batches skipped by the filter are taken as 0, and stay empty in the output)
+            gaps         = np.isnan(this_emg_filt)
+            this_emg_rms = streamingRms.process(np.where(gaps, 0, this_emg_filt), power=power, window=window)
+            this_emg_rms[gaps] = np.nan
+            #this_emg_rms = sharedData['emg_filt'].latest(samples_per_read) /2
             
-            if verbose: print(f"after RMS, their length is {len(this_emg_delt_rms)} and {len(this_emg_bic_rms)}")
+            if verbose: print(f"after RMS, their shape is {this_emg_rms.shape}")
             
             # test: show where each batch starts/finished: add a "1" value at beginning of this array
-            #this_emg_delt_rms[0] = 1
-            #this_emg_bic_rms[0]  = 1
+            #this_emg_rms[:, 0] = 1
 
-            ###
-            # Feedback on if muscles are active
-            ###
+            # average of each muscle over each batch (NaN for the batches skipped by the filter)
+            this_emg_means = this_emg_rms.reshape(len(muscles), count, samples_per_read).mean(axis=2)
 
-            ##
-            # Prepare Muscle activity detection: choose the threshold to use
-            
-            # we have two different thresholds for when STIM is active or not
-            # i.e. we only take the withStim threshold when:
-                # we have been asked to do stim (this_stim_do = True), and:
-                    # either: the stimulator is AUTO   (this_controller_on = True)  and its pulse is > 0 (this_pulse_intensity_auto > 0) (set in the previous batch based on threshold_noStim)
-                    # or    : the stimulator is MANUAL (this_controller_on = False) and its pulse is > 0 (this_pulse_intensity_man  > 0)
-                
-            # to simplify the nested ifs, start with noStim threshold, and replace if we match a condition
-            this_thres_delt = sharedConfig['emg_thresh_noStim'][0]
-            this_thres_bic  = sharedConfig['emg_thresh_noStim'][1]
-            
-            chosenThreshNoStim   = True
-            chosenThreshWithStim = False
-            
-            if this_stim_do:
-                
-                if this_controller_on: # auto mode
-            
-                    if this_pulse_intensity_auto > 0:
-                        
-                        this_thres_delt = sharedConfig['emg_thresh_withStim'][0]
-                        this_thres_bic  = sharedConfig['emg_thresh_withStim'][1] 
-                        #if verbose: print("mode auto, this_pulse_intensity_auto > 0 : taking thresh withStim")
-                        #if verbose: print(sharedConfig['emg_thresh_withStim'])
-                        chosenThreshNoStim   = False
-                        chosenThreshWithStim = True
-            
-                elif not this_controller_on: # manual mode
-                
-                    if this_pulse_intensity_man > 0:
-                    
-                        this_thres_delt = sharedConfig['emg_thresh_withStim'][0]
-                        this_thres_bic  = sharedConfig['emg_thresh_withStim'][1] 
-                        
-                        #if verbose: print("mode man, this_pulse_intensity_man > 0 : taking thresh withStim")
-                        #if verbose: print(sharedConfig['emg_thresh_withStim'])
-                        chosenThreshNoStim   = False
-                        chosenThreshWithStim = True
-            
-            if chosenThreshNoStim:
-                if verbose: print(f"we've chosen chosenThreshNoStim ")
-                pass
-            elif chosenThreshWithStim:
-                if verbose: print(f"we've chosen chosenThreshWithStim ")
-                pass
-
-            # then, decide if its average is below or above the threshold
-
-            if verbose: print("is delt active in this batch?")
-            #print(f"{np.mean(this_emg_delt_rms)} >\n{this_thres_delt} ?")
-            sharedConfig['active_delt']   = np.mean(this_emg_delt_rms) > this_thres_delt
-            sharedConfig['active_bic']    = np.mean(this_emg_bic_rms)  > this_thres_bic
-            
-            # save muscle activity history timeseries
-            if sharedConfig['active_delt']:
-                #sharedData['activ_delt_hist'] = np.concatenate( (sharedData['activ_delt_hist'], np.ones(samples_per_read)),  axis=0 )
-                np.savetxt(fileActiv_delt, np.ones(samples_per_read), delimiter=',')
-            else:
-                #sharedData['activ_delt_hist'] = np.concatenate( (sharedData['activ_delt_hist'], np.zeros(samples_per_read)), axis=0 )
-                np.savetxt(fileActiv_delt, np.zeros(samples_per_read), delimiter=',')
-            if sharedConfig['active_bic']:
-                #sharedData['activ_bic_hist']  = np.concatenate( (sharedData['activ_bic_hist'],  np.ones(samples_per_read)),  axis=0 )
-                np.savetxt(fileActiv_bic, np.ones(samples_per_read), delimiter=',')
-            else:
-                #sharedData['activ_bic_hist']  = np.concatenate( (sharedData['activ_bic_hist'],  np.zeros(samples_per_read)), axis=0 )
-                np.savetxt(fileActiv_bic, np.zeros(samples_per_read), delimiter=',')
-    
-            # provide feedback in the console
-            if verbose: print(f"DEL {sharedConfig['active_delt']} ; BIC {sharedConfig['active_delt']}")
+            # histories of the activity / controller value / pulse intensity, same number of points as the raw data
+            this_activ_hist      = np.full((len(muscles), count*samples_per_read), np.nan)
+            this_controller_hist = np.full(count*samples_per_read, np.nan)
+            this_pulse_hist      = np.full((len(this_pulse_intensity_man), count*samples_per_read), np.nan)
+            this_controller_value = this_control['controller_value']
+            this_active           = None
 
-            ###
-            # Send to controller to get new stimulation value (will be updated in the GUI automatically)
-            ###
-            
-            if verbose: print("# emg: asking controller")
-            # this is redundant as we have already determined the activity of the muscles, but keeping the controller function tidy and separate for now
-            # we send the mean of RMS of each muscle, their threshold of contraction, and the latest controller value
-            new_stim_value = controller(np.mean(this_emg_delt_rms), this_thres_delt, np.mean(this_emg_bic_rms), this_thres_bic, sharedConfig['controller_value'], stim_lambda=0.5, verbose=False)
-            if verbose: print(f"Controller: setting value from {sharedConfig['controller_value']} to {np.around(new_stim_value,4)}")
-            # the ratio (0 -> 1) given by the stimulator is:
-            sharedConfig['controller_value'] = np.around(new_stim_value,4)
-            # to get the new pulse_intensity value we need to multiply by the max_allowed_intensity from calibration
-            sharedConfig['pulse_intensity_auto'] = sharedConfig['controller_value'] * sharedConfig['pulse_intensity_man']
-            if verbose: print(f"set pulse_intensity_auto to {sharedConfig['pulse_intensity_auto']}")
-            
-            if verbose: print(f"new stim value = {new_stim_value}")
-            if verbose: print(f"set pulse_intensity_auto to {sharedConfig['pulse_intensity_auto']}")
+            # the thresholds (set in the GUI) are read once for all the batches
+            this_thresh_withStim  = np.asarray(sharedConfig['emg_thresh_withStim'], dtype=float)
+            this_thresh_noStim    = np.asarray(sharedConfig['emg_thresh_noStim'],   dtype=float)
 
-            ###
-            # dump controller values
-            ###
+            # then, one decision per batch, as if they had come one by one (only the last one is published)
+            for b in range(count):
 
-            np.savetxt(fileController_value, [new_stim_value]                       * samples_per_read, delimiter=',')
-            np.savetxt(fileController_pulse, [sharedConfig['pulse_intensity_auto']] * samples_per_read, delimiter=',')
+                this_emg_mean = this_emg_means[:, b]
+                if np.isnan(this_emg_mean).any():
+                    continue # skipped by the filter: no decision
+                batch = slice(b*samples_per_read, (b+1)*samples_per_read)
 
-            ###
-            # dump emg rms data
-            ###
-            
-            np.savetxt(fileRms_delt, this_emg_delt_rms, delimiter=',')
-            np.savetxt(fileRms_bic,  this_emg_bic_rms,  delimiter=',')
+                ###
+                # Feedback on if muscles are active
+                ###
+
+                ##
+                # Prepare Muscle activity detection: choose the threshold to use
+                
+                # we have two different thresholds for when STIM is active or not
+                # i.e. we only take the withStim threshold when:
+                    # we have been asked to do stim (this_stim_do = True), and:
+                        # either: the stimulator is AUTO   (this_controller_on = True)  and one of its pulses is > 0 (this_pulse_intensity_auto > 0) (set in the previous batch based on threshold_noStim)
+                        # or    : the stimulator is MANUAL (this_controller_on = False) and one of its pulses is > 0 (this_pulse_intensity_man  > 0)
+                
+                chosenThreshWithStim = this_stim_do and ((this_controller_on and (this_pulse_intensity_auto > 0).any()) or (not this_controller_on and (this_pulse_intensity_man > 0).any()))
+                if chosenThreshWithStim:
+                    if verbose: print(f"we've chosen chosenThreshWithStim ")
+                    this_thres = this_thresh_withStim
+                else:
+                    if verbose: print(f"we've chosen chosenThreshNoStim ")
+                    this_thres = this_thresh_noStim
+
+                # then, decide if its average is below or above the threshold (one flag per muscle)
+                this_active   = this_emg_mean > this_thres
+                
+                # save muscle activity history timeseries (1 when active, 0 otherwise)
+                this_activ_hist[:, batch] = this_active[:, None]
+        
+                # provide feedback in the console
+                if verbose: print(" ; ".join(f"{muscle} {active}" for muscle, active in zip(muscles, this_active)))
+
+                ###
+                # Send to controller to get new stimulation value (will be updated in the GUI automatically)
+                ###
+                
+                if verbose: print("# emg: asking controller")
+                # this is redundant as we have already determined the activity of the muscles, but keeping the controller function tidy and separate for now
+                # we send the mean of RMS of each muscle, their threshold of contraction, and the latest controller value
+                new_stim_value = controller(this_emg_mean[iTrigger], this_thres[iTrigger], this_emg_mean[iInhibit], this_thres[iInhibit], this_controller_value, stim_lambda=stim_lambda, verbose=False)
+                if verbose: print(f"Controller: setting value from {this_controller_value} to {np.around(new_stim_value,4)}")
+                # the ratio (0 -> 1) given by the stimulator is:
+                this_controller_value = float(np.around(new_stim_value,4))
+                # to get the new pulse_intensity values we need to multiply by the max_allowed_intensity from calibration (of each stimulated muscle)
+                this_pulse_intensity_auto = this_controller_value * this_pulse_intensity_man
+                this_controller_hist[batch] = new_stim_value
+                this_pulse_hist[:, batch]   = this_pulse_intensity_auto[:, None]
+
+            if this_active is not None:
+                sharedControl['emg_active'] = this_active.tolist()
+                # publish both at once, so that the stimulator never sees one without the other
+                sharedControl.update(controller_value=this_controller_value, pulse_intensity_auto=this_pulse_intensity_auto)
+                
+                if verbose: print(f"new stim value = {this_controller_value}")
+                if verbose: print(f"set pulse_intensity_auto to {this_pulse_intensity_auto}")
+
+                # the stages append one batch for each batch of raw emg, so this decision is on the raw batch filter_iter-1
+                _, _, published = sharedData['emg_raw'].batch_log(filter_iter-1, filter_iter)
+                if len(published):
+                    latencyMeter.add(time.time() - published[0])
+            if time.time() - lastLatency >= 1:
+                sharedConfig['rms_latency'] = latencyMeter.summary()
+                lastLatency                 = time.time()
 
             ###
             # Put in shared dict
             ###
 
-            if verbose: print("adding to shared dict")
-            if verbose: print(f"current size: {len(sharedData['emg_delt_rms'])} and {len(sharedData['emg_bic_rms'])}")
+            if verbose: print("adding to shared rings")
 
-            # we have to make sure that they are the same size as RMS changes the number of points
-            this_emg_delt_rms_tn = time_normalise(this_emg_delt_rms, length=samples_per_read)
-            this_emg_bic_rms_tn  = time_normalise(this_emg_bic_rms,  length=samples_per_read)
-            if verbose: print(f"after time_normalise, their length is {len(this_emg_delt_rms_tn)} and {len(this_emg_bic_rms_tn)}")
-            
-            # add to our shared dict
-            sharedData['emg_delt_rms'] = np.concatenate( (sharedData['emg_delt_rms'],  this_emg_delt_rms_tn),  axis=0 )
-            sharedData['emg_bic_rms']  = np.concatenate( (sharedData['emg_bic_rms'],   this_emg_bic_rms_tn),   axis=0 )
-            if verbose: print(f"now rms is {len(sharedData['emg_delt_rms'])} because we just added {len(this_emg_delt_rms_tn)} values")
-            if verbose: print(f"after concat, size: {len(sharedData['emg_delt_rms'])} and {len(sharedData['emg_bic_rms'])}")
-            
-            # remove the first part to keep size consistent (if reached max limit)
-            if len(sharedData['emg_delt_rms']) > sharedConfig['maxArraySize']:
-                if verbose: print(f"current rms len ({len(sharedData['emg_delt_rms'])}) is > to max array size ({sharedConfig['maxArraySize']})")
-                # we remove length of frame from beginning of array
-                sharedData['emg_delt_rms'] = sharedData['emg_delt_rms'][samples_per_read:] # sharedData['emg_delt_rms'][len(this_emg_delt_rms):]
-                sharedData['emg_bic_rms']  = sharedData['emg_bic_rms'][samples_per_read:]   # sharedData['emg_bic_rms'][len(this_emg_bic_rms):]
-                
-            if verbose: print(f"after shifting, size: {len(sharedData['emg_delt_rms'])} and {len(sharedData['emg_bic_rms'])}")
-
-            ###
-            # dump emg rms data used in display
-            ###
-            
-            np.savetxt(fileRms_delt_timenorm, this_emg_delt_rms_tn, delimiter=',')
-            np.savetxt(fileRms_bic_timenorm,  this_emg_bic_rms_tn,  delimiter=',')
+            # add to our shared rings (they only keep the latest values, the recorder process writes them to disk), one batch for each batch of raw data
+            skipped = np.full((len(muscles), (first - iRms)*samples_per_read), np.nan)
+            batches = filter_iter - iRms
+            sharedData['activ_hist'].append(np.hstack((skipped, this_activ_hist)), batches=batches)
+            sharedData['controller_val_hist'].append(np.hstack((skipped[0], this_controller_hist)), batches=batches)
+            sharedData['pulse_val_hist'].append(np.hstack((np.full((len(this_pulse_hist), skipped.shape[1]), np.nan), this_pulse_hist)), batches=batches)
+            sharedData['emg_rms'].append(np.hstack((skipped, this_emg_rms)), batches=batches)
+            if verbose: print(f"now rms is {sharedData['emg_rms'].cursor} because we just added {this_emg_rms.shape[1]} values")
 
             ###
             # only then (after get;dump;resize), increment iterNumber
             ###
 
-            iRms+=1
+            iRms = filter_iter
             sharedConfig['rms_iter'] = iRms
             if verbose: print(f"# rms: new data, done iter {iRms}")
 
-    # Graceful exit
-    fileRms_delt.close()
-    fileRms_bic.close()
-    fileActiv_delt.close()
-    fileActiv_bic.close()
-    fileController_value.close()
-    fileController_pulse.close()
+    latency = latencyMeter.summary()
+    if latency is not None:
+        print(f"rms: controller decisions {latency['mean']} ms (95% under {latency['p95']} ms, max {latency['max']} ms) after each batch of {samples_per_read} samples was received")
+
 
 if __name__ == "__main__":
     
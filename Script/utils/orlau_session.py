@@ -0,0 +1,1001 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Single-file session container (session.orl)
+
+All the streams of a session (raw, filt, rms, activity, controller, pulse, imu) are written by
+the recorder in one file, as a sequence of self-describing chunks. Each chunk starts with a
+fixed header (tag, stream id, flags, payload size, first sample, number of rows, time):
+    - META : JSON, information on the session (start time, configuration)
+    - STRM : JSON, declares a stream (name, dtype, channels, names, rate, start time, extra information)
+    - DATA : samples of a stream, float32 little-endian, one record of 'channels' values per sample,
+             starting at sample 'start' of the stream (a gap between two chunks is data that was lost).
+             For a stream declared with compression='zdelta' (imu), the samples of each chunk are
+             delta-encoded along time (per channel, on their bit patterns, so it is lossless), their
+             bytes regrouped by significance, and compressed with zlib (flag FLAG_ZDELTA)
+    - BTCH : per-batch index of a stream: batch number (emg_iter, rms_iter...), sample after the
+             end of the batch, and time of the batch (rows of BATCH_DTYPE)
+    - EVNT : samples of a piecewise-constant stream (activity, controller value...) declared with
+             encoding='events', covering 'rows' samples from 'start': only the changes of value are
+             saved, as (batch, offset, time, value) events (see event_dtype), the first sample of a
+             chunk always being an event if it follows a gap. Those streams have no BTCH chunks: their
+             times come from the batch index of the stream named by their 'clock'
+
+When the file is closed, the chunk tables and the batch indexes of every stream are appended
+together with a JSON index (INDX), and the file ends with a trailer pointing to that index: a
+reader can then find any sample of any stream without parsing the file. A file that was not
+closed (crash) is still readable, the chunks are then scanned from the start.
+
+The payloads are padded to 8 bytes, so the samples of a chunk can be memory-mapped as they are
+(the compressed chunks are decompressed when read).
+
+While recording, the recorder also keeps a manifest.json next to the container (replaced atomically,
+see write_manifest): configuration, samples written of each stream and last consistent batch. A
+container that was not closed is repaired by orlau_recover.
+"""
+
+import sys, os, copy, time
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))     # get current directory variable
+sys.path.append(CURR_DIR)                                  # load from the utils directory
+
+import json
+import zlib
+import struct
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from orlau_record import write_all
+
+MAGIC         = b'ORLSES\x00\x01'       # format name and version, at the start of the file
+TRAILER_MAGIC = b'ORLIDX\x00\x01'       # followed by the position of the INDX chunk, at the end of the file
+CHUNK         = struct.Struct('<4sHHQqqd') # tag, stream id, flags, payload size, first sample, rows, time
+TRAILER       = struct.Struct('<8sQ')
+EXTENSION     = '.orl'
+MANIFEST      = 'manifest.json'
+FLAG_EVENTS   = 1                       # chunk (and table row) holding events instead of samples
+FLAG_ZDELTA   = 2                       # chunk (and table row) holding delta-encoded, zlib-compressed samples
+
+BATCH_DTYPE   = np.dtype([('batch', '<i8'), ('stop', '<i8'), ('time', '<f8')])                                 # one row per batch of a stream
+TABLE_DTYPE   = np.dtype([('start', '<i8'), ('samples', '<i8'), ('offset', '<i8'), ('size', '<i8'), ('flags', '<i8')]) # one row per DATA chunk of a stream
+
+def _padding(size):
+    return b'\x00' * (-size % 8)
+
+def event_dtype(channels, dtype='<f4'):
+    """
+    Events of a stream saved with encoding='events': batch number (-1 if unknown), sample number
+    (offset from the start of the stream) and time (nan if unknown) of the first sample of each new value.
+    """
+    return np.dtype([('batch', '<i8'), ('offset', '<i8'), ('time', '<f8'), ('value', np.dtype(dtype), (channels,))])
+
+def _changed(a, b):
+    # a != b, nan being equal to nan
+    return (a != b) & ~(np.isnan(a) & np.isnan(b))
+
+def _zdelta_encode(buffer, level=6):
+    """
+    Compress samples (samples x channels): difference of the bit patterns of consecutive samples of each
+    channel (wrapping integers, so exactly reversible), bytes regrouped by significance, then zlib.
+    """
+    bits  = buffer.view(f'<u{buffer.itemsize}')
+    delta = bits.copy()
+    delta[1:] -= bits[:-1]
+    planes = delta.view(np.uint8).reshape(buffer.shape[0], buffer.shape[1], buffer.itemsize).transpose(2, 1, 0)
+    return zlib.compress(np.ascontiguousarray(planes).tobytes(), level)
+
+def _zdelta_decode(payload, channels, dtype):
+    """
+    Samples (samples x channels) of a chunk compressed by _zdelta_encode.
+    """
+    planes = np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(dtype.itemsize, channels, -1)
+    delta  = np.ascontiguousarray(planes.transpose(2, 1, 0)).reshape(-1, channels * dtype.itemsize).view(f'<u{dtype.itemsize}')
+    return np.cumsum(delta, axis=0, dtype=delta.dtype).view(dtype)
+
+def last_consistent(counts, samples_per_read):
+    """
+    Last batch written completely in all the streams sampled at the highest rate (emg, rms, activity...).
+
+    Parameters
+    ----------
+    counts : dict
+        Name of each stream: (rate, samples written).
+    samples_per_read : int
+        Samples of a batch.
+
+    Returns
+    -------
+    batch : int
+        Number of that batch (-1 if there is none).
+    samples : int
+        Samples of those streams up to the end of that batch.
+    """
+    if not counts:
+        return -1, 0
+    rate    = max([rate for rate, _ in counts.values()])
+    samples = min([samples for r, samples in counts.values() if r == rate])
+    samples = samples - samples % samples_per_read
+    return samples // samples_per_read - 1, samples
+
+def write_manifest(folder, manifest):
+    """
+    Replace the manifest of a session folder atomically: it is written to a temporary file,
+    synced, then renamed, so that a crash leaves either the previous manifest or the new one.
+    """
+    path = os.path.join(folder, MANIFEST)
+    with open(path+'.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(path+'.tmp', path)
+
+def read_manifest(folder):
+    """
+    Manifest of a session folder, None if there is none.
+    """
+    path = os.path.join(folder, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        return json.load(fp)
+
+class SessionWriter(object):
+    """
+    Writer of a session container.
+
+    Parameters
+    ----------
+    path : str
+        File to create (overwritten if it exists).
+    meta : dict, optional
+        Information on the session saved at the start of the file (e.g. the
+        configuration), must be JSON serialisable.
+    start_time : float, optional
+        Time origin of the session (time.time()), now if None.
+    """
+
+    def __init__(self, path, meta=None, start_time=None):
+        self.path       = path
+        self.start_time = time.time() if start_time is None else start_time
+        self.streams    = OrderedDict() # name: {'id', 'header', 'samples', 'table', 'batches', 'last'}
+        self.meta       = dict(meta) if meta else {}
+        self.meta['start_time'] = self.start_time
+
+        # unbuffered: each chunk goes to the OS in one write() call
+        self._lock   = threading.Lock() # streams can be written from different threads
+        self._fp     = open(path, 'wb', buffering=0)
+        self._offset = 0
+        self._write(MAGIC)
+        self._chunk(b'META', 0, json.dumps(self.meta).encode('utf-8'))
+
+    @classmethod
+    def reopen(cls, session):
+        """
+        Reopen a container that was not closed (see SessionFile.complete), to append to it or close it.
+
+        Everything after its last complete chunk (cut by the crash) is removed, and
+        the streams continue from the chunks found by the scan, whose tables may
+        have been shortened meanwhile (samples after the end of a chunk are ignored).
+
+        Parameters
+        ----------
+        session : SessionFile
+            Container opened (and scanned) by SessionFile.
+        """
+        if session.complete:
+            raise ValueError(f"{session.path} is closed")
+        self            = cls.__new__(cls)
+        self.path       = session.path
+        self.meta       = dict(session.meta)
+        self.start_time = self.meta.get('start_time', time.time())
+        self.streams    = OrderedDict()
+        for name, stream in session.streams.items():
+            batches = np.array(session._table(name, 'batches', BATCH_DTYPE))
+            self.streams[name] = {'id': len(self.streams), 'header': stream['header'], 'samples': stream['samples'],
+                                  'table': [tuple(row) for row in session._table(name, 'table', TABLE_DTYPE).tolist()],
+                                  'batches': [batches] if len(batches) else [], 'last': None}
+        end = session.end
+        session.close()
+
+        self._lock   = threading.Lock()
+        self._fp     = open(self.path, 'r+b', buffering=0)
+        self._fp.truncate(end)
+        self._fp.seek(end)
+        self._offset = end
+        return self
+
+    def truncate(self, name, samples):
+        """
+        End a stream at a sample number: the samples after it stay in the file, but are no longer indexed.
+        """
+        stream = self.streams[name]
+        if samples >= stream['samples']:
+            return
+        stream['table']   = [(start, min(n, samples - start), offset, size, flags) for start, n, offset, size, flags in stream['table'] if start < samples]
+        if stream['batches']:
+            batches           = np.concatenate(stream['batches'])
+            stream['batches'] = [batches[batches['stop'] <= samples]]
+        stream['samples'] = samples
+        stream['last']    = None
+
+    def counts(self):
+        """
+        Rate and samples written of each stream, e.g. for last_consistent.
+        """
+        return OrderedDict((name, (stream['header']['rate'], stream['samples'])) for name, stream in self.streams.items())
+
+    def _write(self, data):
+        try:
+            write_all(self._fp, data)
+        except OSError:
+            # remove the part of the chunk that was written, so that the next ones are where the index says
+            self._fp.seek(self._offset)
+            self._fp.truncate()
+            raise
+        self._offset += len(data)
+
+    def _chunk(self, tag, stream, payload, flags=0, start=0, rows=0, t=None):
+        """
+        Write one chunk (header and payload in a single write), and return the position of its payload.
+        """
+        payload = memoryview(payload).cast('B')
+        header  = CHUNK.pack(tag, stream, flags, payload.nbytes, start, rows, time.time() if t is None else t)
+        with self._lock:
+            offset = self._offset + CHUNK.size
+            self._write(b''.join((header, payload, _padding(payload.nbytes))))
+        return offset
+
+    def add_stream(self, name, channels, rate, names=None, start_time=None, meta=None, dtype='<f4', encoding='samples', clock=None, compression=None):
+        """
+        Declare a stream, before writing its samples.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stream (e.g. the name of its shared ring).
+        channels : int
+            Number of channels (rows of the batches).
+        rate : float
+            Sample rate in Hz.
+        names : list of str, optional
+            Name of each channel (e.g. the muscles).
+        start_time : float, optional
+            Time (time.time()) of the first sample, start of the session if None.
+        meta : dict, optional
+            Extra information saved with the stream (must be JSON serialisable).
+        dtype : str, optional
+            Numpy dtype of the samples on disk.
+        encoding : str, optional
+            'samples' to save every sample, or 'events' for a piecewise-constant
+            stream, saved as its changes of value (see event_dtype).
+        clock : str, optional
+            Stream whose batch index gives the times of an 'events' stream
+            (appended by the same process, at the same sample numbers).
+        compression : str, optional
+            'zdelta' to compress the chunks of a 'samples' stream (lossless
+            delta encoding and zlib), None to write them as they are.
+        """
+        if name in self.streams:
+            raise KeyError(f"stream {name} already declared")
+        header = {
+            'name'       : name,
+            'dtype'      : np.dtype(dtype).str,
+            'channels'   : channels,
+            'names'      : list(names) if names is not None else None,
+            'rate'       : rate,
+            'start_time' : self.start_time if start_time is None else start_time,
+            }
+        if encoding == 'events':
+            header['encoding'] = 'events'
+            header['clock']    = clock
+        elif encoding != 'samples':
+            raise ValueError(f"unknown encoding {encoding}")
+        if compression == 'zdelta' and encoding == 'samples':
+            header['compression'] = 'zdelta'
+        elif compression is not None:
+            raise ValueError(f"unsupported compression {compression} for {encoding}")
+        if meta:
+            header.update(meta)
+        stream = {'id': len(self.streams), 'header': header, 'samples': 0, 'table': [], 'batches': [], 'last': None}
+        self.streams[name] = stream
+        self._chunk(b'STRM', stream['id'], json.dumps(header).encode('utf-8'))
+
+    def write(self, name, batch, start=None, batches=None):
+        """
+        Append samples to a stream.
+
+        Parameters
+        ----------
+        name : str
+            Stream declared with add_stream.
+        batch : ndarray, shape=(channels, n) or (n,) for a single channel stream
+            New samples.
+        start : int, optional
+            Sample number of the first sample, after the last one written if None.
+            Larger if samples were lost, smaller values are not allowed.
+        batches : ndarray of BATCH_DTYPE, optional
+            Index of the batches of the stream published since the last call
+            (for an 'events' stream, only used to number and date the events).
+        """
+        stream = self.streams[name]
+        header = stream['header']
+        batch  = np.asarray(batch)
+        if batch.ndim == 1:
+            batch = batch[None, :]
+        start  = stream['samples'] if start is None else start
+        if start < stream['samples']:
+            raise ValueError(f"{name}: sample {start} already written")
+
+        if header.get('encoding') == 'events':
+            self._write_events(stream, batch, start, batches)
+            return
+
+        if batch.shape[1] > 0:
+            buffer = np.ascontiguousarray(batch.T, dtype=header['dtype']) # samples x channels
+            rows   = buffer.shape[0]
+            flags  = 0
+            if header.get('compression') == 'zdelta':
+                buffer, flags = _zdelta_encode(buffer), FLAG_ZDELTA
+            offset = self._chunk(b'DATA', stream['id'], buffer, flags=flags, start=start, rows=rows)
+            stream['table'].append((start, rows, offset, memoryview(buffer).nbytes, flags))
+            stream['samples'] = start + rows
+
+        if batches is not None and len(batches):
+            batches = np.ascontiguousarray(batches, dtype=BATCH_DTYPE)
+            self._chunk(b'BTCH', stream['id'], batches, rows=len(batches))
+            stream['batches'].append(batches)
+
+    def _write_events(self, stream, batch, start, batches):
+        """
+        Write the changes of value of a batch of an 'events' stream as one EVNT chunk.
+        """
+        header = stream['header']
+        n      = batch.shape[1]
+        if n == 0:
+            return
+        values = np.ascontiguousarray(batch.T, dtype=header['dtype']) # samples x channels
+        first  = stream['last'] is None or start != stream['samples'] or _changed(values[0], stream['last']).any()
+        change = np.concatenate(([first], _changed(values[1:], values[:-1]).any(axis=1)))
+        index  = np.flatnonzero(change)
+
+        events = np.zeros(len(index), dtype=event_dtype(header['channels'], header['dtype']))
+        events['offset'] = start + index
+        events['value']  = values[index]
+        events['batch']  = -1
+        events['time']   = np.nan
+        # batch of each event: the first one ending after it (the previous write may have logged it)
+        known = stream['batches'][-1:] + ([np.ascontiguousarray(batches, dtype=BATCH_DTYPE)] if batches is not None else [])
+        known = np.concatenate(known) if known else np.zeros(0, dtype=BATCH_DTYPE)
+        if len(known):
+            position = np.searchsorted(known['stop'], events['offset'], side='right')
+            found    = position < len(known)
+            events['batch'][found] = known['batch'][position[found]]
+            events['time'][found]  = known['time'][position[found]]
+        if batches is not None and len(batches):
+            stream['batches'] = [np.ascontiguousarray(batches, dtype=BATCH_DTYPE)] # only kept to number the next events
+
+        offset = self._chunk(b'EVNT', stream['id'], events, flags=FLAG_EVENTS, start=start, rows=n)
+        stream['table'].append((start, n, offset, events.nbytes, FLAG_EVENTS))
+        stream['samples'] = start + n
+        stream['last']    = values[-1]
+
+    def sync(self):
+        """
+        Make sure the chunks written so far are on the disk (fsync), not only in the OS cache.
+        """
+        os.fsync(self._fp.fileno())
+
+    def close(self):
+        """
+        Write the index (chunk tables, batch indexes) and the trailer, and close the file.
+        """
+        index = {'meta': self.meta, 'streams': OrderedDict()}
+        for name, stream in self.streams.items():
+            table   = np.array(stream['table'], dtype=TABLE_DTYPE)
+            batches = np.concatenate(stream['batches']) if stream['batches'] and stream['header'].get('encoding') != 'events' else np.zeros(0, dtype=BATCH_DTYPE)
+            index['streams'][name] = {
+                'id'      : stream['id'],
+                'header'  : stream['header'],
+                'samples' : stream['samples'],
+                'table'   : [self._chunk(b'TABL', stream['id'], table,   rows=len(table)),   len(table)],
+                'batches' : [self._chunk(b'BIDX', stream['id'], batches, rows=len(batches)), len(batches)],
+                }
+        position = self._offset
+        self._chunk(b'INDX', 0, json.dumps(index).encode('utf-8'))
+        self._write(TRAILER.pack(TRAILER_MAGIC, position))
+        self.sync()
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SessionFile(object):
+    """
+    Random-access reader of a recorded session, on memory-mapped files.
+
+    Opening only reads the index at the end of the container (its size only
+    depends on the number of streams): the chunk table and batch index of a
+    stream are mapped the first time it is used, and samples are only read
+    from the disk when they are accessed.
+
+        session = SessionFile('Data/participantA_test1_...')
+        emg     = session['emg_raw']          # SessionStream
+        emg[0:2000]                           # first second (channels x samples)
+        emg.time[300:360]                     # seconds 300 to 360 of the session
+        for start, block in emg.blocks(60000):
+            ...
+
+    A container that was not closed (crash) has no index: its chunk headers
+    are scanned once when opening. A folder recorded with one data_*.bin
+    file per stream (see orlau_record) is read the same way, each file being
+    a stream made of a single chunk.
+
+    The streams saved as events (activity, controller value...) read the same
+    way: only the requested range is expanded to samples, and
+    session['activ_hist'].events gives the changes of value themselves.
+
+    Parameters
+    ----------
+    path : str
+        Container written by SessionWriter, or session folder (containing
+        session.orl, or the data_*.bin files).
+
+    Attributes
+    ----------
+    meta : dict
+        Information on the session (start_time, configuration...).
+    streams : OrderedDict
+        For each stream: 'header' (dict) and 'samples' (int, after the last
+        sample written). Use session[name] to read it.
+    complete : bool
+        False if the container was not closed and had to be scanned.
+    """
+
+    def __init__(self, path):
+        self._maps    = {}  # path: memory map of the file, opened on first access
+        self._streams = {}  # name: SessionStream, created on first access
+        if os.path.isdir(path) and not os.path.exists(os.path.join(path, 'session'+EXTENSION)):
+            self._open_records(path)
+            return
+        if os.path.isdir(path):
+            path = os.path.join(path, 'session'+EXTENSION)
+        self.path = path
+        with open(path, 'rb') as fp:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a session container")
+        self.size     = os.path.getsize(path)
+        self.complete = self._read_index()
+        if not self.complete:
+            self._scan()
+
+    def _map(self, path):
+        if path not in self._maps:
+            self._maps[path] = np.memmap(path, dtype=np.uint8, mode='r')
+        return self._maps[path]
+
+    def _header(self, fp, offset):
+        fp.seek(offset)
+        data = fp.read(CHUNK.size)
+        if len(data) < CHUNK.size:
+            return None
+        return CHUNK.unpack(data)
+
+    def _read_index(self):
+        if self.size < len(MAGIC) + TRAILER.size:
+            return False
+        with open(self.path, 'rb') as fp:
+            fp.seek(self.size - TRAILER.size)
+            magic, position = TRAILER.unpack(fp.read(TRAILER.size))
+            if magic != TRAILER_MAGIC:
+                return False
+            tag, _, _, size, _, _, _ = self._header(fp, position)
+            index = json.loads(fp.read(size).decode('utf-8'))
+        self.meta    = index['meta']
+        self.streams = OrderedDict()
+        for name, stream in index['streams'].items():
+            # (position, rows) of the tables, mapped when the stream is used
+            self.streams[name] = {'header': stream['header'], 'samples': stream['samples'], 'path': self.path,
+                                  'table': stream['table'], 'batches': stream['batches']}
+        return True
+
+    def _scan(self):
+        """
+        Rebuild the index from the chunks (container not closed). A chunk cut by the end of the file is ignored.
+        """
+        self.meta    = {}
+        self.streams = OrderedDict()
+        names        = {}                 # stream id: name
+        tables       = {}
+        batches      = {}
+        offset       = len(MAGIC)
+        self.end     = offset             # after the last complete chunk
+        with open(self.path, 'rb') as fp:
+            while True:
+                chunk = self._header(fp, offset)
+                if chunk is None:
+                    break
+                tag, stream, flags, size, start, rows, t = chunk
+                payload = offset + CHUNK.size
+                if payload + size > self.size:
+                    break
+                if tag == b'META':
+                    self.meta = json.loads(fp.read(size).decode('utf-8'))
+                elif tag == b'STRM':
+                    header        = json.loads(fp.read(size).decode('utf-8'))
+                    names[stream] = header['name']
+                    self.streams[header['name']] = {'header': header, 'samples': 0, 'path': self.path}
+                    tables[stream], batches[stream] = [], []
+                elif tag in (b'DATA', b'EVNT'):
+                    tables[stream].append((start, rows, payload, size, flags))
+                    self.streams[names[stream]]['samples'] = start + rows
+                elif tag == b'BTCH':
+                    batches[stream].append(np.frombuffer(fp.read(size), dtype=BATCH_DTYPE))
+                elif tag in (b'TABL', b'BIDX', b'INDX'):
+                    break # index of a closed container, but the trailer is missing
+                offset  += CHUNK.size + size + len(_padding(size))
+                self.end = offset
+        for stream, name in names.items():
+            self.streams[name]['table']   = np.array(tables[stream], dtype=TABLE_DTYPE)
+            self.streams[name]['batches'] = np.concatenate(batches[stream]) if batches[stream] else np.zeros(0, dtype=BATCH_DTYPE)
+
+    def _open_records(self, folder):
+        """
+        Session recorded with one data_*.bin file per stream: each file is a stream of one chunk.
+        """
+        from orlau_record import read_header, is_record
+
+        self.path     = folder
+        self.complete = True
+        self.meta     = {}
+        self.streams  = OrderedDict()
+        fileNames     = {}
+        if os.path.exists(folder+'/conf_sharedConfig.json'):
+            with open(folder+'/conf_sharedConfig.json') as fp:
+                self.meta['config'] = json.load(fp)
+            # stream names are the names of the rings, as in the container
+            fileNames = {fileName: key for key, fileName in self.meta['config'].get('record_streams', {}).items()}
+        for fileName in sorted(os.listdir(folder)):
+            path           = os.path.join(folder, fileName)
+            if not fileName.endswith('.bin') or not is_record(path):
+                continue
+            header, offset = read_header(path)
+            dtype          = np.dtype(header['dtype'])
+            samples        = (os.path.getsize(path) - offset) // (dtype.itemsize * header['channels'])
+            name           = fileNames.get(fileName[:-len('.bin')], fileName[:-len('.bin')])
+            header['name'] = name
+            self.streams[name] = {'header': header, 'samples': samples, 'path': path,
+                                  'table': np.array([(0, samples, offset, samples*dtype.itemsize*header['channels'], 0)], dtype=TABLE_DTYPE),
+                                  'batches': np.zeros(0, dtype=BATCH_DTYPE)}
+        if self.streams:
+            self.meta['start_time'] = min([stream['header']['start_time'] for stream in self.streams.values()])
+
+    def _table(self, name, key, dtype):
+        """
+        Chunk table or batch index of a stream, mapped from the index of the container on first use.
+        """
+        stream = self.streams[name]
+        if not isinstance(stream[key], np.ndarray):
+            position, rows = stream[key]
+            stream[key]    = np.ndarray((rows,), dtype=dtype, buffer=self._map(stream['path']), offset=position)
+        return stream[key]
+
+    def keys(self):
+        return self.streams.keys()
+
+    def __contains__(self, name):
+        return name in self.streams
+
+    def __iter__(self):
+        return iter(self.streams)
+
+    def __getitem__(self, name):
+        if name not in self.streams:
+            raise KeyError(name)
+        if name not in self._streams:
+            self._streams[name] = SessionStream(self, name)
+        return self._streams[name]
+
+    def read(self, name, start=0, stop=None):
+        """
+        Samples of a stream between two sample numbers (same as session[name][start:stop]).
+        """
+        return self[name][start:stop]
+
+    def sample_at(self, name, t):
+        """
+        Sample number of a stream at a time of the session (seconds since its start), from its batch index.
+        """
+        stream  = self.streams[name]
+        rate    = stream['header']['rate']
+        clock   = stream['header'].get('clock')
+        batches = self._table(clock if clock in self.streams else name, 'batches', BATCH_DTYPE)
+        times   = batches['time']
+        stops   = batches['stop']
+        t       = t + self.meta['start_time']
+        # no index: from the start time and the rate
+        if len(times) < 2:
+            return int(np.round((t - stream['header']['start_time']) * rate))
+        # outside of the index: extrapolate from its first/last batch with the rate
+        if t <= times[0]:
+            return int(np.round(stops[0]  + (t - times[0])  * rate))
+        if t >= times[-1]:
+            return int(np.round(stops[-1] + (t - times[-1]) * rate))
+        return int(np.round(np.interp(t, times, stops)))
+
+    def read_seconds(self, t0, t1, names=None):
+        """
+        All the streams (or the ones in names) between two times of the session (seconds since its start).
+
+        Returns
+        -------
+        data : OrderedDict
+            For each stream, its samples (channels x n) between t0 and t1.
+        """
+        return OrderedDict((name, self[name].time[t0:t1]) for name in (self.streams if names is None else names))
+
+    def close(self):
+        """
+        Release the memory maps (arrays returned before remain valid as long as they are referenced).
+        """
+        self._streams = {}
+        self._maps    = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SessionStream(object):
+    """
+    One stream of a recorded session, read on demand.
+
+    Indexing with sample numbers returns the samples of all the channels,
+    shape=(channels, n): a view on the memory-mapped file when they are in a
+    single chunk, a copy otherwise. Samples lost during the recording (gaps
+    between chunks) are NaN. stream.time[t0:t1] indexes with times of the
+    session in seconds instead.
+
+    Parameters
+    ----------
+    session : SessionFile
+        Session the stream belongs to.
+    name : str
+        Name of the stream.
+    """
+
+    def __init__(self, session, name):
+        self.session  = session
+        self.name     = name
+        self.header   = session.streams[name]['header']
+        self.dtype    = np.dtype(self.header['dtype'])
+        self.channels = self.header['channels']
+        self.names    = self.header['names']
+        self.rate     = self.header['rate']
+        self.samples  = session.streams[name]['samples']
+        self.encoding = self.header.get('encoding', 'samples')
+        self.time     = _TimeIndexer(self)
+        self._events  = None
+        self._decoded = OrderedDict() # offset: samples of the last compressed chunks read
+
+    @property
+    def table(self):
+        return self.session._table(self.name, 'table', TABLE_DTYPE)
+
+    @property
+    def batches(self):
+        """
+        Batch index: batch number, sample after its end, and time of each batch.
+        """
+        return self.session._table(self.name, 'batches', BATCH_DTYPE)
+
+    @property
+    def events(self):
+        """
+        Changes of value of an 'events' stream (see event_dtype), read from all its chunks on first use.
+        """
+        if self.encoding != 'events':
+            raise TypeError(f"{self.name} is not saved as events")
+        if self._events is None:
+            dtype  = event_dtype(self.channels, self.dtype)
+            buffer = self.session._map(self.session.streams[self.name]['path'])
+            chunks = [np.ndarray((int(chunk['size']) // dtype.itemsize,), dtype=dtype, buffer=buffer, offset=int(chunk['offset'])) for chunk in self.table]
+            self._events = np.concatenate(chunks) if chunks else np.zeros(0, dtype=dtype)
+        return self._events
+
+    @property
+    def shape(self):
+        return (self.channels, self.samples)
+
+    def __len__(self):
+        return self.samples
+
+    def _chunk(self, chunk):
+        """
+        Samples of a chunk (samples x channels), as a view on the memory-mapped file (decompressed if needed).
+        """
+        if chunk['flags'] & FLAG_ZDELTA:
+            key = int(chunk['offset'])
+            if key not in self._decoded: # a few chunks are kept, for the reads that follow each other
+                payload = self.session._map(self.session.streams[self.name]['path'])[key:key+int(chunk['size'])]
+                if len(self._decoded) >= 4:
+                    self._decoded.popitem(last=False)
+                self._decoded[key] = _zdelta_decode(payload, self.channels, self.dtype)
+                self._decoded[key].setflags(write=False) # shared by the reads, like the memory-mapped chunks
+            return self._decoded[key][:int(chunk['samples'])]
+        return np.ndarray((int(chunk['samples']), self.channels), dtype=self.dtype,
+                          buffer=self.session._map(self.session.streams[self.name]['path']), offset=int(chunk['offset']))
+
+    def read(self, start=0, stop=None):
+        """
+        Samples between two sample numbers (clipped to the stream), shape=(channels, stop-start).
+        """
+        stop   = self.samples if stop is None else min(stop, self.samples)
+        start  = max(0, min(start, stop))
+        table  = self.table
+        if self.encoding == 'events':
+            return self._expand(start, stop)
+        first  = max(0, np.searchsorted(table['start'], start, side='right') - 1)
+        last   = np.searchsorted(table['start'], stop, side='left')
+        chunks = table[first:last]
+
+        # all in one chunk: no copy
+        if len(chunks) == 1 and chunks[0]['start'] <= start and stop <= chunks[0]['start'] + chunks[0]['samples']:
+            offset = int(chunks[0]['start'])
+            return self._chunk(chunks[0])[start-offset:stop-offset].T
+
+        data = np.full((stop - start, self.channels), np.nan, dtype=self.dtype)
+        for chunk in chunks:
+            a, b = max(start, int(chunk['start'])), min(stop, int(chunk['start'] + chunk['samples']))
+            if a < b:
+                data[a-start:b-start] = self._chunk(chunk)[a-int(chunk['start']):b-int(chunk['start'])]
+        return data.T
+
+    def _expand(self, start, stop):
+        """
+        Samples of an 'events' stream between two sample numbers: the value of the last event before each
+        sample, nan for the samples that were lost (not covered by any chunk).
+        """
+        events  = self.events
+        table   = self.table
+        samples = np.arange(start, stop)
+        data    = np.full((stop - start, self.channels), np.nan, dtype=self.dtype)
+        last    = np.searchsorted(events['offset'], samples, side='right') - 1
+        chunk   = np.searchsorted(table['start'], samples, side='right') - 1
+        valid   = (last >= 0) & (chunk >= 0)
+        valid[valid] = samples[valid] < (table['start'] + table['samples'])[chunk[valid]]
+        data[valid]  = events['value'][last[valid]]
+        return data.T
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.samples)
+            data = self.read(start, stop) if step > 0 else self.read(stop+1, start+1)
+            return data if step == 1 else data[:, ::step] if step > 0 else data[:, ::-1][:, ::-step]
+        if index < 0:
+            index += self.samples
+        if not 0 <= index < self.samples:
+            raise IndexError(index)
+        return self.read(index, index+1)[:, 0]
+
+    def __array__(self, dtype=None):
+        data = self.read()
+        return data if dtype is None else data.astype(dtype)
+
+    def blocks(self, size, start=0, stop=None):
+        """
+        Iterate over the stream in blocks of 'size' samples (the last one can be shorter).
+
+        Yields
+        ------
+        start : int
+            Sample number of the first sample of the block.
+        data : ndarray, shape=(channels, n)
+            Samples of the block.
+        """
+        stop = self.samples if stop is None else min(stop, self.samples)
+        for blockStart in range(start, stop, size):
+            yield blockStart, self.read(blockStart, min(blockStart + size, stop))
+
+    def __repr__(self):
+        return f"SessionStream('{self.name}', channels={self.channels}, samples={self.samples}, rate={self.rate}, encoding='{self.encoding}')"
+
+
+class _TimeIndexer(object):
+    """
+    stream.time[t0:t1]: samples between two times of the session (seconds since its start).
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step is not None:
+            raise TypeError("time indexing needs a slice t0:t1 (seconds)")
+        session = self.stream.session
+        start   = 0                   if index.start is None else max(0, session.sample_at(self.stream.name, index.start))
+        stop    = self.stream.samples if index.stop  is None else max(start, session.sample_at(self.stream.name, index.stop))
+        return self.stream.read(start, stop)
+
+
+if __name__ == "__main__":
+
+    print("orlau_session loaded as main")
+
+    ###
+    # Write a session of two streams (with a gap), read it back, closed and not closed
+    ###
+
+    import tempfile
+
+    folder  = tempfile.mkdtemp()
+    rng     = np.random.default_rng(0)
+    emg     = rng.normal(0, 0.0003, (2, 300*100)).astype('<f4')
+    imu     = rng.normal(0, 1, (6, 22*100)).astype('<f4')
+    t0      = time.time()
+
+    for closed in [True, False]:
+        path   = folder+f'/session_{closed}'+EXTENSION
+        writer = SessionWriter(path, meta={'participant_name': 'test'}, start_time=t0)
+        writer.add_stream('emg_raw', 2, 2000, names=['deltoid','biceps'], start_time=t0)
+        writer.add_stream('imu_all', 6, 148.1, meta={'imu_channels': list(range(6))}, start_time=t0)
+        for i in range(0, 100, 5): # 5 batches per write, as the recorder does
+            if i == 50:
+                continue           # lost
+            batches = np.array([(k, (k+1)*300, t0 + (k+1)*0.15) for k in range(i, i+5)], dtype=BATCH_DTYPE)
+            writer.write('emg_raw', emg[:, i*300:(i+5)*300], start=i*300, batches=batches)
+            writer.write('imu_all', imu[:, i*22:(i+5)*22],   start=i*22)
+        if closed:
+            writer.close()
+        else:
+            writer._fp.write(b'\x00' * 20) # cut in the middle of a chunk header
+            writer._fp.close()
+
+        with SessionFile(path) as session:
+            emgStream = session['emg_raw']
+            assert session.complete == closed
+            assert len(emgStream) == 30000
+            data = emgStream[:]
+            assert np.array_equal(data[:, :15000], emg[:, :15000]) and np.array_equal(data[:, 16500:], emg[:, 16500:])
+            assert np.isnan(data[:, 15000:16500]).all()
+            assert np.shares_memory(emgStream[100:200], session._maps[path])                  # in one chunk: a view
+            assert np.array_equal(emgStream[1000:2000:7], emg[:, 1000:2000:7]) and np.array_equal(emgStream[-1], emg[:, -1])
+            assert np.array_equal(np.concatenate([block for _, block in emgStream.blocks(4000)], axis=1), data, equal_nan=True)
+            part = session.read_seconds(3.0, 6.0)
+            assert part['emg_raw'].shape == (2, 6000) and np.array_equal(part['emg_raw'], emg[:, 6000:12000])
+            print(f"closed={closed}: {len(emgStream.table)} chunks, {len(emgStream.batches)} batches indexed, {os.path.getsize(path)/1e6:.2f} MB: ok")
+
+    ###
+    # Short writes (signal) are completed, and a chunk that cannot be written (disk full) is removed:
+    # the chunks after it are where the index says
+    ###
+
+    class ShortWrites(object):
+        def __init__(self, fp, limit):
+            self.fp, self.name, self.limit = fp, fp.name, limit
+        def write(self, data):
+            written     = min(self.limit, memoryview(data).nbytes, 1000)
+            self.limit -= written
+            return self.fp.write(memoryview(data)[:written])
+        def __getattr__(self, key):
+            return getattr(self.fp, key)
+
+    path       = folder+'/session_short'+EXTENSION
+    writer     = SessionWriter(path, start_time=t0)
+    writer._fp = ShortWrites(writer._fp, 10**9)
+    writer.add_stream('emg_raw', 2, 2000, start_time=t0)
+    writer.write('emg_raw', emg[:, :3000])
+    writer._fp.limit = 5000
+    try:
+        writer.write('emg_raw', emg[:, 3000:6000])
+        raise AssertionError("no error when the disk is full")
+    except OSError:
+        pass
+    writer._fp.limit = 10**9
+    writer.write('emg_raw', emg[:, 6000:9000], start=6000)
+    writer.close()
+    with SessionFile(path) as session:
+        expected = emg[:, :9000].copy()
+        expected[:, 3000:6000] = np.nan
+        assert session.complete and np.array_equal(session['emg_raw'][:], expected, equal_nan=True)
+    print("short writes, and a chunk lost when the disk is full: ok")
+
+    ###
+    # Session recorded with one file per stream, next to the log of the simulated stimulator
+    # (stim_log.bin in the older sessions: it is not a recorded stream and is ignored)
+    ###
+
+    from orlau_record import RecordWriter
+    from orlau_stim_sim import StimulatorSim
+
+    records = folder+'/records'
+    os.makedirs(records)
+    with RecordWriter(records+'/data_emg_raw.bin', 2, 2000, start_time=t0) as record:
+        record.write(emg)
+    StimulatorSim(probe_time=0, log=records+'/stim_log.bin').close()
+    with SessionFile(records) as session:
+        assert list(session) == ['data_emg_raw'] and np.array_equal(session['data_emg_raw'][:], emg)
+    print("one file per stream, with a stimulator log: ok")
+
+    ###
+    # Piecewise-constant stream saved as events: size, and expansion back to samples
+    ###
+
+    path    = folder+'/session_events'+EXTENSION
+    active  = np.repeat(rng.random((2, 1000)) > 0.9, 300, axis=1).astype(float)  # one flag per muscle and batch
+    active[:, 30000:30600] = np.nan                                               # nan like any other value
+    writer  = SessionWriter(path, start_time=t0)
+    writer.add_stream('emg_rms', 2, 2000, start_time=t0)
+    writer.add_stream('activ_hist', 2, 2000, encoding='events', clock='emg_rms', start_time=t0)
+    for i in range(0, 1000, 5):
+        if i == 500:
+            continue # lost
+        batches = np.array([(k, (k+1)*300, t0 + (k+1)*0.15) for k in range(i, i+5)], dtype=BATCH_DTYPE)
+        writer.write('emg_rms', active[:, i*300:(i+5)*300], start=i*300, batches=batches)
+        writer.write('activ_hist', active[:, i*300:(i+5)*300], start=i*300, batches=batches)
+    writer.close()
+
+    with SessionFile(path) as session:
+        dense, events = session['emg_rms'], session['activ_hist']
+        expected      = active.astype('<f4')
+        expected[:, 150000:151500] = np.nan
+        assert np.array_equal(events[:], expected, equal_nan=True) and np.array_equal(events[12345:23456], expected[:, 12345:23456], equal_nan=True)
+        assert np.array_equal(events.time[100:110], dense.time[100:110], equal_nan=True)
+        assert (events.events['batch'] == events.events['offset'] // 300).all()
+        size_dense  = int(dense.table['size'].sum())  + len(dense.table)*CHUNK.size + len(dense.batches)*BATCH_DTYPE.itemsize
+        size_events = int(events.table['size'].sum()) + len(events.table)*CHUNK.size
+        print(f"activity: {len(events.events)} events, {size_events/1e3:.1f} kB instead of {size_dense/1e3:.1f} kB ({size_dense/size_events:.0f}x smaller)")
+
+    ###
+    # Compressed imu stream (delta + zlib per chunk): quantised accelerometer signals, as the sensors give them
+    ###
+
+    path    = folder+'/session_zdelta'+EXTENSION
+    t       = np.arange(148*600) / 148.1
+    acc     = np.sin(2*np.pi*0.5*t[:, None] + np.arange(6)) * 0.5 + rng.normal(0, 0.01, (len(t), 6))
+    acc     = (np.round(acc * 2048) / 2048).T.astype('<f4')
+    acc[0, 1000] = np.nan
+    writer  = SessionWriter(path, start_time=t0)
+    writer.add_stream('imu_plain', 6, 148.1, start_time=t0)
+    writer.add_stream('imu_all',   6, 148.1, start_time=t0, compression='zdelta')
+    writer.write('imu_plain', acc)
+    for i in range(0, acc.shape[1], 74): # written every 0.5s by the recorder
+        if 7400 <= i < 7400+740:
+            continue                     # lost
+        writer.write('imu_all', acc[:, i:i+74], start=i)
+    writer.close()
+    with SessionFile(path) as session:
+        expected = acc.copy()
+        expected[:, 7400:7400+740] = np.nan
+        assert np.array_equal(session['imu_all'][:], expected, equal_nan=True)
+        assert np.array_equal(session['imu_all'][5000:5010], acc[:, 5000:5010], equal_nan=True)
+        size_plain  = int(session['imu_plain'].table['size'].sum())
+        size_zdelta = int(session['imu_all'].table['size'].sum())
+        print(f"imu zdelta: {size_zdelta/1e3:.0f} kB instead of {size_plain/1e3:.0f} kB ({size_plain/size_zdelta:.1f}x smaller)")
+
+    ###
+    # Opening is independent of the length of the recording: 1 hour of 2 muscles, written every 0.5s
+    ###
+
+    path   = folder+'/session_long'+EXTENSION
+    writer = SessionWriter(path, start_time=t0)
+    writer.add_stream('emg_raw', 2, 2000, names=['deltoid','biceps'], start_time=t0)
+    block  = rng.normal(0, 0.0003, (2, 1000)).astype('<f4')
+    for i in range(2*3600):
+        batches = np.array([(k, (k+1)*300, t0 + (k+1)*0.15) for k in range(i*10//3, (i+1)*10//3)], dtype=BATCH_DTYPE)
+        writer.write('emg_raw', block, batches=batches)
+    writer.close()
+
+    tic = time.perf_counter()
+    session = SessionFile(path)
+    t_open  = time.perf_counter() - tic
+    tic = time.perf_counter()
+    minute  = session['emg_raw'].time[1800:1860]
+    t_slice = time.perf_counter() - tic
+    print(f"1 hour session ({os.path.getsize(path)/1e6:.0f} MB): open {t_open*1000:.2f} ms, seconds 1800-1860 {minute.shape} in {t_slice*1000:.2f} ms")
+    session.close()
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
+stimulator: sends the pulse intensity (manual, or from the controller) to the stimulator in mid-level mode
 
+The stimulator library is sciencemode3 (Windows only), imported only once the process starts, or the
+pure-python StimulatorSim of orlau_stim_sim when 'stim_dummyMode' is set (same calls, logged to
+stim_log.sim in the session folder).
 """
 
 # Reset the vars at run if using ipython-based IDE if in main
@@ -11,19 +15,176 @@ if __name__ == "__main__":
         get_ipython().run_line_magic('reset', '-sf')
     except: pass
 
-import sys, os, copy, time
+import sys, os, copy, time, json, glob
 CURR_DIR = os.path.dirname(os.path.realpath(__file__))     # get current directory variable
 os.chdir(os.path.abspath(os.path.dirname(__file__)))       # change current working directory
 sys.path += [CURR_DIR, CURR_DIR,CURR_DIR+'/utils']         # add relative folders to path, to load our modules easily without installing them
 
 from time import sleep
-from sciencemode3 import sciencemode # stimulator
-from orlau_utils import showTitle, printColor, show, convert_to_rms
+import queue
+import threading
+import numpy as np
+from orlau_utils import showTitle, printColor, show, convert_to_rms, LatencyMeter
 
-def funcStim2(sharedConfig, sharedData, verbose=False, debug=False):
+def load_backend(sharedConfig):
+    """
+    Stimulator library: sciencemode3, or StimulatorSim in stim_dummyMode (no hardware needed).
+
+    sciencemode3 is only imported here, so that this module (and live.py) can be loaded
+    on the machines where it is not installed.
+    """
+    if sharedConfig['stim_dummyMode']:
+        from orlau_stim_sim import StimulatorSim
+        return StimulatorSim(log=sharedConfig['dataSaveFolder']+'/stim_log.sim')
+    from sciencemode3 import sciencemode # stimulator
+    return sciencemode
+
+# USB ids (vendor, product) of the FTDI serial converters the stimulators are connected through
+STIM_USB_IDS = [(0x0403, 0x6001), (0x0403, 0x6010), (0x0403, 0x6011), (0x0403, 0x6014), (0x0403, 0x6015)]
+
+def candidate_ports():
+    """
+    Serial ports the stimulator may be on, most likely first.
+
+    The FTDI devices (STIM_USB_IDS) listed by pyserial (and on Linux by /dev/serial/by-id,
+    whose names do not change when the device is plugged in again), then the other serial
+    ports and the /dev/ttyUSB* devices. Without pyserial on Windows, COM1 to COM16.
+    """
+    byId   = sorted(glob.glob('/dev/serial/by-id/*'))
+    ports  = [port for port in byId if 'FTDI' in port]
+    try:
+        from serial.tools import list_ports
+        devices = sorted(list_ports.comports(), key=lambda device: (device.vid, device.pid) not in STIM_USB_IDS) # FTDI first, in the listed order
+        ports  += [device.device for device in devices]
+    except ImportError:
+        if os.name == 'nt':
+            ports += [f"COM{number}" for number in range(1, 17)]
+    ports += byId + sorted(glob.glob('/dev/ttyUSB*'))
+
+    # each device once (under its first name)
+    unique, seen = [], set()
+    for port in ports:
+        device = os.path.realpath(port) if port.startswith('/dev/') else port
+        if device not in seen:
+            seen.add(device)
+            unique.append(port)
+    return unique
+
+def probe_ports(sciencemode, ports, timeout):
+    """
+    First of the ports where smpt_check_serial_port finds a stimulator, all of them probed at once.
+
+    Each port is checked in its own (daemon) thread, so that a port that does not answer does not
+    delay the others, and does not keep the process alive.
+
+    Returns
+    -------
+    port : str
+        Port that answered first, None if none did within 'timeout' seconds.
+    """
+    results = queue.Queue()
+    def check(port):
+        try:
+            results.put((port, bool(sciencemode.smpt_check_serial_port(sciencemode.ffi.new("char[]", bytes(port, "utf-8"))))))
+        except Exception:
+            results.put((port, False))
+    for port in ports:
+        threading.Thread(target=check, args=(port,), daemon=True).start()
+
+    deadline = time.perf_counter() + timeout
+    for _ in ports:
+        try:
+            port, found = results.get(timeout=max(deadline - time.perf_counter(), 0))
+        except queue.Empty:
+            break
+        if found:
+            return port
+    return None
+
+def find_stimulator(sciencemode, cache=None, timeout=2.0, verbose=False):
+    """
+    Serial port of the stimulator.
+
+    The port it was last found on (saved in the cache file) is tried first on its own, then
+    all the candidate ports are probed at once. A backend that simulates its own ports
+    (StimulatorSim) lists them with list_ports().
+
+    Parameters
+    ----------
+    sciencemode : module or StimulatorSim
+        Stimulator library (see load_backend).
+    cache : str, optional
+        JSON file keeping the last port the stimulator was found on.
+    timeout : float, optional
+        Time given to the ports to answer, for the cached port and then for the others (s).
+
+    Returns
+    -------
+    port : str
+        Port to open.
+
+    Raises
+    ------
+    IOError
+        If no port answered.
+    """
+    t0     = time.perf_counter()
+    cached = None
+    if cache and os.path.exists(cache):
+        try:
+            with open(cache) as fp:
+                cached = json.load(fp)['port']
+        except (ValueError, KeyError):
+            pass
+
+    port = probe_ports(sciencemode, [cached], timeout) if cached else None
+    if port is None:
+        ports = [port for port in (sciencemode.list_ports() if hasattr(sciencemode, 'list_ports') else candidate_ports()) if port != cached]
+        port  = probe_ports(sciencemode, ports, timeout) if ports else None
+        if port is None:
+            tried = ([cached] if cached else []) + ports
+            raise IOError(f"stimulator not found on any serial port ({', '.join(tried) or 'none found'}): make sure it is plugged in and switched on")
+        if cache:
+            with open(cache, 'w') as fp:
+                json.dump({'port': port, 'time': time.time()}, fp)
+
+    if verbose: print(f"#STIM: Found stimulator on {port} in {1e3*(time.perf_counter() - t0):.1f} ms{' (cached)' if port == cached else ''}")
+    return port
+
+def pulse_shapes(shape, channels):
+    """
+    Points of the pulses of each stimulated channel.
+
+    Parameters
+    ----------
+    shape : list
+        'stim_pulseShape': [fraction of pulse_width, fraction of the intensity] of each point,
+        for all the channels, or one such list per channel.
+    channels : int
+        Number of stimulated channels.
+
+    Returns
+    -------
+    shapes : list of ndarray, shape=(points, 2)
+        Points of the pulses of each channel.
+    """
+    if np.ndim(shape[0][0]) == 0:
+        shape = [shape] * channels
+    shapes = [np.asarray(points, dtype=float).reshape(-1, 2) for points in shape]
+    if len(shapes) != channels:
+        raise ValueError(f"stim_pulseShape: {len(shapes)} shapes for {channels} stimulated channels")
+    if max([len(points) for points in shapes]) > 16:
+        raise ValueError("stim_pulseShape: at most 16 points per pulse")
+    if max([np.abs(points[:, 1]).max() for points in shapes]) > 1:
+        raise ValueError("stim_pulseShape: the current of a point is a fraction of the intensity, between -1 and 1")
+    return shapes
+
+def funcStim2(sharedConfig, sharedData, sharedControl, verbose=False, debug=False):
 
     if verbose: showTitle('STIM: Connecting to stimulator\n', color='blue')
 
+    sciencemode = load_backend(sharedConfig)
+
     ###
     # Find the stimulator
     ###
@@ -32,17 +193,17 @@ def funcStim2(sharedConfig, sharedData, verbose=False, debug=False):
     device      = sciencemode.ffi.new("Smpt_device*")
     version_ack = sciencemode.ffi.new("Smpt_get_version_ack*")
     
-    com_connected = False
-    com_port_number = 1
-    while not com_connected:
-        com = sciencemode.ffi.new("char[]", bytes("COM{0}".format(com_port_number), "utf-8"))
-        ret = sciencemode.smpt_check_serial_port(com)
-        if debug: print(f"checking port {com}")
-        if ret==False:
-            com_port_number += 1
-        else:
-            com_connected = True
-            if verbose: print(f"#STIM: Found stimulator on COM port {com_port_number}")
+    # last known port first, then all the serial ports at once (gives up after stim_portTimeout)
+    # (the simulated stimulator's ports are never cached: the next start with the real one would try them first)
+    cache = sharedConfig['stim_portCache'] if not sharedConfig['stim_dummyMode'] else None
+    try:
+        com_port = find_stimulator(sciencemode, cache=cache, timeout=sharedConfig['stim_portTimeout'], verbose=verbose or debug)
+    except IOError as error:
+        printColor(f"#STIM: {error}", color='red')
+        if sharedConfig['stim_dummyMode']:
+            sciencemode.close()
+        return
+    com = sciencemode.ffi.new("char[]", bytes(com_port, "utf-8"))
     
     ###
     # Connect to the stimulator
@@ -68,69 +229,142 @@ def funcStim2(sharedConfig, sharedData, verbose=False, debug=False):
     # Stimulate
     ###
     
-    # initiate 0 pulse
+    # initiate 0 pulse, on all the channels of the stimulated muscles (they are all updated by the same packet)
     ml_update = sciencemode.ffi.new("Smpt_ml_update*")
     ml_update.packet_number = sciencemode.smpt_packet_number_generator_next(device)
-    channelNumber = sharedConfig['stim_channelNumbers']
-    ml_update.enable_channel[channelNumber]                   = True
-    ml_update.channel_config[channelNumber].period            = sharedConfig['pulse_period']
-    ml_update.channel_config[channelNumber].number_of_points  = 1
-    ml_update.channel_config[channelNumber].points[0].time    = sharedConfig['pulse_width']
-    ml_update.channel_config[channelNumber].points[0].current = 0
+    channelNumbers = list(sharedConfig['stim_channelNumbers'])
+    shapes         = pulse_shapes(sharedConfig['stim_pulseShape'], len(channelNumbers))
+    for channelNumber, shape in zip(channelNumbers, shapes):
+        ml_update.enable_channel[channelNumber]                  = True
+        ml_update.channel_config[channelNumber].period           = sharedControl['pulse_period']
+        ml_update.channel_config[channelNumber].number_of_points = len(shape)
+        for point, (width, current) in enumerate(shape):
+            ml_update.channel_config[channelNumber].points[point].time    = int(round(width * sharedControl['pulse_width']))
+            ml_update.channel_config[channelNumber].points[point].current = 0
     
     if debug: print("set 0 pulse")
-    
+
+    ###
+    # Scheduler
+    ###
+
+    # the updates are sent at deadlines instead of continuously:
+    #   - 'change': as soon as the settings to send change (the controller's values are sent as soon as the rms process publishes them,
+    #               the GUI's are looked at every stim_checkPeriod), and at least every stim_keepAlive seconds (the stimulator stops after 2s without update)
+    #   - 'pulse' : one update per pulse (every pulse_period), changed or not
+    schedule    = sharedConfig['stim_schedule']
+    keepAlive   = sharedConfig['stim_keepAlive']
+    checkPeriod = sharedConfig['stim_checkPeriod'] / 1000.
+    controller  = sharedData['controller_val_hist']
+    seen        = controller.batches
+
+    # how late we wake up after each deadline, how long each update takes to send, and the deadlines missed (a whole period late)
+    lateMeter   = LatencyMeter()
+    sendMeter   = LatencyMeter()
+    misses      = 0
+    sends       = {'change': 0, 'keepalive': 0, 'pulse': 0}
+    lastTiming  = time.perf_counter()
+
+    def timing():
+        return {'sends': dict(sends), 'misses': misses, 'late': lateMeter.summary(), 'send': sendMeter.summary()}
+
+    sent        = None                           # settings of the last update sent
+    lastSend    = time.perf_counter() - keepAlive # the first update is sent straight away
+    nextTick    = time.perf_counter()            # next pulse ('pulse') or check of the settings ('change')
+
     # While we don't ask for shutdown,
     iStim = 0
-    while not sharedConfig['stim_shutdown']:
-
-        # delay between updates (?10hz)
-        sleep(0)
+    while not sharedControl['stim_shutdown']:
 
         iStim+=1
         
         if debug: print(f"iStim {iStim}")
+
+        # sleep until the next deadline (woken up earlier by a new value of the controller)
+        deadline = nextTick if schedule == 'pulse' else min(nextTick, lastSend + keepAlive)
+        timeout  = deadline - time.perf_counter()
+        if schedule == 'change' and timeout > 0:
+            seen = controller.wait(seen, timeout=timeout)
+        elif timeout > 0:
+            sleep(timeout)
+        now = time.perf_counter()
+
+        # deadline reached: how late we are, and how many whole periods we missed (the next deadline is the next one in the future)
+        if now >= deadline:
+            lateMeter.add(now - deadline)
+        period = sharedControl['pulse_period'] / 1000. if schedule == 'pulse' else checkPeriod
+        if now >= nextTick:
+            late      = int((now - nextTick) // period)
+            misses   += late
+            nextTick += (late + 1) * period
+
+        # consistent snapshot of the hot settings, read from shared memory (no manager round-trip)
+        control = sharedControl.snapshot()
         
-        # only if we asked the stimulator to send pulses (otherwise it stays at 0)
-        if not sharedConfig['stim_do']:
-            ml_update.channel_config[channelNumber].points[0].current = 0
+        # only if we asked the stimulator to send pulses (otherwise it stays at 0), one intensity per stimulated muscle
+        new_pulse_intensity = np.zeros(len(channelNumbers))
         
-        if sharedConfig['stim_do']:
-
-            new_pulse_intensity = 0            
+        if control['stim_do']:
 
             # the intensity value is different if we are in AUTO mode (controller) or MANUAL (set in GUI )
 
             # if AUTO: get controller's current value
-            if sharedConfig['controller_on']:
-                new_pulse_intensity = sharedConfig['pulse_intensity_auto']
-                if debug: print(f"automode, new_pulse_intensity is {sharedConfig['controller_value']} * {sharedConfig['stim_max_intensity']} = {new_pulse_intensity}")
+            if control['controller_on']:
+                new_pulse_intensity = np.asarray(control['pulse_intensity_auto'], dtype=float)
+                if debug: print(f"automode, new_pulse_intensity is {control['controller_value']} * {control['pulse_intensity_man']} = {new_pulse_intensity}")
 
             # if MANUAL: get value from GUI
             else:
-                new_pulse_intensity = sharedConfig['pulse_intensity_man']
+                new_pulse_intensity = np.asarray(control['pulse_intensity_man'], dtype=float)
                 if debug: print(f"manual, new_pulse_intensity is {new_pulse_intensity}")
 
-            # double check that it's not > max or set to max
-            if new_pulse_intensity > sharedConfig['stim_max_intensity']:
-                new_pulse_intensity = sharedConfig['stim_max_intensity']
-                if debug: print(f"intensity > max ({sharedConfig['stim_max_intensity']}), keeping {new_pulse_intensity}")
+            # double check that none is > its max or set it to its max
+            if (new_pulse_intensity > control['stim_max_intensity']).any():
+                new_pulse_intensity = np.minimum(new_pulse_intensity, control['stim_max_intensity'])
+                if debug: print(f"intensity > max ({control['stim_max_intensity']}), keeping {new_pulse_intensity}")
+
+        settings = (control['pulse_period'], control['pulse_width'], tuple(new_pulse_intensity.tolist()))
 
-            # update settings on the stim
-            ml_update.channel_config[channelNumber].period            = sharedConfig['pulse_period']
-            ml_update.channel_config[channelNumber].points[0].time    = sharedConfig['pulse_width']
-            ml_update.channel_config[channelNumber].points[0].current = new_pulse_intensity
+        # why we send this update, if we do
+        if schedule == 'pulse':
+            reason = 'pulse' if now >= deadline else None
+        elif settings != sent:
+            reason = 'change'
+        else:
+            reason = 'keepalive' if now - lastSend >= keepAlive else None
+        if reason is None:
+            continue
+
+        # update settings on the stim: all the channels in this one packet
+        ml_update.packet_number = sciencemode.smpt_packet_number_generator_next(device)
+        for channelNumber, shape, intensity, maximum in zip(channelNumbers, shapes, settings[2], control['stim_max_intensity']):
+            ml_update.channel_config[channelNumber].period = settings[0]
+            for point, (width, current) in enumerate(shape):
+                ml_update.channel_config[channelNumber].points[point].time    = int(round(width * settings[1]))
+                ml_update.channel_config[channelNumber].points[point].current = min(max(current * intensity, -maximum), maximum) # never more than the max of the channel, whatever the shape
 
         #######################################################################
         # Keep alive (required every < 2 seconds)
         #######################################################################
+        t0  = time.perf_counter()
         ret = sciencemode.smpt_send_ml_update(device, ml_update)
+        sendMeter.add(time.perf_counter() - t0)
+        sent, lastSend  = settings, t0
+        sends[reason]  += 1
+        if debug: print(f"sent {settings} ({reason}): {ret}")
+
+        # publish the timing every second
+        if t0 - lastTiming >= 1:
+            sharedConfig['stim_timing'] = timing()
+            lastTiming                  = t0
 
     ###########################################################################
     # Disconnect
     ###########################################################################
     
     if verbose: showTitle("graceful exit of the stimulator")
+    sharedConfig['stim_timing'] = timing()
+    if verbose: print(f"stim: {sends} updates sent, {misses} deadlines missed, late by {lateMeter.summary()} ms, sent in {sendMeter.summary()} ms")
     ret = sciencemode.smpt_close_serial_port(device)
     if debug: print(f"smpt_close_serial_port: {ret}")
     
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pure-python stand-in for the sciencemode3 stimulator library (Hasomed RehaStim, mid-level mode)
+
+sciencemode3 only exists as a Windows wheel (Documents/Rehastim/libs): StimulatorSim offers the
+part of its API used by orlau_stim (ffi.new and the smpt_* calls of the mid-level mode), so that
+funcStim2 and the whole closed loop can run on any machine, with 'stim_dummyMode' set in live.py:
+
+    sciencemode = StimulatorSim(log='stim_log.sim')
+    ml_update   = sciencemode.ffi.new("Smpt_ml_update*")
+    sciencemode.smpt_send_ml_update(device, ml_update)
+
+Like the stimulator, it leaves the mid-level mode (and stops stimulating) if it does not receive
+an ml_update for more than KEEP_ALIVE seconds: the following updates are rejected until a new
+ml_init.
+
+Every call is logged with a high-resolution timestamp in a binary file (encode_header of orlau_record,
+then one LOG_DTYPE record per call and per enabled channel), which load_stim_log reads back:
+
+    python orlau_stim_sim.py ../Data/session/stim_log.sim   # summary of a log: update rate, gaps, timeouts
+    python orlau_stim_sim.py --test                         # self-test of the keep-alive rule and of the log
+"""
+
+# Reset the vars at run if using ipython-based IDE if in main
+if __name__ == "__main__":
+    try:
+        from IPython import get_ipython
+        get_ipython().run_line_magic('reset', '-sf')
+    except: pass
+
+import sys, os, copy, time
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))     # get current directory variable
+sys.path.append(CURR_DIR)                                  # load from the utils directory
+
+import argparse
+import numpy as np
+
+from orlau_record import encode_header, read_header
+from orlau_utils import showTitle, printColor, show
+
+MAGIC      = b'ORLSTM\x00\x01' # format name and version of the log
+KEEP_ALIVE = 2.0               # maximum time between two ml_update of the mid-level mode (s)
+CHANNELS   = 8                 # Smpt_Length_Number_Of_Channels
+POINTS     = 16                # Smpt_Length_Points
+
+# kind of each record of the log
+INIT, UPDATE, STOP, TIMEOUT, REJECTED, OPEN, CLOSE = range(7)
+KINDS = ['init', 'update', 'stop', 'timeout', 'rejected', 'open', 'close']
+
+# one record per call (per enabled channel for ml_update, channel 255 for the other calls)
+LOG_DTYPE = np.dtype([
+    ('t_ns',    '<i8'),           # time of the call (time.perf_counter_ns() - header['start_ns'])
+    ('kind',    'u1'),
+    ('packet',  'u1'),
+    ('channel', 'u1'),
+    ('points',  'u1'),            # number_of_points of the channel
+    ('period',  '<f4'),           # ms
+    ('time',    '<u2', (POINTS,)), # us, for each point
+    ('current', '<f4', (POINTS,)), # mA, for each point
+    ])
+
+
+class _Struct(object):
+    # C struct allocated by ffi.new: plain attributes, initialised to 0
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def _point():
+    return _Struct(time=0, current=0, interpolation_mode=0)
+
+def _channel_config():
+    return _Struct(period=0, ramp=0, number_of_points=0, points=[_point() for _ in range(POINTS)])
+
+
+class _Ffi(object):
+    """
+    ffi.new of the structs used in the mid-level mode.
+    """
+
+    def new(self, ctype, init=None):
+        if ctype == "char[]":
+            return bytes(init)
+        if ctype == "Smpt_ml_update*":
+            return _Struct(packet_number=0, enable_channel=[False]*CHANNELS,
+                           channel_config=[_channel_config() for _ in range(CHANNELS)])
+        if ctype in ("Smpt_ml_init*", "Smpt_ack*", "Smpt_device*", "Smpt_get_version_ack*"):
+            return _Struct(packet_number=0, result=0)
+        raise ValueError(f"StimulatorSim: unknown type {ctype}")
+
+
+class StimulatorSim(object):
+    """
+    Stimulator answering the sciencemode3 calls of the mid-level mode.
+
+    Parameters
+    ----------
+    port : str, optional
+        Serial port the stimulator is found on (smpt_check_serial_port).
+    ports : list of str, optional
+        Serial ports of the simulated machine (list_ports), with other devices on them.
+    probe_time : float, optional
+        Time smpt_check_serial_port takes to answer (s).
+    log : str, optional
+        Binary log of all the calls, none if None.
+    send_time : float, optional
+        Time each packet takes on the serial port (s): the smpt_send_* calls
+        block that long, as with the real stimulator.
+    keep_alive : float, optional
+        Maximum time between two ml_update before leaving the mid-level mode (s).
+    """
+
+    def __init__(self, port='COM3', ports=('COM1', 'COM2', 'COM3', 'COM4'), probe_time=0.05, log=None, send_time=0.002, keep_alive=KEEP_ALIVE):
+        self.ffi        = _Ffi()
+        self.port       = port
+        self.ports      = sorted(set(ports) | set([port]))
+        self.probe_time = probe_time
+        self.send_time  = send_time
+        self.keep_alive = keep_alive
+        self.opened     = False
+        self.active     = False # in mid-level mode (after ml_init, until ml_stop or a keep-alive timeout)
+        self.timeouts   = 0
+        self.rejected   = 0
+        self._packet    = 0
+        self._last      = None  # time of the last ml_init/ml_update (perf_counter_ns)
+        self._log       = None
+        self._start_ns  = time.perf_counter_ns()
+        if log is not None:
+            self._log = open(log, 'wb', buffering=0)
+            self._log.write(encode_header({'dtype': LOG_DTYPE.descr, 'start_time': time.time(), 'start_ns': self._start_ns,
+                                           'keep_alive': keep_alive, 'port': port}, magic=MAGIC))
+
+    def _record(self, kind, now, packet=0, channels=()):
+        # one record per channel (or one with channel 255), in one write
+        if self._log is None:
+            return
+        records = np.zeros(max(len(channels), 1), dtype=LOG_DTYPE)
+        records['t_ns'], records['kind'], records['packet'], records['channel'] = now - self._start_ns, kind, packet % 256, 255
+        for record, (channel, config) in zip(records, channels):
+            points            = min(int(config.number_of_points), POINTS)
+            record['channel'] = channel
+            record['points']  = points
+            record['period']  = config.period
+            record['time'][:points]    = [config.points[i].time    for i in range(points)]
+            record['current'][:points] = [config.points[i].current for i in range(points)]
+        self._log.write(records.tobytes())
+
+    def _check_keep_alive(self, now):
+        # the stimulator left the mid-level mode KEEP_ALIVE seconds after the last update
+        if self.active and now - self._last > self.keep_alive * 1e9:
+            self.active    = False
+            self.timeouts += 1
+            self._record(TIMEOUT, self._last + int(self.keep_alive * 1e9))
+            printColor(f"StimulatorSim: no ml_update for more than {self.keep_alive}s, leaving the mid-level mode", 'red')
+
+    def _send(self):
+        if self.send_time:
+            time.sleep(self.send_time)
+        return time.perf_counter_ns()
+
+    def list_ports(self):
+        return list(self.ports)
+
+    def smpt_check_serial_port(self, com):
+        if self.probe_time:
+            time.sleep(self.probe_time)
+        return bytes(com).rstrip(b'\x00').decode() == self.port
+
+    def smpt_open_serial_port(self, device, com):
+        self.opened = self.smpt_check_serial_port(com)
+        if self.opened:
+            self._record(OPEN, time.perf_counter_ns())
+        return self.opened
+
+    def smpt_packet_number_generator_next(self, device):
+        self._packet = (self._packet + 1) % 64
+        return self._packet
+
+    def smpt_send_ml_init(self, device, ml_init):
+        if not self.opened:
+            return False
+        now = self._send()
+        self._check_keep_alive(now)
+        self.active, self._last = True, now
+        self._record(INIT, now, ml_init.packet_number)
+        return True
+
+    def smpt_send_ml_update(self, device, ml_update):
+        if not self.opened:
+            return False
+        now = self._send()
+        self._check_keep_alive(now)
+        channels = [(channel, ml_update.channel_config[channel]) for channel in range(CHANNELS) if ml_update.enable_channel[channel]]
+        if not self.active:
+            self.rejected += 1
+            self._record(REJECTED, now, ml_update.packet_number, channels)
+            return False
+        self._last = now
+        self._record(UPDATE, now, ml_update.packet_number, channels)
+        return True
+
+    def smpt_send_ml_stop(self, device, packet_number):
+        if not self.opened:
+            return False
+        now = self._send()
+        self._check_keep_alive(now)
+        self.active = False
+        self._record(STOP, now, packet_number)
+        return True
+
+    def smpt_close_serial_port(self, device):
+        if not self.opened:
+            return False
+        now = time.perf_counter_ns()
+        self._check_keep_alive(now)
+        self._record(CLOSE, now)
+        self.opened = False
+        self.active = False
+        self.close()
+        return True
+
+    def close(self):
+        """
+        Close the log (done by smpt_close_serial_port, or when the stimulator was never opened).
+        """
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def load_stim_log(path):
+    """
+    Load the log of a StimulatorSim.
+
+    Returns
+    -------
+    records : ndarray of LOG_DTYPE
+        Records of the calls, with 't_ns' from the opening of the log.
+    header : dict
+        Content of the JSON header ('start_time': time.time() at t_ns = 0).
+    """
+    header, offset = read_header(path, magic=MAGIC)
+    count          = (os.path.getsize(path) - offset) // LOG_DTYPE.itemsize # ignore a last record cut by a crash
+    return np.fromfile(path, dtype=LOG_DTYPE, count=count, offset=offset), header
+
+
+def summarise(records):
+    """
+    Update rate and timing of the updates of a log.
+
+    Returns
+    -------
+    summary : dict
+        Number of calls of each kind, updates per second, mean and max time between two updates (ms).
+    """
+    updates = records[records['kind'] == UPDATE]
+    times   = np.unique(updates['t_ns']) / 1e6 # one time per ml_update, whatever its number of channels
+    gaps    = np.diff(times)
+    summary = dict((kind, int(np.count_nonzero(records['kind'] == i))) for i, kind in enumerate(KINDS))
+    summary['updates'] = len(times)
+    summary['rate']    = round(float((len(times) - 1) / (times[-1] - times[0]) * 1e3), 1) if len(times) > 1 else None
+    summary['gap']     = round(float(gaps.mean()), 3) if len(gaps) else None
+    summary['max_gap'] = round(float(gaps.max()), 3)  if len(gaps) else None
+    return summary
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Pure-python stimulator (sciencemode3 stand-in) and its logs")
+    parser.add_argument('log',    nargs='?', default=None, help="log to summarise (stim_log.sim of a session)")
+    parser.add_argument('--test', action='store_true', help="self-test of the keep-alive rule and of the log")
+    args = parser.parse_args()
+
+    if args.log:
+        records, header = load_stim_log(args.log)
+        print(summarise(records))
+
+    if args.test:
+
+        import tempfile
+
+        showTitle("StimulatorSim self-test", 'cyan')
+        path        = tempfile.mkdtemp() + '/stim_log.sim'
+        sciencemode = StimulatorSim(log=path, send_time=0, probe_time=0, keep_alive=0.2)
+        device      = sciencemode.ffi.new("Smpt_device*")
+
+        # the port search of funcStim2
+        port = 1
+        while not sciencemode.smpt_check_serial_port(sciencemode.ffi.new("char[]", bytes(f"COM{port}", "utf-8"))):
+            port += 1
+        com = sciencemode.ffi.new("char[]", bytes(f"COM{port}", "utf-8"))
+        assert port == 3 and sciencemode.smpt_open_serial_port(device, com)
+
+        # updates before the mid-level mode are rejected
+        ml_update = sciencemode.ffi.new("Smpt_ml_update*")
+        ml_update.enable_channel[1] = True
+        ml_update.channel_config[1].period            = 40
+        ml_update.channel_config[1].number_of_points  = 1
+        ml_update.channel_config[1].points[0].time    = 300
+        ml_update.channel_config[1].points[0].current = 5
+        assert not sciencemode.smpt_send_ml_update(device, ml_update)
+
+        ml_init = sciencemode.ffi.new("Smpt_ml_init*")
+        ml_init.packet_number = sciencemode.smpt_packet_number_generator_next(device)
+        assert sciencemode.smpt_send_ml_init(device, ml_init)
+        for i in range(50):
+            ml_update.packet_number = sciencemode.smpt_packet_number_generator_next(device)
+            assert sciencemode.smpt_send_ml_update(device, ml_update)
+            time.sleep(0.002)
+
+        # no update for longer than the keep-alive: the next update is rejected, until a new ml_init
+        time.sleep(0.3)
+        assert not sciencemode.smpt_send_ml_update(device, ml_update) and sciencemode.timeouts == 1
+        assert sciencemode.smpt_send_ml_init(device, ml_init) and sciencemode.smpt_send_ml_update(device, ml_update)
+        sciencemode.smpt_close_serial_port(device)
+
+        records, header = load_stim_log(path)
+        summary         = summarise(records)
+        assert [summary[kind] for kind in KINDS] == [2, 51, 0, 1, 2, 1, 1], summary
+        updates = records[records['kind'] == UPDATE]
+        assert np.all(updates['channel'] == 1) and np.all(updates['current'][:, 0] == 5) and np.all(updates['time'][:, 0] == 300)
+        assert np.all(np.diff(records['t_ns']) >= 0)
+        printColor(f"keep-alive and log ok: {summary}", 'green')
+
+        # port discovery of funcStim2: all the ports at once, then the cached one first, and a clear error if it is gone
+        from orlau_stim import find_stimulator
+        cache       = os.path.dirname(path) + '/stim_port.json'
+        sciencemode = StimulatorSim(port='COM7', ports=[f"COM{number}" for number in range(1, 9)], probe_time=0.05)
+        t0   = time.perf_counter()
+        port = 1
+        while not sciencemode.smpt_check_serial_port(sciencemode.ffi.new("char[]", bytes(f"COM{port}", "utf-8"))):
+            port += 1
+        t_loop = time.perf_counter() - t0
+        t0     = time.perf_counter()
+        assert find_stimulator(sciencemode, cache=cache) == 'COM7'
+        t_cold = time.perf_counter() - t0
+        t0     = time.perf_counter()
+        assert find_stimulator(sciencemode, cache=cache) == 'COM7'
+        t_warm = time.perf_counter() - t0
+        sciencemode.port = 'COM9'
+        try:
+            find_stimulator(sciencemode, cache=cache, timeout=0.5)
+            raise AssertionError("no error without stimulator")
+        except IOError as error:
+            printColor(f"without stimulator: {error}", 'white')
+        printColor(f"port discovery ok: {1e3*t_loop:.0f} ms one port after the other, {1e3*t_cold:.0f} ms all at once, {1e3*t_warm:.0f} ms from the cache (50 ms per port)", 'green')
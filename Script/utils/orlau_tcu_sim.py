@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Delsys Trigno Control Utility (TCU)
+
+Listens on the command port (50040) and on the EMG/IMU data ports (50043/50044),
+answers the commands we send from orlau_emg_utils (START, STOP, MASTER, QUIT, SENSOR n ...)
+and streams little-endian float32 frames at the real rates (2000 Hz EMG, 148.1 Hz IMU),
+either from synthetic signals or by replaying a recorded session folder.
+
+It allows running the real TrignoEMG/TrignoAccel code paths and the full live.py pipeline
+on a machine with no Delsys hardware:
+
+    python orlau_tcu_sim.py                           # synthetic signals, until ctrl+c
+    python orlau_tcu_sim.py --replay ../Data/session  # replay session.orl / data_*.bin (or the older text files)
+    python orlau_tcu_sim.py --bench 10                # benchmark TrignoEMG/TrignoAccel reads for 10 seconds
+"""
+
+# Reset the vars at run if using ipython-based IDE if in main
+if __name__ == "__main__":
+    try:
+        from IPython import get_ipython
+        get_ipython().run_line_magic('reset', '-sf')
+    except: pass
+
+import sys, os, copy, time, json
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))     # get current directory variable
+os.chdir(os.path.abspath(os.path.dirname(__file__)))       # change current working directory
+sys.path.append(CURR_DIR)                                  # load from the utils directory
+
+import socket
+import threading
+import argparse
+import numpy as np
+
+from orlau_session import SessionFile
+
+from orlau_utils import showTitle, printColor, show
+
+class SyntheticSource(object):
+    """
+    Synthetic EMG and IMU signals.
+
+    EMG channels get background noise, a slow alternating contraction of the
+    first two sensors (deltoid/biceps) and stimulation artifacts at the pulse
+    period, so that the filter/rms/controller stages all have something to do.
+    IMU channels are slow sinusoids with a different phase per channel.
+
+    Parameters
+    ----------
+    emg_channels : int
+        Number of channels of the EMG stream.
+    imu_channels : int
+        Number of channels of the IMU stream.
+    emg_rate : float
+        EMG sampling rate in Hz.
+    imu_rate : float
+        IMU sampling rate in Hz.
+    stim_period : float
+        Period of the fake stimulation artifacts in ms (0 for none).
+    seed : int
+        Seed of the noise generator.
+    """
+
+    def __init__(self, emg_channels=16, imu_channels=144, emg_rate=2000, imu_rate=148.1, stim_period=25, seed=0):
+        self.emg_channels = emg_channels
+        self.imu_channels = imu_channels
+        self.emg_rate     = emg_rate
+        self.imu_rate     = imu_rate
+        self.stim_period  = stim_period
+        self._rng         = np.random.default_rng(seed)
+
+    def emg(self, start, n):
+        """
+        Get n samples of EMG starting at sample number start, shape (n, emg_channels).
+        """
+        t     = (start + np.arange(n)) / self.emg_rate
+        data  = self._rng.normal(0, 0.00002, size=(n, self.emg_channels))
+        burst = 0.0003 * np.sin(2*np.pi*0.25*t)                  # 4 seconds cycle: deltoid then biceps
+        data[:,0] += np.clip(burst, 0, None)  * self._rng.normal(0, 1, size=n)
+        if self.emg_channels > 1:
+            data[:,1] += np.clip(-burst, 0, None) * self._rng.normal(0, 1, size=n)
+        if self.stim_period:
+            period_samples = int(round(self.stim_period / 1000 * self.emg_rate))
+            artifacts = ((start + np.arange(n)) % period_samples) == 0
+            data[artifacts, :] += 0.0011
+        return data.astype('<f4')
+
+    def imu(self, start, n):
+        """
+        Get n samples of IMU starting at sample number start, shape (n, imu_channels).
+        """
+        t     = (start + np.arange(n)) / self.imu_rate
+        phase = np.arange(self.imu_channels) * 2*np.pi / self.imu_channels
+        data  = np.sin(2*np.pi*0.5*t[:,None] + phase[None,:])
+        return data.astype('<f4')
+
+
+class ReplaySource(object):
+    """
+    Replay of a recorded session folder, looped forever.
+
+    EMG and IMU are taken from the recording (session.orl or data_*.bin, see
+    orlau_session), or from the older text files: data_raw.txt (one column per
+    muscle) and data_raw_*.txt files (one sensor per muscle), data_imu.txt or
+    the legacy full-width data_imu_all.txt. The muscles are placed on the sensors
+    of emg_sensors (when conf_sharedConfig.json exists) and the imu channels back
+    on imu_channels. Missing streams are replaced by zeros.
+
+    Parameters
+    ----------
+    folder : str
+        Session folder (as written in Script/Data).
+    emg_channels : int
+        Number of channels of the EMG stream.
+    imu_channels : int
+        Number of channels of the IMU stream.
+    """
+
+    def __init__(self, folder, emg_channels=16, imu_channels=144):
+        self.folder       = folder
+        self.emg_channels = emg_channels
+        self.imu_channels = imu_channels
+
+        config = {}
+        if os.path.exists(folder+'/conf_sharedConfig.json'):
+            with open(folder+'/conf_sharedConfig.json') as fp:
+                config = json.load(fp)
+
+        # EMG: one column per muscle, or one file per muscle (older sessions)
+        self._emg = np.zeros((1, emg_channels), dtype='<f4')
+        columns   = []
+        session   = SessionFile(folder)
+        if 'emg_raw' in session:
+            columns = list(np.nan_to_num(session['emg_raw'][:])) # lost samples replaced by 0
+        elif os.path.exists(folder+'/data_raw.txt'):
+            columns = list(np.loadtxt(folder+'/data_raw.txt', delimiter=',', ndmin=2).T)
+        else:
+            muscles = ['delt', 'bic']
+            columns = [np.loadtxt(folder+'/data_raw_'+m+'.txt', delimiter=',', ndmin=1) for m in muscles if os.path.exists(folder+'/data_raw_'+m+'.txt')]
+        if columns:
+            length    = min([len(c) for c in columns])
+            self._emg = np.zeros((length, emg_channels), dtype='<f4')
+            sensors   = config.get('emg_sensors') or list(range(1, len(columns)+1))
+            for sensor, column in zip(sensors, columns):
+                self._emg[:,sensor-1] = column[:length]
+
+        # IMU: subset of channels, or all of them
+        self._imu = np.zeros((1, imu_channels), dtype='<f4')
+        if 'imu_all' in session:
+            subset    = np.nan_to_num(session['imu_all'][:])
+            self._imu = np.zeros((subset.shape[1], imu_channels), dtype='<f4')
+            self._imu[:,session['imu_all'].header['imu_channels']] = subset.T
+        elif os.path.exists(folder+'/data_imu.txt') and config.get('imu_channels'):
+            subset    = np.loadtxt(folder+'/data_imu.txt', delimiter=',', ndmin=2)
+            self._imu = np.zeros((len(subset), imu_channels), dtype='<f4')
+            self._imu[:,config['imu_channels']] = subset
+        elif os.path.exists(folder+'/data_imu_all.txt'):
+            full      = np.loadtxt(folder+'/data_imu_all.txt', delimiter=',', ndmin=2)
+            self._imu = np.zeros((len(full), imu_channels), dtype='<f4')
+            self._imu[:,:full.shape[1]] = full[:,:imu_channels]
+        session.close()
+
+    @staticmethod
+    def _loop(data, start, n):
+        return np.take(data, np.arange(start, start+n) % len(data), axis=0)
+
+    def emg(self, start, n):
+        return self._loop(self._emg, start, n)
+
+    def imu(self, start, n):
+        return self._loop(self._imu, start, n)
+
+
+class TcuSimulator(object):
+    """
+    Local Trigno Control Utility server.
+
+    Parameters
+    ----------
+    source : SyntheticSource or ReplaySource, optional
+        Where the streamed data comes from. Synthetic signals by default.
+    host : str, optional
+        IP address to listen on.
+    cmd_port : int, optional
+        Port of TCU command messages.
+    emg_port : int, optional
+        Port of the EMG data stream.
+    imu_port : int, optional
+        Port of the IMU (aux) data stream.
+    emg_rate : float, optional
+        EMG sampling rate in Hz.
+    imu_rate : float, optional
+        IMU sampling rate in Hz.
+    frame_period : float, optional
+        Time between two frames sent on the data ports, in seconds (the TCU
+        sends 27 EMG samples every 13.5ms).
+    aux_channel_count : int, optional
+        Answer to SENSOR n AUXCHANNELCOUNT?
+    verbose : bool, optional
+        Print the commands received.
+    """
+
+    BANNER   = 'Delsys Trigno System Digital Protocol Version 3.6.0 (simulator)'
+    CMD_TERM = '\r\n\r\n'
+
+    EMG_CHANNELS = 16
+    IMU_CHANNELS = 144
+
+    def __init__(self, source=None, host='127.0.0.1', cmd_port=50040, emg_port=50043, imu_port=50044,
+                 emg_rate=2000, imu_rate=148.1, frame_period=0.0135, aux_channel_count=9, verbose=False):
+        self.source            = source if source is not None else SyntheticSource(self.EMG_CHANNELS, self.IMU_CHANNELS, emg_rate, imu_rate)
+        self.host              = host
+        self.cmd_port          = cmd_port
+        self.emg_port          = emg_port
+        self.imu_port          = imu_port
+        self.emg_rate          = emg_rate
+        self.imu_rate          = imu_rate
+        self.frame_period      = frame_period
+        self.aux_channel_count = aux_channel_count
+        self.verbose           = verbose
+
+        self.sensor_modes      = {}                    # SENSOR n SETMODE y
+        self._streaming        = threading.Event()     # set between START and STOP
+        self._shutdown         = threading.Event()
+        self._lock             = threading.Lock()
+        self._data_clients     = {emg_port: [], imu_port: []}
+        self._servers          = []
+        self._threads          = []
+
+    ###
+    # Server lifecycle
+    ###
+
+    def start(self):
+        """
+        Open the listening sockets and start the server threads (non blocking).
+        """
+        for port, handler in [(self.cmd_port, self._accept_cmd), (self.emg_port, self._accept_data), (self.imu_port, self._accept_data)]:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((self.host, port))
+            server.listen(8)
+            server.settimeout(0.5)
+            self._servers.append(server)
+            self._spawn(handler, server, port)
+
+        self._spawn(self._stream, self.emg_port, self.EMG_CHANNELS, self.emg_rate, self.source.emg)
+        self._spawn(self._stream, self.imu_port, self.IMU_CHANNELS, self.imu_rate, self.source.imu)
+        printColor(f"TCU simulator listening on {self.host} (cmd {self.cmd_port}, emg {self.emg_port}, imu {self.imu_port})", 'green')
+
+    def stop(self):
+        """
+        Stop streaming, close all sockets and wait for the threads.
+        """
+        self._shutdown.set()
+        self._streaming.clear()
+        for thread in self._threads:
+            thread.join(timeout=2)
+        for server in self._servers:
+            server.close()
+        with self._lock:
+            for clients in self._data_clients.values():
+                for client in clients:
+                    client.close()
+                clients.clear()
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    ###
+    # Command port
+    ###
+
+    def _accept_cmd(self, server, port):
+        while not self._shutdown.is_set():
+            try:
+                client, address = server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            self._spawn(self._serve_cmd, client)
+
+    def _serve_cmd(self, client):
+        client.settimeout(0.5)
+        client.sendall(bytes(self.BANNER + self.CMD_TERM, encoding='ascii'))
+        buffer = ''
+        while not self._shutdown.is_set():
+            try:
+                chunk = client.recv(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not chunk:
+                break
+            buffer += str(chunk, 'ascii', errors='replace')
+            while self.CMD_TERM in buffer:
+                command, buffer = buffer.split(self.CMD_TERM, 1)
+                response = self.answer(command.strip())
+                if self.verbose: print(f"TCU sim: {command.strip()} -> {response}")
+                client.sendall(bytes(response + self.CMD_TERM, encoding='ascii'))
+                if command.strip().upper() == 'QUIT':
+                    client.close()
+                    return
+        client.close()
+
+    def answer(self, command):
+        """
+        Response of the TCU to one command (without the terminator).
+        """
+        words = command.upper().split()
+        if not words:
+            return 'INVALID COMMAND'
+
+        if words[0] == 'START':
+            self._streaming.set()
+            return 'OK'
+        if words[0] in ('STOP', 'QUIT'):
+            self._streaming.clear()
+            return 'OK'
+        if words[0] == 'MASTER':
+            return 'OK'
+
+        if words[0] == 'SENSOR' and len(words) >= 3 and words[1].isdigit():
+            n = int(words[1])
+            if not 1 <= n <= self.EMG_CHANNELS:
+                return 'INVALID SENSOR'
+            if words[2] == 'TYPE?':
+                return 'D'
+            if words[2] == 'MODE?':
+                return str(self.sensor_modes.get(n, 39))
+            if words[2] == 'SETMODE' and len(words) == 4:
+                self.sensor_modes[n] = int(words[3])
+                return 'OK'
+            if words[2] == 'STARTINDEX?':
+                return str(n)
+            if words[2] == 'AUXSTARTINDEX?':
+                return str((n-1) * (self.IMU_CHANNELS // self.EMG_CHANNELS) + 1)
+            if words[2] == 'AUXCHANNELCOUNT?':
+                return str(self.aux_channel_count)
+            if words[2] == 'CHANNEL' and len(words) == 5 and words[4] == 'UNITS?':
+                return 'V'
+
+        return 'INVALID COMMAND'
+
+    ###
+    # Data ports
+    ###
+
+    def _accept_data(self, server, port):
+        while not self._shutdown.is_set():
+            try:
+                client, address = server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            with self._lock:
+                self._data_clients[port].append(client)
+
+    def _stream(self, port, channels, rate, generate):
+        """
+        Send frames to the clients of a data port, paced on a deadline so the
+        average rate is exact even when a frame holds a fractional number of samples.
+        """
+        sent     = 0
+        base     = 0
+        frame    = 0
+        deadline = None
+        while not self._shutdown.is_set():
+
+            if not self._streaming.is_set():
+                deadline = None
+                self._streaming.wait(timeout=0.5)
+                continue
+
+            now = time.perf_counter()
+            if deadline is None:                        # (re)started: pace from now, continuing the source where we stopped
+                deadline, start, frame, base = now, now, 0, sent
+
+            frame += 1
+            due    = base + int(frame * self.frame_period * rate)
+            if due > sent:
+                payload = generate(sent, due - sent).astype('<f4', copy=False).tobytes()
+                sent    = due
+                with self._lock:
+                    for client in list(self._data_clients[port]):
+                        try:
+                            client.sendall(payload)
+                        except OSError:
+                            self._data_clients[port].remove(client)
+
+            deadline = start + frame * self.frame_period
+            delay    = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def benchmark(duration=10, samples_per_read=300, imu_samples_per_read=300, emg_sensors=[1,2], imu_sensors=[4,8]):
+    """
+    Read from the simulator through the real TrignoEMG/TrignoAccel classes and report timings.
+    """
+    import orlau_emg_utils as delsys
+
+    devEMG = delsys.TrignoEMG(channel_range=(0, 16), samples_per_read=samples_per_read, host='127.0.0.1', timeout=10)
+    devIMU = delsys.TrignoAccel(channel_range=(0, 150), samples_per_read=imu_samples_per_read, host='127.0.0.1', timeout=10)
+    devEMG.become_master()
+    devEMG.set_channels(devEMG.sensor_channels(emg_sensors))
+    devIMU.set_channels(devIMU.sensor_channels(imu_sensors, aux=True))
+    devEMG.start()
+
+    results = {}
+    def reader(name, dev):
+        waits, stamps, samples = [], [], 0
+        t_end = time.perf_counter() + duration
+        while time.perf_counter() < t_end:
+            t0 = time.perf_counter()
+            data = dev.read()
+            stamps.append(time.perf_counter())
+            waits.append(stamps[-1] - t0)
+            samples += data.shape[1]
+        results[name] = (stamps, samples, waits)
+
+    threads = [threading.Thread(target=reader, args=('emg', devEMG)), threading.Thread(target=reader, args=('imu', devIMU))]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    devEMG.stop()
+    for name, (stamps, samples, waits) in results.items():
+        # effective rate measured between the first and the last batch (the first one includes the start-up delay)
+        rate = (samples - samples/len(stamps)) / (stamps[-1] - stamps[0]) if len(stamps) > 1 else float('nan')
+        print(f"{name}: {len(stamps)} batches, {samples} samples/channel, effective rate {rate:.1f} Hz, read() mean {1000*np.mean(waits[1:] or waits):.2f} ms, max {1000*np.max(waits[1:] or waits):.2f} ms")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local Trigno Control Utility simulator")
+    parser.add_argument('--host',        default='127.0.0.1')
+    parser.add_argument('--replay',      default=None,  help="session folder to replay instead of synthetic signals")
+    parser.add_argument('--stim-period', default=25,    type=float, help="period of the synthetic stim artifacts in ms (0 for none)")
+    parser.add_argument('--bench',       default=0,     type=float, help="benchmark TrignoEMG/TrignoAccel reads for this many seconds, then exit")
+    parser.add_argument('--verbose',     action='store_true')
+    args = parser.parse_args()
+
+    showTitle("TCU simulator", 'cyan')
+
+    if args.replay:
+        source = ReplaySource(args.replay)
+        printColor(f"replaying {args.replay}", 'white')
+    else:
+        source = SyntheticSource(stim_period=args.stim_period)
+
+    sim = TcuSimulator(source=source, host=args.host, verbose=args.verbose)
+    sim.start()
+    try:
+        if args.bench:
+            benchmark(duration=args.bench)
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+    print("TCU simulator: goodbye")
@@ -44,6 +44,95 @@ def convert_to_rms(muscle_raw, analogFrequency=2000, power=2, highFreq=10, lowFr
     
     return result_rms
 
+class StreamingRms(object):
+    """
+    Causal moving RMS, batch after batch, with one output value per input sample.
+
+    Same values as convert_to_rms (rectification, then square root of the mean of |x|^power
+    over 'window' samples), but the end of the previous batch is kept so that the window
+    runs continuously across batches instead of shrinking each batch ('valid' convolution).
+    Before the first 'window' samples, the missing past is taken as 0.
+
+    The sums over the window are computed from a cumulative sum over [end of the previous
+    batch, new batch], so nothing drifts from one batch to the next.
+
+    Parameters
+    ----------
+    channels : int
+        Number of channels (rows) of the batches.
+    """
+
+    def __init__(self, channels=1):
+        self.channels = channels
+        self.tail     = np.zeros((channels, 0)) # rectified end of the previous batches
+
+    def process(self, data, power=2, window=200):
+        """
+        Moving RMS of the next batch.
+
+        Parameters
+        ----------
+        data : ndarray, shape=(channels, n)
+            New batch.
+        power : float, optional
+            Power applied to the rectified signal before averaging.
+        window : int, optional
+            Number of samples of the moving window.
+
+        Returns
+        -------
+        rms : ndarray, shape=(channels, n)
+            RMS at each sample of the batch (over this sample and the window-1 before it).
+        """
+        data = abs(np.atleast_2d(data))
+        n    = data.shape[1]
+
+        # rectified signal over the window-1 samples before the batch (0 if we do not have them yet) and the batch
+        past  = self.tail[:, max(self.tail.shape[1] - (window - 1), 0):]
+        full  = np.zeros((self.channels, window - 1 + n))
+        full[:, window-1-past.shape[1]:window-1] = past
+        full[:, window-1:]                       = data
+
+        # sum over each window = difference of the cumulative sum
+        csum          = np.zeros((self.channels, window + n - 1 + 1))
+        csum[:, 1:]   = np.cumsum(np.power(full, power), axis=1)
+        mean          = (csum[:, window:] - csum[:, :-window]) / float(window)
+        rms           = np.sqrt(np.maximum(mean, 0)) # the difference can be slightly below 0 with rounding errors
+
+        # keep what the next batch needs (more if the window was larger before)
+        keep      = max(window - 1, self.tail.shape[1])
+        self.tail = full[:, max(full.shape[1] - keep, 0):].copy()
+        return rms
+
+class LatencyMeter(object):
+    """
+    Statistics of a latency measured at each batch (e.g. from the publication of a batch of emg
+    to the decision of the controller on it), over the last 'size' measures.
+
+    Parameters
+    ----------
+    size : int, optional
+        Number of measures kept.
+    """
+
+    def __init__(self, size=1000):
+        self.values = np.zeros(size)
+        self.count  = 0 # measures since the creation (the last 'size' ones are kept)
+
+    def add(self, seconds):
+        self.values[self.count % len(self.values)] = seconds
+        self.count += 1
+
+    def summary(self):
+        """
+        Mean, 95th percentile and max of the measures kept, in ms (None if there are none yet).
+        """
+        if self.count == 0:
+            return None
+        values = self.values[:min(self.count, len(self.values))] * 1e3
+        return {'mean': round(float(values.mean()), 2), 'p95': round(float(np.percentile(values, 95)), 2),
+                'max': round(float(values.max()), 2), 'count': self.count}
+
 def time_normalise(data, length=100):
 
     arr_ref                = np.empty((1,length,))